@@ -0,0 +1,153 @@
+#  Copyright (c) 2021, CRS4
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy of
+#  this software and associated documentation files (the "Software"), to deal in
+#  the Software without restriction, including without limitation the rights to
+#  use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+#  the Software, and to permit persons to whom the Software is furnished to do so,
+#  subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+#  FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+#  COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+#  IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+#  CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+Throughput and geometric error of the mask_to_shapes scalers.
+
+For every scaler, the contours of each mask are scaled to the slide
+resolution and compared with the area of the pixels they enclose
+(filled contour pixels times the per-axis scale factors), and their
+bounding boxes with the pixel extent of the contours. Synthetic
+masks contain random ellipses, optionally with a slightly anisotropic
+slide resolution; real masks are zarr groups as read by mask_to_shapes.
+
+    python benchmarks/bench_scalers.py [--mask GROUP.zarr ...]
+"""
+
+import argparse
+import sys
+import time
+from math import log, sqrt
+
+import cv2
+import numpy as np
+
+from promort_tools.converters.mask_to_shapes import (
+    SCALERS,
+    _read_group,
+    apply_threshold,
+    filter_contours,
+    get_scaler,
+    pack_contours,
+)
+
+ROW = "{0:<28} {1:<10} {2:>8} {3:>10} {4:>11} {5:>9} {6:>9} {7:>9}"
+
+
+def synthetic_mask(size, ellipses, seed):
+    rng = np.random.default_rng(seed)
+    mask = np.zeros((size, size), dtype=np.uint8)
+    for _ in range(ellipses):
+        center = tuple(int(c) for c in rng.integers(0, size, 2))
+        axes = tuple(int(a) for a in rng.integers(2, max(3, size // 100), 2))
+        cv2.ellipse(mask, center, axes, float(rng.uniform(0, 180)), 0, 360, 100, -1)
+    return mask
+
+
+def pixel_geometry(contours, axis_factors):
+    areas, extents = [], []
+    for contour in contours:
+        x, y, w, h = cv2.boundingRect(contour)
+        filled = np.zeros((h, w), dtype=np.uint8)
+        cv2.drawContours(filled, [contour], 0, 1, cv2.FILLED, offset=(-x, -y))
+        areas.append(filled.sum() * axis_factors[0] * axis_factors[1])
+        extents.append((w * axis_factors[0], h * axis_factors[1]))
+    return np.array(areas), np.array(extents)
+
+
+def extents(scaled):
+    return np.array(
+        [np.ptp(c, axis=0) for c in np.split(scaled.coordinates, scaled.offsets[1:-1])]
+    )
+
+
+def run(label, mask, resolution, threshold, repeat):
+    binary_mask = apply_threshold(mask, threshold)
+    contours, _ = cv2.findContours(
+        binary_mask, mode=cv2.RETR_EXTERNAL, method=cv2.CHAIN_APPROX_SIMPLE
+    )
+    contours = filter_contours(contours, mask.size, 0)
+    points, offsets = pack_contours(contours)
+    axis_factors = (resolution[0] / mask.shape[1], resolution[1] / mask.shape[0])
+    factor = pow(2, log(sqrt(axis_factors[0] * axis_factors[1]), 2))
+    expected_areas, expected_extents = pixel_geometry(contours, axis_factors)
+    for name in SCALERS:
+        scaler = get_scaler(name, mask.shape, resolution)
+        elapsed = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            scaled = scaler.scale_shapes(points, offsets, factor)
+            elapsed.append(time.perf_counter() - start)
+        area_error = np.abs(scaled.areas - expected_areas) / expected_areas
+        extent_error = np.abs(extents(scaled) - expected_extents) / expected_extents
+        print(
+            ROW.format(
+                label,
+                name,
+                len(contours),
+                "{0:.0f}".format(len(contours) / min(elapsed)),
+                "{0:.0f}".format(len(points) / min(elapsed)),
+                "{0:.4f}".format(area_error.mean()),
+                "{0:.4f}".format(area_error.max()),
+                "{0:.4f}".format(extent_error.mean()),
+            )
+        )
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--mask", type=str, action="append", default=[], help="zarr group to include"
+    )
+    parser.add_argument(
+        "-t", dest="threshold", type=float, default=0.5, help="threshold (default=0.5)"
+    )
+    parser.add_argument("--size", type=int, default=4096, help="synthetic mask size")
+    parser.add_argument(
+        "--ellipses", type=int, default=2000, help="ellipses per synthetic mask"
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="timed repetitions")
+    return parser
+
+
+def main(argv=None):
+    args = make_parser().parse_args(argv)
+    print(
+        ROW.format(
+            "mask",
+            "scaler",
+            "shapes",
+            "shapes/s",
+            "points/s",
+            "area err",
+            "max area",
+            "bbox err",
+        )
+    )
+    mask = synthetic_mask(args.size, args.ellipses, seed=0)
+    size = args.size
+    run("synthetic x16", mask, (size * 16, size * 16), 50, args.repeat)
+    run("synthetic x16/x15.5", mask, (size * 16, int(size * 15.5)), 50, args.repeat)
+    for path in args.mask:
+        mask, resolution, round_to_0_100 = _read_group(path)
+        threshold = round(args.threshold * 100) if round_to_0_100 else args.threshold
+        run(path[-28:], mask, resolution, threshold, args.repeat)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
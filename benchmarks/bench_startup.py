@@ -0,0 +1,111 @@
+#  Copyright (c) 2021, CRS4
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy of
+#  this software and associated documentation files (the "Software"), to deal in
+#  the Software without restriction, including without limitation the rights to
+#  use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+#  the Software, and to permit persons to whom the Software is furnished to do so,
+#  subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+#  FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+#  COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+#  IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+#  CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+Startup time of the command line tools, checked against an import budget.
+
+Every command is run --repeat times with python -X importtime. Its import
+time is the sum of the self times of all the imported modules, minus the
+one of a bare interpreter, and the median over the runs is compared with
+BUDGETS. Commands only print their help, so the time is what every
+invocation pays before doing any work. Exits with an error if a command
+is over budget.
+
+    python benchmarks/bench_startup.py [--repeat 5]
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+ROW = "{0:<30} {1:>10} {2:>7} {3:>8}  {4}"
+
+IMPORTER = "promort_tools.importers.importer"
+ZARR_TO_TILEDB = "promort_tools.converters.zarr_to_tiledb"
+MASK_TO_SHAPES = "promort_tools.converters.mask_to_shapes"
+
+# label: (python arguments, import budget in ms); the budgets leave some headroom over
+# the times measured on a development machine and stay below the time needed to import
+# numpy (about 60 ms), so they fail if a heavy dependency is imported at startup again
+BUDGETS = {
+    "importer --help": (["-m", IMPORTER, "--help"], 45),
+    "zarr_to_tiledb --help": (["-m", ZARR_TO_TILEDB, "--help"], 55),
+    "zarr_to_tiledb batch --help": (["-m", ZARR_TO_TILEDB, "batch", "--help"], 55),
+    "mask_to_shapes --help": (["-m", MASK_TO_SHAPES, "--help"], 55),
+    "mask_to_shapes batch --help": (["-m", MASK_TO_SHAPES, "batch", "--help"], 55),
+}
+
+
+def import_time(stderr):
+    # import time: self [us] | cumulative | imported package
+    self_times = [line.split("|")[0].split(":")[1] for line in stderr.splitlines()]
+    return sum(int(t) for t in self_times if t.strip().isdigit())
+
+
+def run(arguments, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        process = subprocess.run(
+            [sys.executable, "-X", "importtime"] + arguments,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        wall = time.perf_counter() - start
+        times.append((import_time(process.stderr) / 1000, wall * 1000))
+    return tuple(statistics.median(t) for t in zip(*times))
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--repeat", type=int, default=5, help="runs of each command")
+    return parser
+
+
+def main(argv=None):
+    args = make_parser().parse_args(argv)
+    base_imports, base_wall = run(["-c", "pass"], args.repeat)
+    print(
+        "bare interpreter: {0:.1f} ms imports, {1:.1f} ms wall".format(
+            base_imports, base_wall
+        )
+    )
+    print(ROW.format("command", "import ms", "budget", "wall ms", ""))
+    over_budget = 0
+    for label, (arguments, budget) in BUDGETS.items():
+        imports, wall = run(arguments, args.repeat)
+        imports -= base_imports
+        over_budget += imports > budget
+        print(
+            ROW.format(
+                label,
+                "{0:.1f}".format(imports),
+                budget,
+                "{0:.1f}".format(wall - base_wall),
+                "OVER BUDGET" if imports > budget else "",
+            )
+        )
+    if over_budget:
+        sys.exit("{0} commands over budget".format(over_budget))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,241 @@
+#  Copyright (c) 2021, CRS4
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy of
+#  this software and associated documentation files (the "Software"), to deal in
+#  the Software without restriction, including without limitation the rights to
+#  use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+#  the Software, and to permit persons to whom the Software is furnished to do so,
+#  subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+#  FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+#  COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+#  IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+#  CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+Write time, on-disk size and read latency of zarr_to_tiledb configurations.
+
+A zarr group with a uint8 and a float32 prediction array (smooth random
+blobs, like real tissue/tumor predictions) is converted with every
+configuration; reads are random windows of --window pixels, as requested
+by the viewer when browsing a slide. Conversion time is then measured for
+each --workers count on a group with three float32 classes, as produced
+by the GLEASON predictions. Finally dense and sparse arrays are compared
+on a mostly empty synthetic mask and on every --dataset zarr group; sparse
+windows are read as TileDBMask does, filling the missing cells.
+
+    python benchmarks/bench_tiledb.py [--size 4096] [--reads 200] [--workers 1,2,4]
+                                      [--dataset GROUP.zarr ...]
+"""
+
+import argparse
+import itertools
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+import tiledb
+import zarr
+
+from promort_tools.converters.mask_to_shapes import TileDBMask
+from promort_tools.converters.zarr_to_tiledb import ZarrToTileDBConverter
+
+ROW = "{0:<34} {1:>9} {2:>10} {3:>11} {4:>11}"
+
+# label: (tile_size, filters, attribute_filters)
+CONFIGURATIONS = {
+    "4x4 tiles, no filters": ((4, 4), [], {}),
+    "zarr chunk tiles, no filters": (None, [], {}),
+    "zarr chunk tiles, zstd": (None, ["zstd"], {}),
+    "zarr chunk tiles, bitshuffle+zstd": (None, ["bitshuffle", "zstd"], {}),
+    "zarr chunk tiles, delta+zstd": (
+        None,
+        ["zstd"],
+        {"tumor": ["delta", "zstd"]},
+    ),
+    "1024x1024 tiles, bitshuffle+zstd": ((1024, 1024), ["bitshuffle", "zstd"], {}),
+}
+
+
+def synthetic_prediction(size, rng):
+    noise = rng.random((size // 32, size // 32)).astype(np.float32)
+    prediction = cv2.resize(noise, (size, size), interpolation=cv2.INTER_CUBIC)
+    return np.clip(prediction, 0, 1)
+
+
+def synthetic_group(path, size, chunk, seed, gleason=False, empty_below=0):
+    rng = np.random.default_rng(seed)
+    group = zarr.open_group(path, mode="w")
+    group.attrs["resolution"] = [size * 16, size * 16]
+    group.attrs["filename"] = "synthetic.mrxs"
+    if gleason:
+        arrays = {
+            "gleason_{0}".format(i): synthetic_prediction(size, rng) for i in range(3)
+        }
+    else:
+        prediction = synthetic_prediction(size, rng)
+        prediction[prediction < empty_below] = 0
+        arrays = {
+            "tissue": (prediction * 100).astype(np.uint8),
+            "tumor": prediction,
+        }
+    for name, data in arrays.items():
+        array = group.array(name, data, chunks=(chunk, chunk))
+        array.attrs["dzi_sampling_level"] = 9
+        array.attrs["tile_size"] = 256
+
+
+def disk_size(path):
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, files in os.walk(path)
+        for name in files
+    )
+
+
+def read_latency(path, window, reads, seed):
+    rng = np.random.default_rng(seed)
+    elapsed = []
+    with tiledb.open(path) as dataset:
+        masks = [
+            TileDBMask(dataset, dataset.schema.attr(i).name)
+            for i in range(dataset.schema.nattr)
+        ]
+        shape = np.array(dataset.schema.shape)
+        for row, column in (rng.random((reads, 2)) * (shape - window)).astype(int):
+            start = time.perf_counter()
+            for mask in masks:
+                mask[row : row + window, column : column + window]
+            elapsed.append(time.perf_counter() - start)
+    return np.median(elapsed)
+
+
+def compare_array_types(label, zarr_path, workdir, args):
+    for array_type, filters in itertools.product(("dense", "sparse"), ("", "zstd")):
+        out_folder = os.path.join(workdir, "out")
+        converter = ZarrToTileDBConverter(
+            logging.getLogger(),
+            filters=[f for f in [filters] if f],
+            array_type=array_type,
+        )
+        density = converter._measure_density(zarr.open(zarr_path, mode="r"))
+        start = time.perf_counter()
+        tiledb_path = converter.run(zarr_path, out_folder)
+        write_time = time.perf_counter() - start
+        latency = read_latency(tiledb_path, args.window, args.reads, 1)
+        print(
+            ROW.format(
+                "{0} {1} {2}".format(label[-22:], array_type, filters),
+                "{0:.2f}".format(write_time),
+                "{0:.1f}".format(disk_size(tiledb_path) / 2**20),
+                "{0:.2f}".format(latency * 1000),
+                "{0:.3f}".format(density),
+            )
+        )
+        shutil.rmtree(out_folder)
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--size", type=int, default=4096, help="array size")
+    parser.add_argument("--chunk", type=int, default=512, help="zarr chunk size")
+    parser.add_argument("--window", type=int, default=256, help="read window size")
+    parser.add_argument("--reads", type=int, default=200, help="random reads")
+    parser.add_argument(
+        "--workers",
+        type=lambda v: [int(w) for w in v.split(",")],
+        default=[1, 2, 4],
+        help="comma separated worker counts (default=1,2,4)",
+    )
+    parser.add_argument(
+        "--dataset",
+        type=str,
+        action="append",
+        default=[],
+        help="zarr group to include in the dense/sparse comparison",
+    )
+    return parser
+
+
+def main(argv=None):
+    args = make_parser().parse_args(argv)
+    workdir = tempfile.mkdtemp()
+    try:
+        zarr_path = os.path.join(workdir, "pred.zarr")
+        synthetic_group(zarr_path, args.size, args.chunk, seed=0)
+        print(
+            ROW.format("configuration", "write s", "size MB", "read ms", "x zarr size")
+        )
+        zarr_size = disk_size(zarr_path)
+        for label, (tile_size, filters, attribute_filters) in CONFIGURATIONS.items():
+            out_folder = os.path.join(workdir, "out")
+            converter = ZarrToTileDBConverter(
+                logging.getLogger(),
+                tile_size=tile_size,
+                filters=filters,
+                attribute_filters=attribute_filters,
+            )
+            start = time.perf_counter()
+            converter.run(zarr_path, out_folder)
+            write_time = time.perf_counter() - start
+            tiledb_path = os.path.join(out_folder, "pred.zarr.tiledb")
+            size = disk_size(tiledb_path)
+            latency = read_latency(tiledb_path, args.window, args.reads, 1)
+            print(
+                ROW.format(
+                    label,
+                    "{0:.2f}".format(write_time),
+                    "{0:.1f}".format(size / 2**20),
+                    "{0:.2f}".format(latency * 1000),
+                    "{0:.2f}".format(size / zarr_size),
+                )
+            )
+            shutil.rmtree(out_folder)
+
+        gleason_path = os.path.join(workdir, "gleason.zarr")
+        synthetic_group(gleason_path, args.size, args.chunk, seed=0, gleason=True)
+        print()
+        print(ROW.format("gleason workers", "write s", "speedup", "", ""))
+        baseline = None
+        for workers in args.workers:
+            out_folder = os.path.join(workdir, "out")
+            converter = ZarrToTileDBConverter(
+                logging.getLogger(), filters=["zstd"], workers=workers
+            )
+            start = time.perf_counter()
+            converter.run(gleason_path, out_folder)
+            write_time = time.perf_counter() - start
+            baseline = baseline or write_time
+            print(
+                ROW.format(
+                    workers,
+                    "{0:.2f}".format(write_time),
+                    "{0:.2f}".format(baseline / write_time),
+                    "",
+                    "",
+                )
+            )
+            shutil.rmtree(out_folder)
+
+        sparse_path = os.path.join(workdir, "sparse.zarr")
+        synthetic_group(sparse_path, args.size, args.chunk, seed=0, empty_below=0.9)
+        print()
+        print(ROW.format("array type", "write s", "size MB", "read ms", "density"))
+        compare_array_types("synthetic", sparse_path, workdir, args)
+        for path in args.dataset:
+            compare_array_types(os.path.normpath(path), path, workdir, args)
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
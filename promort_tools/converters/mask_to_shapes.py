@@ -16,59 +16,214 @@
 #  COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
 #  IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 #  CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+from __future__ import annotations
+
 import abc
 import argparse
+import contextlib
 import json
 import logging
+import multiprocessing
+import os
 import sys
-from math import log, sqrt
-from typing import Callable, Dict, List, Tuple
-
-import cv2
-import numpy as np
-import zarr
-from shapely.affinity import scale as shapely_scale
-from shapely.geometry import Polygon
+import time
+from array import array
+from collections import OrderedDict
+from math import ceil, log, sqrt
+from typing import Dict, Iterable, List, NamedTuple, TextIO, Tuple
 
+from promort_tools.converters.shapes_io import save_shapes_zarr
+from promort_tools.libs.utils.lazy_import import lazy_import
 from promort_tools.libs.utils.logger import LOG_LEVELS, get_logger
 
+cv2 = lazy_import("cv2")
+np = lazy_import("numpy")
+pyclipper = lazy_import("pyclipper")
+shapely_affinity = lazy_import("shapely.affinity")
+shapely_geometry = lazy_import("shapely.geometry")
+tiledb = lazy_import("tiledb")
+zarr = lazy_import("zarr")
+
 LOGGER = logging.getLogger()
 
+OUTPUT_EXTENSIONS = {"json": ".json", "zarr": ".shapes.zarr"}
+
+COORDS = Tuple[float, float]
+
 
 def convert_to_shapes(
     mask: np.ndarray,
     original_resolution: Tuple[int, int],
     threshold: int,
     scaler: "Scaler",
+    in_place: bool = False,
+    min_area: float = 0.02,
+    min_vertices: int = 3,
+    lazy: bool = False,
 ):
-    def _apply_threshold(mask: np.ndarray, threshold: int) -> np.ndarray:
-        mask[mask < threshold] = 0
-        mask[mask >= threshold] = 1
+    """
+    Extracts the shapes of the regions of mask >= threshold. If in_place is
+    True and mask is an uint8 array, it is overwritten by the thresholded
+    mask instead of allocating a new one. Contours smaller than min_area
+    percent of the mask area or with less than min_vertices vertices are
+    discarded. If lazy is True, "shapes" is a generator building the shape
+    dicts one at a time (see write_json).
+    """
 
-    def _get_cores(mask):
+    def _get_contours(mask):
         contours, _ = cv2.findContours(
             mask, mode=cv2.RETR_EXTERNAL, method=cv2.CHAIN_APPROX_SIMPLE
         )
-        LOGGER.debug("contours %s", contours)
-        contours = filter(None, [_contour_to_shape(c) for c in contours])
         return contours
 
-    def _contour_to_shape(contour):
-        normalize_contour = []
-        for x in contour:
-            normalize_contour.append(tuple(x[0]))
-        try:
-            return Shape(normalize_contour, scaler)
-        except ValueError:
-            return None
+    binary_mask = apply_threshold(mask, threshold, in_place=in_place)
+    return _contours_to_slide_json(
+        _get_contours(binary_mask),
+        mask.shape,
+        original_resolution,
+        scaler,
+        min_area,
+        min_vertices,
+        lazy,
+    )
+
+
+def convert_to_shapes_chunked(
+    mask: "zarr.Array",
+    original_resolution: Tuple[int, int],
+    threshold: int,
+    scaler: "Scaler",
+    chunk_rows: int = None,
+    min_area: float = 0.02,
+    min_vertices: int = 3,
+    lazy: bool = False,
+):
+    """
+    Same as convert_to_shapes, but the mask is read and thresholded in
+    bands of chunk_rows rows (default: the zarr chunk height), so that it
+    never needs to be fully loaded in memory. The returned dict is the same
+    one convert_to_shapes would produce on the whole mask.
+    """
+    if chunk_rows is None:
+        chunk_rows = getattr(mask, "chunks", mask.shape)[0]
+    contours = ChunkedContourFinder(mask, threshold, chunk_rows).find_contours()
+    return _contours_to_slide_json(
+        contours, mask.shape, original_resolution, scaler, min_area, min_vertices, lazy
+    )
 
-    def _filter_cores(cores, slide_area, core_min_area=0.02):
-        accepted_cores = []
-        for core in cores:
-            if (core.get_area() * 100 / slide_area) >= core_min_area:
-                accepted_cores.append(core)
-        return accepted_cores
 
+def convert_to_shapes_sweep(
+    mask: np.ndarray,
+    original_resolution: Tuple[int, int],
+    thresholds: List[float],
+    scaler: "Scaler",
+    streaming: bool = False,
+    chunk_rows: int = None,
+    min_area: float = 0.02,
+    min_vertices: int = 3,
+    lazy: bool = False,
+) -> Dict:
+    """
+    Extracts the shapes for several thresholds reading the mask once.
+    Returns a dict mapping each threshold to the result of
+    convert_to_shapes (or convert_to_shapes_chunked if streaming is True).
+
+    In memory, thresholds are processed in increasing order and, since
+    the regions over a threshold are contained in the ones over a lower
+    threshold, each threshold is only searched inside the external
+    contours found for the previous one. In streaming mode every band is
+    read once and fed to a ChunkedContourFinder per threshold.
+    """
+    thresholds = sorted(set(thresholds))
+    if streaming:
+        if chunk_rows is None:
+            chunk_rows = getattr(mask, "chunks", mask.shape)[0]
+        finders = [ChunkedContourFinder(mask, t, chunk_rows) for t in thresholds]
+        for start in range(0, mask.shape[0], chunk_rows):
+            band = np.asarray(mask[start : start + chunk_rows])
+            for finder in finders:
+                finder.add_band(band, start)
+        contours = [finder.collect_contours() for finder in finders]
+    else:
+        contours = []
+        for threshold in thresholds:
+            if contours:
+                contours.append(find_nested_contours(mask, threshold, contours[-1]))
+            else:
+                binary_mask = apply_threshold(mask, threshold)
+                contours.append(
+                    cv2.findContours(
+                        binary_mask,
+                        mode=cv2.RETR_EXTERNAL,
+                        method=cv2.CHAIN_APPROX_SIMPLE,
+                    )[0]
+                )
+                del binary_mask
+    return {
+        t: _contours_to_slide_json(
+            c, mask.shape, original_resolution, scaler, min_area, min_vertices, lazy
+        )
+        for t, c in zip(thresholds, contours)
+    }
+
+
+def find_nested_contours(
+    mask: np.ndarray, threshold: float, outer_contours: List[np.ndarray]
+) -> List[np.ndarray]:
+    """
+    Returns the external contours of mask >= threshold, given the external
+    contours outer_contours of the mask thresholded at a lower value. Only
+    the areas enclosed by outer_contours are thresholded and searched.
+    """
+    contours = []
+    for outer in outer_contours:
+        left, top, width, height = cv2.boundingRect(outer)
+        window = apply_threshold(
+            mask[top : top + height, left : left + width], threshold
+        )
+        region = np.zeros_like(window)
+        cv2.drawContours(
+            region, [outer], 0, 1, thickness=cv2.FILLED, offset=(-left, -top)
+        )
+        np.bitwise_and(window, region, out=window)
+        contours.extend(
+            cv2.findContours(
+                window,
+                mode=cv2.RETR_EXTERNAL,
+                method=cv2.CHAIN_APPROX_SIMPLE,
+                offset=(left, top),
+            )[0]
+        )
+    # same order as cv2.findContours, reverse raster order of starting pixel
+    contours.sort(key=lambda c: (c[0][0][1], c[0][0][0]), reverse=True)
+    return contours
+
+
+def apply_threshold(
+    mask: np.ndarray,
+    threshold: float,
+    out: np.ndarray = None,
+    in_place: bool = False,
+) -> np.ndarray:
+    """
+    Returns an uint8 array set to 1 where mask >= threshold and to 0
+    elsewhere, computed in a single pass. Works with uint8 masks
+    (round_to_0_100) as well as with float probability masks. The result
+    is written into out if given, into mask itself if in_place is True and
+    mask is a writeable uint8 array, otherwise into a new array.
+    """
+    if out is None:
+        if in_place and mask.dtype == np.uint8 and mask.flags.writeable:
+            out = mask
+        else:
+            out = np.empty(mask.shape, dtype=np.uint8)
+    np.greater_equal(mask, threshold, out=out)
+    return out
+
+
+def _contours_to_slide_json(
+    contours, mask_shape, original_resolution, scaler, min_area, min_vertices, lazy
+):
     def _get_scale_factor(slide_resolution, mask_resolution):
         scale_factor = sqrt(
             (slide_resolution[0] * slide_resolution[1])
@@ -77,30 +232,383 @@ def convert_to_shapes(
         LOGGER.info("Scale factor is %r", scale_factor)
         return scale_factor
 
-    def _build_slide_json(cores, scale_factor):
-        scale_factor = log(scale_factor, 2)
-        slide_shapes = [
-            {
-                "coordinates": c.get_coordinates(scale_factor),
-                "length": c.get_length(scale_factor),
-                "area": c.get_area(scale_factor),
+    def _iter_shapes(scaled):
+        for index in range(len(scaled.offsets) - 1):
+            start, stop = scaled.offsets[index], scaled.offsets[index + 1]
+            yield {
+                "coordinates": [
+                    tuple(p) for p in scaled.coordinates[start:stop].tolist()
+                ],
+                "length": float(scaled.lengths[index]),
+                "area": float(scaled.areas[index]),
             }
-            for c in cores
-        ]
-        return {"shapes": slide_shapes}
 
-    _apply_threshold(mask, threshold)
+    def _build_slide_json(points, offsets, scale_factor):
+        scale_factor = pow(2, log(scale_factor, 2))
+        scaled = scaler.scale_shapes(points, offsets, scale_factor)
+        slide_shapes = _iter_shapes(scaled)
+        return {"shapes": slide_shapes if lazy else list(slide_shapes)}
 
-    cores = _filter_cores(_get_cores(mask), mask.size)
+    LOGGER.debug("contours %s", contours)
+    contours = filter_contours(
+        contours, mask_shape[0] * mask_shape[1], min_area, min_vertices
+    )
+    points, offsets = pack_contours(contours)
     #  grouped_cores = self._group_nearest_cores(cores, mask.shape[0])
-    scale_factor = _get_scale_factor(original_resolution, mask.shape)
-    return _build_slide_json(cores, scale_factor)
+    scale_factor = _get_scale_factor(original_resolution, mask_shape)
+    return _build_slide_json(points, offsets, scale_factor)
+
+
+def filter_contours(
+    contours: List[np.ndarray],
+    slide_area: int,
+    core_min_area: float = 0.02,
+    min_vertices: int = 3,
+) -> List[np.ndarray]:
+    """
+    Drops the raw cv2 contours with less than min_vertices vertices or
+    whose area is less than core_min_area percent of slide_area.
+    """
+    min_vertices = max(min_vertices, 3)
+    accepted_contours = [
+        c
+        for c in contours
+        if len(c) >= min_vertices
+        and (cv2.contourArea(c) * 100 / slide_area) >= core_min_area
+    ]
+    LOGGER.info("%d contours out of %d accepted", len(accepted_contours), len(contours))
+    return accepted_contours
+
+
+def pack_contours(contours: List[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Packs cv2 contours in a single (N, 2) array of closed rings. offsets has
+    one item more than the number of shapes: the points of shape i are
+    points[offsets[i]:offsets[i + 1]]. Contours with less than 3 points,
+    that are not valid polygons, are discarded.
+    """
+    contours = [c.reshape(-1, 2) for c in contours if len(c) >= 3]
+    if not contours:
+        return np.empty((0, 2), dtype=np.int64), np.zeros(1, dtype=np.int64)
+    counts = np.array([len(c) for c in contours])
+    points = np.concatenate(contours).astype(np.int64)
+    ends = np.cumsum(counts)
+    starts = ends - counts
+    # close the rings, as shapely does
+    open_rings = np.any(points[starts] != points[ends - 1], axis=1)
+    points = np.insert(points, ends[open_rings], points[starts[open_rings]], axis=0)
+    offsets = np.concatenate([[0], np.cumsum(counts + open_rings)])
+    return points, offsets
+
+
+def polygon_areas(points: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    """Areas of the packed closed rings, computed with the shoelace formula."""
+    if len(offsets) < 2:
+        return np.empty(0)
+    x, y = points[:, 0], points[:, 1]
+    cross = np.zeros(len(points), dtype=np.result_type(points, np.float64))
+    cross[:-1] = x[:-1] * y[1:] - x[1:] * y[:-1]
+    # the last point of a ring is not joined to the first one of the next
+    cross[offsets[1:] - 1] = 0
+    return np.abs(np.add.reduceat(cross, offsets[:-1])) / 2
+
+
+class ChunkedContourFinder:
+    """
+    Extracts the external contours of a thresholded mask reading it in
+    bands of rows. Every band is labelled on its own (8-connectivity for the
+    foreground, 4-connectivity for the background, as cv2.findContours
+    does) and labels touching across band borders are merged. A component
+    is external if the background pixel on the left of its first pixel (in
+    raster order) is connected to the image frame. The outer border of a
+    component spanning several bands is followed through the mask as
+    cv2.findContours does, keeping at most TRACE_BANDS thresholded bands in
+    memory, so memory is bounded by the band size whatever the size of the
+    components.
+
+    Contours are returned in the same order as cv2.findContours, i.e.
+    sorted by starting pixel in reverse raster order.
+    """
+
+    # moves of the border following, as numbered by cv2.findContours
+    DIRECTIONS = ((1, 0), (1, -1), (0, -1), (-1, -1), (-1, 0), (-1, 1), (0, 1), (1, 1))
+    TRACE_BANDS = 3
+
+    def __init__(self, mask, threshold, chunk_rows: int):
+        if chunk_rows < 1:
+            raise ValueError(f"invalid chunk_rows {chunk_rows}")
+        self.mask = mask
+        self.threshold = threshold
+        self.chunk_rows = chunk_rows
+        self._fg = _DisjointSet()
+        self._bg = _DisjointSet()
+        self._bg_on_frame = []
+        self._first_pixel = []
+        self._left_bg = []
+        self._contours = {}
+        self._last_rows = None
+        self._buffer = np.empty((chunk_rows, mask.shape[1]), dtype=np.uint8)
+        self._trace_bands = OrderedDict()
+
+    def find_contours(self) -> List[np.ndarray]:
+        for start in range(0, self.mask.shape[0], self.chunk_rows):
+            self.add_band(self.mask[start : start + self.chunk_rows], start)
+        return self.collect_contours()
+
+    def add_band(self, data: np.ndarray, start: int):
+        """
+        Processes the rows of the mask starting at start. Bands must be added
+        in order and must be at most chunk_rows high.
+        """
+        stop = start + data.shape[0]
+        LOGGER.debug("processing rows %s-%s", start, stop)
+        band = apply_threshold(data, self.threshold, out=self._buffer[: stop - start])
+        fg_labels, bg_labels = self._process_band(
+            band, start, is_first=start == 0, is_last=stop == self.mask.shape[0]
+        )
+        if self._last_rows is not None:
+            self._merge_rows(*self._last_rows, fg_labels[0], bg_labels[0])
+        self._last_rows = fg_labels[-1].copy(), bg_labels[-1].copy()
+
+    def _process_band(self, band, row_offset, is_first, is_last):
+        n_fg, fg_labels = cv2.connectedComponents(
+            band, connectivity=8, ltype=cv2.CV_32S
+        )
+        n_bg, bg_labels = cv2.connectedComponents(
+            1 - band, connectivity=4, ltype=cv2.CV_32S
+        )
+        # label 0 is the complement in both labellings, global ids are
+        # shifted so that -1 marks the complement
+        fg_offset = self._fg.add(n_fg - 1)
+        bg_offset = self._bg.add(n_bg - 1)
+        for labels, offset in ((fg_labels, fg_offset), (bg_labels, bg_offset)):
+            labels -= 1
+            np.add(labels, offset, out=labels, where=labels >= 0)
+
+        bg_on_frame = np.zeros(n_bg - 1, dtype=bool)
+        frame = [bg_labels[:, 0], bg_labels[:, -1]]
+        if is_first:
+            frame.append(bg_labels[0])
+        if is_last:
+            frame.append(bg_labels[-1])
+        frame = np.concatenate(frame)
+        bg_on_frame[frame[frame >= 0] - bg_offset] = True
+        self._bg_on_frame.extend(bg_on_frame)
+
+        first_pixel = [None] * (n_fg - 1)
+        left_bg = [None] * (n_fg - 1)
+        contours, hierarchy = cv2.findContours(
+            band,
+            mode=cv2.RETR_CCOMP,
+            method=cv2.CHAIN_APPROX_SIMPLE,
+            offset=(0, row_offset),
+        )
+        for contour, (_, _, _, parent) in zip(
+            contours, hierarchy[0] if hierarchy is not None else []
+        ):
+            if parent >= 0:  # hole
+                continue
+            x, y = contour[0][0]
+            gid = fg_labels[y - row_offset, x]
+            first_pixel[gid - fg_offset] = (y, x)
+            left_bg[gid - fg_offset] = bg_labels[y - row_offset, x - 1] if x else -1
+            self._contours[gid] = contour
+        self._first_pixel.extend(first_pixel)
+        self._left_bg.extend(left_bg)
+        return fg_labels, bg_labels
+
+    def _merge_rows(self, fg_above, bg_above, fg_below, bg_below):
+        pairs = []
+        for shift in (-1, 0, 1):
+            above = fg_above[max(0, shift) : len(fg_above) + min(0, shift)]
+            below = fg_below[max(0, -shift) : len(fg_below) + min(0, -shift)]
+            connected = (above >= 0) & (below >= 0)
+            pairs.append(np.stack([above[connected], below[connected]], axis=1))
+        for a, b in np.unique(np.concatenate(pairs), axis=0):
+            self._fg.union(a, b)
+
+        connected = (bg_above >= 0) & (bg_below >= 0)
+        for a, b in np.unique(
+            np.stack([bg_above[connected], bg_below[connected]], axis=1), axis=0
+        ):
+            self._bg.union(a, b)
+
+    def collect_contours(self) -> List[np.ndarray]:
+        fg_roots = self._fg.roots()
+        bg_roots = self._bg.roots()
+        bg_on_frame = np.zeros(len(bg_roots), dtype=bool)
+        np.logical_or.at(bg_on_frame, bg_roots, self._bg_on_frame)
+
+        components = {}
+        for gid, root in enumerate(fg_roots):
+            components.setdefault(root, []).append(gid)
+
+        contours = []
+        for parts in components.values():
+            first = min(parts, key=lambda gid: self._first_pixel[gid])
+            left_bg = self._left_bg[first]
+            if left_bg >= 0 and not bg_on_frame[bg_roots[left_bg]]:
+                continue  # nested in a hole of another component
+            contour = self._contours[first] if len(parts) == 1 else None
+            contours.append((self._first_pixel[first], contour))
+        # traced from top to bottom, so that consecutive components mostly
+        # read the same bands
+        contours.sort(key=lambda c: c[0])
+        contours = [
+            (first_pixel, self._trace_component(first_pixel) if c is None else c)
+            for first_pixel, c in contours
+        ]
+        self._trace_bands.clear()
+        contours.sort(key=lambda c: c[0], reverse=True)
+        return [c for _, c in contours]
+
+    def _read_trace_band(self, index: int) -> bytes:
+        bands = self._trace_bands
+        if index in bands:
+            bands.move_to_end(index)
+            return bands[index]
+        start = index * self.chunk_rows
+        data = self.mask[start : start + self.chunk_rows]
+        band = apply_threshold(
+            data, self.threshold, out=self._buffer[: data.shape[0]]
+        ).tobytes()
+        bands[index] = band
+        if len(bands) > self.TRACE_BANDS:
+            bands.popitem(last=False)
+        return band
+
+    def _trace_component(self, first_pixel: Tuple[int, int]) -> np.ndarray:
+        """
+        Follows the outer border of the component whose first pixel in
+        raster order is first_pixel, with the same moves and the same
+        CHAIN_APPROX_SIMPLE points of cv2.findContours.
+        """
+        height, width = self.mask.shape
+        chunk_rows = self.chunk_rows
+        directions = self.DIRECTIONS
+        current = [-1, b""]
+
+        def is_set(x, y):
+            if x < 0 or y < 0 or x >= width or y >= height:
+                return False
+            index = y // chunk_rows
+            if index != current[0]:
+                current[:] = index, self._read_trace_band(index)
+            return current[1][(y - index * chunk_rows) * width + x] != 0
+
+        y0, x0 = first_pixel
+        LOGGER.debug("tracing component starting at %s", (y0, x0))
+        # first neighbour clockwise from the left one, which is background
+        s = 4
+        while True:
+            s = (s - 1) & 7
+            if s == 4 or is_set(x0 + directions[s][0], y0 + directions[s][1]):
+                break
+        if s == 4:  # single pixel
+            return np.array([[[x0, y0]]], dtype=np.int32)
+        x1, y1 = x0 + directions[s][0], y0 + directions[s][1]
+        x3, y3 = x0, y0
+        previous = s ^ 4
+        points = array("i")
+        while True:
+            # next neighbour counterclockwise from the previous pixel
+            for s in range(s + 1, s + 9):
+                dx, dy = directions[s & 7]
+                x4, y4 = x3 + dx, y3 + dy
+                if is_set(x4, y4):
+                    break
+            s &= 7
+            if s != previous:
+                points.extend((x3, y3))
+                previous = s
+            if x4 == x0 and y4 == y0 and x3 == x1 and y3 == y1:
+                break
+            x3, y3 = x4, y4
+            s = (s + 4) & 7
+        return np.frombuffer(points, dtype=np.int32).reshape(-1, 1, 2)
+
+
+class _DisjointSet:
+    def __init__(self):
+        self._parent = np.empty(0, dtype=np.int64)
+
+    def __len__(self):
+        return len(self._parent)
+
+    def add(self, n: int) -> int:
+        start = len(self._parent)
+        self._parent = np.concatenate(
+            [self._parent, np.arange(start, start + n, dtype=np.int64)]
+        )
+        return start
+
+    def find(self, x: int) -> int:
+        parent = self._parent
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    def union(self, a: int, b: int):
+        a, b = self.find(a), self.find(b)
+        if a != b:
+            self._parent[max(a, b)] = min(a, b)
+
+    def roots(self) -> np.ndarray:
+        parent = self._parent
+        while True:
+            grand_parent = parent[parent]
+            if np.array_equal(grand_parent, parent):
+                return parent
+            parent = grand_parent
+
+
+def add_pyramid(
+    shapes: Dict, original_resolution: Tuple[int, int], tolerance: float = 1.0
+) -> Dict:
+    """
+    Adds to every shape of a convert_to_shapes result a "pyramid" dict,
+    mapping each DZI level of the slide to the shape coordinates simplified
+    with a tolerance of tolerance pixels of that level. Coordinates are
+    still expressed at full resolution; levels at which the shape is
+    smaller than a pixel are omitted. Lazy results stay lazy.
+    """
+    max_level = ceil(log(max(original_resolution), 2))
+
+    def _add_pyramid(shape):
+        shape["pyramid"] = build_pyramid(shape["coordinates"], max_level, tolerance)
+        return shape
+
+    if isinstance(shapes["shapes"], list):
+        for shape in shapes["shapes"]:
+            _add_pyramid(shape)
+    else:
+        shapes["shapes"] = map(_add_pyramid, shapes["shapes"])
+    return shapes
+
+
+def build_pyramid(
+    coordinates: List[COORDS], max_level: int, tolerance: float = 1.0
+) -> Dict[str, List[COORDS]]:
+    polygon = shapely_geometry.Polygon(coordinates)
+    x_min, y_min, x_max, y_max = polygon.bounds
+    size = max(x_max - x_min, y_max - y_min)
+    pyramid = {}
+    for level in range(max_level, -1, -1):
+        pixel_size = pow(2, max_level - level)
+        if size < pixel_size:
+            break
+        simplified = polygon.simplify(tolerance * pixel_size, preserve_topology=False)
+        if simplified.is_empty or simplified.geom_type != "Polygon":
+            break
+        pyramid[str(level)] = list(simplified.exterior.coords)
+    return pyramid
 
 
 class Shape:
     def __init__(self, segments, scaler: "Scaler"):
         self._scaler = scaler
-        self.polygon = Polygon(segments)
+        self.polygon = shapely_geometry.Polygon(segments)
 
     def __str__(self):
         return str(self.polygon)
@@ -166,7 +674,11 @@ class Shape:
         return mask
 
 
-COORDS = Tuple[float, float]
+class ScaledShapes(NamedTuple):
+    coordinates: np.ndarray
+    offsets: np.ndarray
+    areas: np.ndarray
+    lengths: np.ndarray
 
 
 class Scaler(abc.ABC):
@@ -182,10 +694,38 @@ class Scaler(abc.ABC):
     def get_length(self, shape: Shape, factor: float) -> float:
         ...
 
+    def scale_shapes(
+        self, points: np.ndarray, offsets: np.ndarray, factor: float
+    ) -> ScaledShapes:
+        """
+        Scales all the shapes packed by pack_contours at once. Subclasses
+        should override it with a vectorized implementation, this one
+        falls back to the per-shape methods.
+        """
+        coordinates, areas, lengths = [], [], []
+        for start, stop in zip(offsets[:-1], offsets[1:]):
+            shape = Shape(points[start:stop].tolist(), self)
+            coordinates.append(np.array(self.get_coordinates(shape, factor)))
+            areas.append(self.get_area(shape, factor))
+            lengths.append(self.get_length(shape, factor))
+        return ScaledShapes(
+            np.concatenate(coordinates) if coordinates else np.empty((0, 2)),
+            np.concatenate([[0], np.cumsum([len(c) for c in coordinates])]).astype(
+                np.int64
+            ),
+            np.array(areas),
+            np.array(lengths),
+        )
+
 
 class BasicScaler(Scaler):
-    def __init__(self, bounding_box: Tuple[int, int]):
+    """Scales pixel centers: (x + 0.5) * factor."""
+
+    def __init__(
+        self, bounding_box: Tuple[int, int], original_resolution: Tuple[int, int] = None
+    ):
         self.bounding_box = np.array(bounding_box)
+        self.original_resolution = original_resolution
 
     def get_coordinates(self, shape: Shape, factor: float) -> List[COORDS]:
         return list(self._scale(shape.polygon, factor).exterior.coords)
@@ -195,54 +735,405 @@ class BasicScaler(Scaler):
 
     def get_length(self, shape: Shape, factor: float) -> float:
         polygon = self._scale(shape.polygon, factor)
-        polygon_path = np.array(polygon.exterior.coords[:])
-        _, radius = cv2.minEnclosingCircle(polygon_path.astype(int))
-        return radius * 2
+        return _enclosing_circle_length(np.array(polygon.exterior.coords[:]))
+
+    def scale_shapes(
+        self, points: np.ndarray, offsets: np.ndarray, factor: float
+    ) -> ScaledShapes:
+        scaled_points = self._scale_points(points, factor)
+        lengths = np.array(
+            [
+                _enclosing_circle_length(path)
+                for path in np.split(scaled_points, offsets[1:-1])
+            ]
+            if len(offsets) > 1
+            else []
+        )
+        return ScaledShapes(
+            scaled_points, offsets, polygon_areas(scaled_points, offsets), lengths
+        )
 
     def _scale(self, polygon, factor):
         points = np.array(list(polygon.exterior.coords))
+        return shapely_geometry.Polygon(self._scale_points(points, factor))
+
+    def _scale_points(self, points, factor):
         points = points + 0.5
         norm_points = points / self.bounding_box
         denorm_scaled_points = norm_points * self.bounding_box * factor
+        return denorm_scaled_points
+
+
+class ShapelyScaler(Scaler):
+    """Same mapping as BasicScaler, computed by shapely.affinity on each shape."""
+
+    def __init__(
+        self, bounding_box: Tuple[int, int], original_resolution: Tuple[int, int] = None
+    ):
+        self.bounding_box = np.array(bounding_box)
+        self.original_resolution = original_resolution
+
+    def get_coordinates(self, shape: Shape, factor: float) -> List[COORDS]:
+        return list(self._scale(shape.polygon, factor).exterior.coords)
+
+    def get_area(self, shape: Shape, factor: float) -> float:
+        return self._scale(shape.polygon, factor).area
+
+    def get_length(self, shape: Shape, factor: float) -> float:
+        polygon = self._scale(shape.polygon, factor)
+        return _enclosing_circle_length(np.array(polygon.exterior.coords[:]))
+
+    def scale_shapes(
+        self, points: np.ndarray, offsets: np.ndarray, factor: float
+    ) -> ScaledShapes:
+        polygons = [
+            self._scale(shapely_geometry.Polygon(points[start:stop]), factor)
+            for start, stop in zip(offsets[:-1], offsets[1:])
+        ]
+        coordinates = [np.array(p.exterior.coords) for p in polygons]
+        return ScaledShapes(
+            np.concatenate(coordinates) if coordinates else np.empty((0, 2)),
+            np.concatenate([[0], np.cumsum([len(c) for c in coordinates])]).astype(
+                np.int64
+            ),
+            np.array([p.area for p in polygons]),
+            np.array([_enclosing_circle_length(c) for c in coordinates]),
+        )
+
+    def _scale(self, polygon, factor):
+        return shapely_affinity.scale(
+            shapely_affinity.translate(polygon, 0.5, 0.5),
+            xfact=factor,
+            yfact=factor,
+            origin=(0, 0),
+        )
+
+
+class FitScaler(BasicScaler):
+    """
+    Scales the two axes independently, so that the mask fits exactly the
+    original resolution (width, height) of the slide even when the mask
+    was not downsampled by the same factor along x and y. factor is the
+    isotropic scale factor, as for the other scalers.
+    """
+
+    def __init__(
+        self, bounding_box: Tuple[int, int], original_resolution: Tuple[int, int] = None
+    ):
+        if original_resolution is None:
+            raise ValueError("FitScaler requires the original resolution")
+        super().__init__(bounding_box, original_resolution)
+        axis_factors = np.array(original_resolution, dtype=np.float64) / np.array(
+            [bounding_box[1], bounding_box[0]]
+        )
+        self.aspect = axis_factors / sqrt(axis_factors[0] * axis_factors[1])
+
+    def _scale_points(self, points, factor):
+        return (points + 0.5) * (self.aspect * factor)
 
-        return Polygon(denorm_scaled_points)
+
+class PyclipperScaler(BasicScaler):
+    """
+    Grows every shape by half a pixel with a pyclipper offset before
+    scaling it. Contours pass through the centers of the border pixels,
+    the grown polygons follow the outer edges of the pixels instead, so
+    that their area matches the pixel area of the region.
+    """
+
+    PRECISION = 1 << 8
+
+    def scale_shapes(
+        self, points: np.ndarray, offsets: np.ndarray, factor: float
+    ) -> ScaledShapes:
+        grown = [
+            self._grow(points[start:stop])
+            for start, stop in zip(offsets[:-1], offsets[1:])
+        ]
+        grown_offsets = np.concatenate([[0], np.cumsum([len(g) for g in grown])])
+        return super().scale_shapes(
+            np.concatenate(grown) if grown else np.empty((0, 2)),
+            grown_offsets.astype(np.int64),
+            factor,
+        )
+
+    def _scale(self, polygon, factor):
+        points = self._grow(np.array(list(polygon.exterior.coords)))
+        return shapely_geometry.Polygon(self._scale_points(points, factor))
+
+    def _grow(self, points: np.ndarray) -> np.ndarray:
+        path = (np.asarray(points) * self.PRECISION).round().astype(np.int64).tolist()
+        paths = []
+        # degenerate (zero area) contours are grown as lines
+        for end_type in (pyclipper.ET_CLOSEDPOLYGON, pyclipper.ET_CLOSEDLINE):
+            offset = pyclipper.PyclipperOffset()
+            offset.AddPath(path, pyclipper.JT_MITER, end_type)
+            paths = offset.Execute(0.5 * self.PRECISION)
+            if paths:
+                break
+        if not paths:
+            return np.asarray(points, dtype=np.float64)
+        grown = max(paths, key=lambda p: abs(pyclipper.Area(p)))
+        grown.append(grown[0])
+        return np.array(grown, dtype=np.float64) / self.PRECISION
+
+
+SCALERS = {
+    "basic": BasicScaler,
+    "shapely": ShapelyScaler,
+    "fit": FitScaler,
+    "pyclipper": PyclipperScaler,
+}
+
+
+def get_scaler(
+    name: str, bounding_box: Tuple[int, int], original_resolution: Tuple[int, int]
+) -> Scaler:
+    return SCALERS[name](bounding_box, original_resolution)
+
+
+def _enclosing_circle_length(points: np.ndarray) -> float:
+    _, radius = cv2.minEnclosingCircle(points.astype(np.int32))
+    return radius * 2
 
 
 def main(argv):
+    if argv and argv[0] == "batch":
+        return batch_main(argv[1:])
     parser = _make_parser()
     args = parser.parse_args(argv)
+    if args.format != "json" and args.out_file is None:
+        parser.error(f"an output file is required with the {args.format} format")
 
     global LOGGER
     LOGGER = get_logger(args.log_level, args.log_file)
 
-    mask, original_resolution, round_to_0_100 = _read_group(args.mask)
-    threshold = round(args.threshold * 100) if round_to_0_100 else args.threshold
+    _convert_group(args.mask, args.out_file, args)
 
-    scaler = BasicScaler(mask.shape)
-    shapes = convert_to_shapes(mask, original_resolution, threshold, scaler)
 
-    _save_shapes(shapes, args.out_file)
+def batch_main(argv):
+    parser = _make_batch_parser()
+    args = parser.parse_args(argv)
 
+    global LOGGER
+    LOGGER = get_logger(args.log_level, args.log_file)
+
+    groups = _list_groups(args.inputs)
+    LOGGER.info("Converting %d datasets with %d processes", len(groups), args.processes)
+    os.makedirs(args.out_folder, exist_ok=True)
+    jobs = [
+        (group, _get_output_path(group, args.out_folder, args.format), args)
+        for group in groups
+    ]
+    start = time.perf_counter()
+    # TileDB is not fork safe, and listing the inputs may have initialised it
+    pool = multiprocessing.get_context("spawn").Pool(
+        args.processes, _init_batch_worker, (args,)
+    )
+    with pool:
+        results = list(pool.imap_unordered(_convert_group_job, jobs))
+    failures = [r for r in results if r["status"] != "OK"]
+    report = {
+        "datasets": len(results),
+        "failed": len(failures),
+        "elapsed": time.perf_counter() - start,
+        "results": sorted(results, key=lambda r: r["input"]),
+    }
+    report_path = args.report or os.path.join(args.out_folder, "report.json")
+    with open(report_path, "w") as ofile:
+        json.dump(report, ofile, indent=2)
+    LOGGER.info("Report written to %s", report_path)
+    if failures:
+        LOGGER.error("%d conversions failed", len(failures))
+        sys.exit(f"{len(failures)} conversions failed")
+
+
+def _convert_group(path: str, out_file: str, args: argparse.Namespace) -> int:
+    with contextlib.ExitStack() as stack:
+        if args.streaming:
+            mask, original_resolution, round_to_0_100 = _open_group(path, args.array)
+            # closed once the shapes, which read it while written, are saved
+            if isinstance(mask, TileDBMask):
+                stack.enter_context(mask)
+        else:
+            mask, original_resolution, round_to_0_100 = _read_group(path, args.array)
+        # mask threshold: first option giving it, duplicates are converted once
+        thresholds = {}
+        for t in args.threshold:
+            thresholds.setdefault(round(t * 100) if round_to_0_100 else t, t)
+        # json is written while shapes are generated, zarr needs them all
+        lazy = args.format == "json"
 
-def _get_scale_func(func_name: str) -> Callable:
-    return globals()[f"{func_name}_scale"]
+        scaler = get_scaler(args.scale_func, mask.shape, original_resolution)
+        if len(thresholds) > 1:
+            sweep = convert_to_shapes_sweep(
+                mask,
+                original_resolution,
+                list(thresholds),
+                scaler,
+                args.streaming,
+                args.chunk_rows,
+                min_area=args.min_area,
+                min_vertices=args.min_vertices,
+                lazy=lazy,
+            )
+            shapes = {"thresholds": {str(t): sweep[th] for th, t in thresholds.items()}}
+        elif args.streaming:
+            shapes = convert_to_shapes_chunked(
+                mask,
+                original_resolution,
+                next(iter(thresholds)),
+                scaler,
+                args.chunk_rows,
+                min_area=args.min_area,
+                min_vertices=args.min_vertices,
+                lazy=lazy,
+            )
+        else:
+            shapes = convert_to_shapes(
+                mask,
+                original_resolution,
+                next(iter(thresholds)),
+                scaler,
+                in_place=True,
+                min_area=args.min_area,
+                min_vertices=args.min_vertices,
+                lazy=lazy,
+            )
+        del mask
+
+        if args.pyramid:
+            for doc in shapes.get("thresholds", {"": shapes}).values():
+                add_pyramid(doc, original_resolution, args.pyramid_tolerance)
+
+        if args.format == "zarr":
+            save_shapes_zarr(shapes, out_file)
+            return _count_shapes(shapes)
+        return _save_shapes(shapes, out_file)
+
+
+def _init_batch_worker(args: argparse.Namespace):
+    global LOGGER
+    LOGGER = get_logger(args.log_level, args.log_file)
+
+
+def _convert_group_job(job: Tuple) -> Dict:
+    path, out_file = job[:2]
+    result = {"input": path, "output": out_file}
+    start = time.perf_counter()
+    try:
+        shapes_count = _convert_group(*job)
+    except Exception as ex:
+        LOGGER.error("Conversion of %s failed: %s", path, ex)
+        result.update(status="ERROR", error=str(ex))
+    else:
+        LOGGER.info("Converted %s", path)
+        result.update(status="OK", shapes=shapes_count)
+    result["elapsed"] = time.perf_counter() - start
+    return result
+
+
+def _count_shapes(shapes: Dict) -> int:
+    if "thresholds" in shapes:
+        return sum(len(s["shapes"]) for s in shapes["thresholds"].values())
+    return len(shapes["shapes"])
+
+
+def _list_groups(inputs: str) -> List[str]:
+    if os.path.isdir(inputs):
+        return sorted(
+            os.path.join(inputs, d)
+            for d in os.listdir(inputs)
+            if _is_zarr_group(os.path.join(inputs, d))
+            or tiledb.object_type(os.path.join(inputs, d)) == "array"
+        )
+    base_dir = os.path.dirname(inputs)
+    with open(inputs) as manifest:
+        return [
+            os.path.join(base_dir, line.strip())
+            for line in manifest
+            if line.strip() and not line.startswith("#")
+        ]
+
+
+def _get_output_path(group: str, out_folder: str, output_format: str) -> str:
+    return os.path.join(
+        out_folder,
+        "{0}{1}".format(
+            os.path.basename(os.path.normpath(group)), OUTPUT_EXTENSIONS[output_format]
+        ),
+    )
 
 
 def _make_parser():
-    parser = argparse.ArgumentParser()
+    parser = argparse.ArgumentParser(
+        epilog='use "%(prog)s batch -h" for converting many datasets at once'
+    )
     parser.add_argument("mask", type=str, help="path to the dataset to be converted")
     parser.add_argument(
         "-o",
         dest="out_file",
         type=str,
-        help="output file json for the serialized ROIs. Default: STDOUT",
+        help="output file for the serialized ROIs. Default: STDOUT (json only)",
+    )
+    _add_conversion_arguments(parser)
+    return parser
+
+
+def _make_batch_parser():
+    parser = argparse.ArgumentParser(
+        prog="mask_to_shapes.py batch",
+        description="convert many datasets using a pool of processes",
+    )
+    parser.add_argument(
+        "inputs",
+        type=str,
+        help="folder containing the datasets to be converted or manifest file "
+        "listing one dataset path per line",
+    )
+    parser.add_argument(
+        "-o",
+        dest="out_folder",
+        type=str,
+        required=True,
+        help="output folder, an output file is written for each dataset",
     )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=os.cpu_count(),
+        help="number of worker processes (default=number of CPUs)",
+    )
+    parser.add_argument(
+        "--report",
+        type=str,
+        default=None,
+        help="summary report file (default=OUT_FOLDER/report.json)",
+    )
+    _add_conversion_arguments(parser)
+    return parser
+
+
+def _float_list(value: str) -> List[float]:
+    return [float(v) for v in value.split(",")]
+
+
+def _positive_int(value: str) -> int:
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"expected a positive integer, got {value}")
+    return number
+
+
+def _add_conversion_arguments(parser):
     parser.add_argument(
         "-t",
         dest="threshold",
-        type=float,
+        type=_float_list,
+        action="extend",
         required=True,
-        help="threshold for generating the ROI. Float in range [0, 1].",
+        help="threshold for generating the ROI. Float in range [0, 1]. A comma "
+        "separated list (or a repeated -t) converts the mask at every threshold "
+        "and the output maps each threshold to its shapes.",
     )
     parser.add_argument(
         "--log-level",
@@ -254,36 +1145,210 @@ def _make_parser():
     parser.add_argument(
         "--log-file", type=str, default=None, help="log file (default=stderr)"
     )
+    parser.add_argument(
+        "--min-area",
+        type=float,
+        default=0.02,
+        help="minimum area of a shape, as percentage of the mask area (default=0.02)",
+    )
+    parser.add_argument(
+        "--min-vertices",
+        type=int,
+        default=3,
+        help="minimum number of vertices of a shape (default=3)",
+    )
+    parser.add_argument(
+        "--format",
+        type=str,
+        choices=tuple(OUTPUT_EXTENSIONS),
+        default="json",
+        help="output format: json or zarr, storing packed coordinate arrays "
+        "(default=json)",
+    )
+    parser.add_argument(
+        "--pyramid",
+        action="store_true",
+        help="add to every shape its coordinates simplified for each DZI level",
+    )
+    parser.add_argument(
+        "--pyramid-tolerance",
+        type=float,
+        default=1.0,
+        help="simplification tolerance, in pixels of each DZI level (default=1.0)",
+    )
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        help="read the mask chunk by chunk instead of loading it in memory",
+    )
+    parser.add_argument(
+        "--chunk-rows",
+        type=_positive_int,
+        default=None,
+        help="rows read at once in streaming mode (default=zarr chunk height)",
+    )
 
-    scale_funcs = ("shapely", "fit", "pyclipper")
+    parser.add_argument(
+        "--array",
+        type=str,
+        default=None,
+        help="zarr array or TileDB attribute holding the mask (default=the first one)",
+    )
     parser.add_argument(
         "--scale-func",
         dest="scale_func",
         type=str,
-        choices=scale_funcs,
-        default=scale_funcs[0],
-        help="log file (default=stderr)",
+        choices=tuple(SCALERS),
+        default="basic",
+        help="method used to scale the shapes to the slide resolution "
+        "(default=basic)",
     )
-    return parser
 
 
-def _read_group(path: str) -> Tuple[np.ndarray, Tuple[int, int, bool]]:
-    group = zarr.open(path)
+class TileDBMask:
+    """
+    Read-only view of an attribute of a TileDB array, as written by
+    zarr_to_tiledb, that can replace a zarr array as mask: it is sliced
+    like a zarr array and every slice is read as a TileDB subarray. chunks
+    are the TileDB tile extents. Cells missing from sparse arrays are 0.
+    """
+
+    def __init__(self, array: "tiledb.DenseArray", attribute: str):
+        self.array = array
+        self.attribute = attribute
+        self.shape = array.schema.shape
+        self.dtype = array.schema.attr(attribute).dtype
+        self.chunks = tuple(
+            int(array.schema.domain.dim(i).tile) for i in range(array.schema.ndim)
+        )
+
+    def __getitem__(self, key) -> np.ndarray:
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (len(self.shape) - len(key))
+        # slices are clipped to the array domain, as zarr does
+        subarray = tuple(
+            slice(*k.indices(size)[:2]) for k, size in zip(key, self.shape)
+        )
+        if any(s.start >= s.stop for s in subarray):
+            return np.empty([max(s.stop - s.start, 0) for s in subarray], self.dtype)
+        result = self.array.query(attrs=[self.attribute])[subarray]
+        if not self.array.schema.sparse:
+            return result[self.attribute]
+        # cells missing from sparse arrays are zeros
+        data = np.zeros([s.stop - s.start for s in subarray], self.dtype)
+        dims = [self.array.schema.domain.dim(i).name for i in range(len(subarray))]
+        coords = tuple(
+            result[d].astype(np.int64) - s.start for d, s in zip(dims, subarray)
+        )
+        data[coords] = result[self.attribute]
+        return data
+
+    def __array__(self, dtype=None, copy=None) -> np.ndarray:
+        data = self[:]
+        return data if dtype is None else data.astype(dtype)
+
+    def close(self):
+        self.array.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _read_group(
+    path: str, name: str = None
+) -> Tuple[np.ndarray, Tuple[int, int, bool]]:
+    mask, resolution, round_to_0_100 = _open_group(path, name)
+    if isinstance(mask, TileDBMask):
+        with mask:
+            return np.array(mask), resolution, round_to_0_100
+    return np.array(mask), resolution, round_to_0_100
+
+
+def _is_zarr_group(path: str) -> bool:
+    return os.path.isfile(os.path.join(path, ".zgroup"))
+
+
+def _open_group(
+    path: str, name: str = None
+) -> Tuple["zarr.Array", Tuple[int, int, bool]]:
+    """
+    Opens the mask of a zarr group or of a TileDB array, which must be
+    closed once read.
+    """
+    if not _is_zarr_group(path) and tiledb.object_type(path) == "array":
+        return _open_tiledb_array(path, name)
+    group = zarr.open(path, mode="r")
     # retrieving the first array
-    key = list(group.array_keys())[0]
+    key = name or list(group.array_keys())[0]
     mask = group[key]
     round_to_0_100 = mask.attrs["round_to_0_100"]
-    mask = np.array(mask)
     resolution = group.attrs["resolution"]
     return mask, resolution, round_to_0_100
 
 
-def _save_shapes(shapes: Dict, output_path: str):
+def _open_tiledb_array(
+    path: str, name: str = None
+) -> Tuple[TileDBMask, Tuple[int, int, bool]]:
+    array = tiledb.open(path)
+    try:
+        attribute = name or array.schema.attr(0).name
+        mask = TileDBMask(array, attribute)
+        key = f"{attribute}.round_to_0_100"
+        if key in array.meta:
+            round_to_0_100 = bool(array.meta[key])
+        else:
+            # written before zarr_to_tiledb kept the attribute, 0-100 masks are uint8
+            round_to_0_100 = np.issubdtype(mask.dtype, np.integer)
+        resolution = [array.meta["original_width"], array.meta["original_height"]]
+    except Exception:
+        array.close()
+        raise
+    return mask, resolution, round_to_0_100
+
+
+def _save_shapes(shapes: Dict, output_path: str) -> int:
     if output_path is None:
-        print(json.dumps(shapes))
+        count = write_json(shapes, sys.stdout)
+        sys.stdout.write("\n")
+        sys.stdout.flush()
     else:
         with open(output_path, "w") as ofile:
-            json.dump(shapes, ofile)
+            count = write_json(shapes, ofile)
+    return count
+
+
+def write_json(obj, ofile: TextIO) -> int:
+    """
+    Writes obj as json.dump would, but iterables other than lists found in
+    it (e.g. lazy lists of shapes) are written item by item as they are
+    consumed, so that the whole document is never held in memory. Returns
+    the number of items written from such iterables.
+    """
+    count = 0
+    if isinstance(obj, dict):
+        ofile.write("{")
+        for index, (key, value) in enumerate(obj.items()):
+            if index:
+                ofile.write(", ")
+            ofile.write(json.dumps(str(key)))
+            ofile.write(": ")
+            count += write_json(value, ofile)
+        ofile.write("}")
+    elif isinstance(obj, Iterable) and not isinstance(obj, (str, list, tuple)):
+        ofile.write("[")
+        for index, item in enumerate(obj):
+            if index:
+                ofile.write(", ")
+            ofile.write(json.dumps(item))
+            count += 1
+        ofile.write("]")
+    else:
+        ofile.write(json.dumps(obj))
+    return count
 
 
 class InvalidPolygonError(Exception):
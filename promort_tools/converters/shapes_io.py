@@ -0,0 +1,172 @@
+#  Copyright (c) 2021, CRS4
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy of
+#  this software and associated documentation files (the "Software"), to deal in
+#  the Software without restriction, including without limitation the rights to
+#  use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+#  the Software, and to permit persons to whom the Software is furnished to do so,
+#  subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+#  FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+#  COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+#  IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+#  CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+from __future__ import annotations
+
+import json
+import os
+from typing import Dict, Iterator, List
+
+from promort_tools.libs.utils.lazy_import import lazy_import
+
+np = lazy_import("numpy")
+zarr = lazy_import("zarr")
+
+FORMAT_NAME = "promort_shapes"
+FORMAT_VERSION = 1
+COORDINATES_CHUNK = 1 << 20
+READ_BATCH = 1024
+
+
+def save_shapes_zarr(shapes: Dict, path: str, coordinates_dtype: str = "float32"):
+    """
+    Writes the result of mask_to_shapes as a zarr group of packed arrays:
+    coordinates (N, 2), offsets (the points of shape i are
+    coordinates[offsets[i]:offsets[i + 1]]), areas and lengths. Pyramids
+    are stored in pyramid/<level> groups, with a shape_ids array pointing
+    to the shapes that have the level. Multi-threshold documents get a
+    thresholds/<threshold> group for every threshold.
+    """
+    root = zarr.open_group(path, mode="w")
+    root.attrs.update(format=FORMAT_NAME, version=FORMAT_VERSION)
+    if "thresholds" in shapes:
+        root.attrs["thresholds"] = list(shapes["thresholds"])
+        for threshold, doc in shapes["thresholds"].items():
+            _write_shapes(
+                root.require_group(f"thresholds/{threshold}"),
+                doc["shapes"],
+                coordinates_dtype,
+            )
+    else:
+        _write_shapes(root, shapes["shapes"], coordinates_dtype)
+
+
+def load_shapes(path: str) -> Dict:
+    """
+    Loads a mask_to_shapes output, either json or zarr. The result has the
+    same structure of the json document, but with zarr the lists of shapes
+    are PackedShapes, which read the coordinates lazily.
+    """
+    if not os.path.isdir(path):
+        with open(path) as f_obj:
+            return json.load(f_obj)
+    root = zarr.open_group(path, mode="r")
+    if root.attrs.get("format") != FORMAT_NAME:
+        raise InvalidShapesFormatError(f"{path} is not a shapes dataset")
+    if "thresholds" in root.attrs:
+        return {
+            "thresholds": {
+                t: {"shapes": PackedShapes(root[f"thresholds/{t}"])}
+                for t in root.attrs["thresholds"]
+            }
+        }
+    return {"shapes": PackedShapes(root)}
+
+
+class PackedShapes:
+    """Read-only sequence of shape dicts backed by a zarr group."""
+
+    def __init__(self, group: zarr.Group):
+        self.coordinates = group["coordinates"]
+        self.offsets = group["offsets"][:]
+        self.areas = group["areas"][:]
+        self.lengths = group["lengths"][:]
+        self._pyramid = {}
+        if "pyramid" in group:
+            for level, level_group in group["pyramid"].groups():
+                self._pyramid[level] = (
+                    level_group["coordinates"],
+                    level_group["offsets"][:],
+                    level_group["shape_ids"][:],
+                )
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index: int) -> Dict:
+        if not -len(self) <= index < len(self):
+            raise IndexError(index)
+        index %= len(self)
+        start, stop = self.offsets[index], self.offsets[index + 1]
+        return self._build_shape(index, self.coordinates[start:stop])
+
+    def __iter__(self) -> Iterator[Dict]:
+        # coordinates are read in batches of shapes, not one shape at a time
+        for first in range(0, len(self), READ_BATCH):
+            last = min(first + READ_BATCH, len(self))
+            offsets = self.offsets[first : last + 1]
+            coordinates = self.coordinates[offsets[0] : offsets[-1]]
+            for index, shape_coordinates in enumerate(
+                np.split(coordinates, offsets[1:-1] - offsets[0]), first
+            ):
+                yield self._build_shape(index, shape_coordinates)
+
+    def get_coordinates(self, index: int) -> np.ndarray:
+        return self.coordinates[self.offsets[index] : self.offsets[index + 1]]
+
+    def to_json(self) -> Dict:
+        return {"shapes": list(self)}
+
+    def _build_shape(self, index: int, coordinates: np.ndarray) -> Dict:
+        shape = {
+            "coordinates": coordinates.tolist(),
+            "length": float(self.lengths[index]),
+            "area": float(self.areas[index]),
+        }
+        if self._pyramid:
+            shape["pyramid"] = {}
+            for level, (coords, offsets, shape_ids) in self._pyramid.items():
+                position = np.searchsorted(shape_ids, index)
+                if position < len(shape_ids) and shape_ids[position] == index:
+                    start, stop = offsets[position], offsets[position + 1]
+                    shape["pyramid"][level] = coords[start:stop].tolist()
+        return shape
+
+
+def _write_shapes(group: zarr.Group, shapes: List[Dict], coordinates_dtype: str):
+    _write_coordinates(group, [s["coordinates"] for s in shapes], coordinates_dtype)
+    group.array("areas", np.array([s["area"] for s in shapes], dtype=np.float64))
+    group.array("lengths", np.array([s["length"] for s in shapes], dtype=np.float64))
+    levels = {level for s in shapes for level in s.get("pyramid", {})}
+    for level in sorted(levels, key=int):
+        shape_ids = [i for i, s in enumerate(shapes) if level in s["pyramid"]]
+        level_group = group.require_group(f"pyramid/{level}")
+        _write_coordinates(
+            level_group,
+            [shapes[i]["pyramid"][level] for i in shape_ids],
+            coordinates_dtype,
+        )
+        level_group.array("shape_ids", np.array(shape_ids, dtype=np.int64))
+
+
+def _write_coordinates(
+    group: zarr.Group, coordinates: List[List], coordinates_dtype: str
+):
+    counts = [len(c) for c in coordinates]
+    offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    packed = np.empty((offsets[-1], 2), dtype=coordinates_dtype)
+    for c, start, stop in zip(coordinates, offsets[:-1], offsets[1:]):
+        packed[start:stop] = c
+    group.array(
+        "coordinates", packed, chunks=(min(max(len(packed), 1), COORDINATES_CHUNK), 2)
+    )
+    group.array("offsets", offsets)
+
+
+class InvalidShapesFormatError(Exception):
+    ...
@@ -17,19 +17,78 @@
 #  IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 #  CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
-import argparse, sys, os
-import zarr
-import tiledb
-import numpy as np
-from math import ceil
+import argparse, sys, os, glob, json, time
+import multiprocessing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from math import ceil, gcd
 
+from promort_tools.libs.utils.lazy_import import lazy_import
 from promort_tools.libs.utils.logger import get_logger, LOG_LEVELS
 
+zarr = lazy_import('zarr')
+tiledb = lazy_import('tiledb')
+np = lazy_import('numpy')
+
+DEFAULT_BUFFER_SIZE = 256  # MB
+LAYOUTS = ('row-major', 'col-major')
+# filters are given as NAME or NAME:LEVEL, LEVEL only applies to compressors; values are
+# tiledb filter classes
+FILTERS = {
+    'zstd': 'ZstdFilter',
+    'lz4': 'LZ4Filter',
+    'gzip': 'GzipFilter',
+    'bitshuffle': 'BitShuffleFilter',
+    'byteshuffle': 'ByteShuffleFilter',
+    'delta': 'DeltaFilter',
+    'double-delta': 'DoubleDeltaFilter'
+}
+DOMAIN_DTYPES = ('uint16', 'uint32', 'uint64')
+DEFAULT_WORKERS = os.cpu_count() or 1
+# metadata recording the progress of a conversion, removed once completed
+REGION_SIZE_KEY = 'conversion.region_size'
+REGIONS_DONE_KEY = 'conversion.regions_done'
+POOLING = ('max', 'mean')
+ARRAY_TYPES = ('dense', 'sparse', 'auto')
+DEFAULT_MAX_SPARSE_DENSITY = 0.1
+# states of the output of a conversion
+MISSING, INCOMPATIBLE, PARTIAL, COMPLETE = 'missing', 'incompatible', 'partial', 'complete'
+
 
 class ZarrToTileDBConverter(object):
 
-    def __init__(self, logger):
+    def __init__(self, logger, buffer_size=DEFAULT_BUFFER_SIZE, tile_size=None,
+                 cell_order='row-major', tile_order='row-major', filters=None,
+                 attribute_filters=None, workers=DEFAULT_WORKERS, ctx=None, consolidate=True,
+                 overview_levels=0, pooling='max', attribute_pooling=None, array_type='dense',
+                 sparse_threshold=0, max_sparse_density=DEFAULT_MAX_SPARSE_DENSITY):
         self.logger = logger
+        # max bytes of zarr data held in memory at once, for all the attributes
+        self.buffer_size = int(buffer_size * 1024 * 1024)
+        # (rows, columns) tile extents, None to use the zarr chunk shape
+        self.tile_size = tile_size
+        self.cell_order = cell_order
+        self.tile_order = tile_order
+        # filter pipeline for all the attributes, overridden by attribute_filters
+        # which maps attribute labels to their own pipeline
+        self.filters = filters or []
+        self.attribute_filters = attribute_filters or {}
+        # threads decoding zarr chunks, numcodecs releases the GIL
+        self.workers = workers
+        # TileDB context shared by all the conversions, None for the default one
+        self.ctx = ctx
+        # merge the fragments written for every region once the conversion is completed
+        self.consolidate = consolidate
+        # overviews halve the resolution at every level, pooling reduces 2x2 cells to one
+        # for all the attributes, unless overridden by attribute_pooling
+        self.overview_levels = overview_levels
+        self.pooling = pooling
+        self.attribute_pooling = attribute_pooling or {}
+        # sparse arrays only store cells where an attribute is > sparse_threshold, with
+        # array_type 'auto' they are used if the stored cells are at most max_sparse_density
+        self.array_type = array_type
+        self.sparse_threshold = sparse_threshold
+        self.max_sparse_density = max_sparse_density
 
     def _get_array_shape(self, zarr_dataset):
         shapes = set([arr[1].shape for arr in zarr_dataset.arrays()])
@@ -48,25 +107,272 @@ class ZarrToTileDBConverter(object):
             '{0}.tiledb'.format(os.path.basename(os.path.normpath(zarr_dataset)))
         )
 
-    def _init_tiledb_dataset(self, dataset_path, dataset_shape, zarr_attributes):
-        rows = tiledb.Dim(name='rows', domain=(0, dataset_shape[0]-1), tile=4, dtype=np.uint16)
-        columns = tiledb.Dim(name='columns', domain=(0, dataset_shape[1]-1), tile=4, dtype=np.uint16)
-        domain = tiledb.Domain(rows, columns)
+    def _get_tile_size(self, zarr_dataset, dataset_shape):
+        if self.tile_size:
+            tile_size = self.tile_size
+        else:
+            tile_size = [max(c) for c in zip(*[arr[1].chunks for arr in zarr_dataset.arrays()])]
+        # TileDB does not accept tiles larger than the domain
+        return tuple(min(t, s) for t, s in zip(tile_size, dataset_shape))
+
+    def _get_domain_dtype(self, dataset_shape):
+        for dtype in DOMAIN_DTYPES:
+            if max(dataset_shape) - 1 <= np.iinfo(dtype).max:
+                return np.dtype(dtype)
+
+    def _get_filters(self, label, dtype):
+        filters = list()
+        for f in self.attribute_filters.get(label, self.filters):
+            name, _, level = f.partition(':')
+            if name not in FILTERS:
+                self.logger.error('Unknown filter {0}'.format(name))
+                sys.exit('Unknown filter {0}'.format(name))
+            kwargs = dict()
+            if level:
+                kwargs['level'] = int(level)
+            if name in ('delta', 'double-delta') and np.dtype(dtype).kind == 'f':
+                # delta filters only accept integers, work on the float bits instead
+                kwargs['reinterp_dtype'] = np.dtype('i{0}'.format(np.dtype(dtype).itemsize))
+            filters.append(getattr(tiledb, FILTERS[name])(ctx=self.ctx, **kwargs))
+        return tiledb.FilterList(filters, ctx=self.ctx)
+
+    def _init_tiledb_dataset(self, dataset_path, dataset_shape, zarr_attributes, tile_size,
+                             sparse=False):
+        domain_dtype = self._get_domain_dtype(dataset_shape)
+        self.logger.debug('Tile size {0}, domain dtype {1}'.format(
+            tile_size, np.dtype(domain_dtype).name))
+        rows = tiledb.Dim(name='rows', domain=(0, dataset_shape[0]-1), tile=tile_size[0],
+                          dtype=domain_dtype, ctx=self.ctx)
+        columns = tiledb.Dim(name='columns', domain=(0, dataset_shape[1]-1), tile=tile_size[1],
+                             dtype=domain_dtype, ctx=self.ctx)
+        domain = tiledb.Domain(rows, columns, ctx=self.ctx)
         attributes = list()
         for a in zarr_attributes:
-            attributes.append(tiledb.Attr(a[0], dtype=a[1]))
-        schema = tiledb.ArraySchema(domain=domain, sparse=False, attrs=attributes)
-        tiledb.DenseArray.create(dataset_path, schema)
+            attributes.append(tiledb.Attr(a[0], dtype=a[1], filters=self._get_filters(*a),
+                                          ctx=self.ctx))
+        schema = tiledb.ArraySchema(domain=domain, sparse=sparse, attrs=attributes,
+                                    cell_order=self.cell_order, tile_order=self.tile_order,
+                                    ctx=self.ctx)
+        if sparse:
+            tiledb.SparseArray.create(dataset_path, schema, ctx=self.ctx)
+        else:
+            tiledb.DenseArray.create(dataset_path, schema, ctx=self.ctx)
+
+    def _get_stored_cells(self, region_data):
+        stored = None
+        for data in region_data.values():
+            above = data > self.sparse_threshold
+            stored = above if stored is None else stored | above
+        return stored
+
+    def _measure_density(self, zarr_dataset):
+        arrays = list(zarr_dataset.arrays())
+        dataset_shape = arrays[0][1].shape
+        cell_size = sum(arr_data.dtype.itemsize for _, arr_data in arrays)
+        region_size = self._get_region_size(
+            dataset_shape, self._get_alignment(zarr_dataset, [1, 1]), cell_size)
+        stored_cells = 0
+        with ThreadPoolExecutor(self.workers) as executor:
+            for rows, columns in self._get_regions(dataset_shape, region_size):
+                _, _, region_data, futures = self._read_region(executor, arrays, rows, columns)
+                for f in futures:
+                    f.result()
+                stored_cells += int(np.count_nonzero(self._get_stored_cells(region_data)))
+        return stored_cells / (dataset_shape[0] * dataset_shape[1])
+
+    def _use_sparse(self, zarr_dataset):
+        if self.array_type != 'auto':
+            return self.array_type == 'sparse'
+        density = self._measure_density(zarr_dataset)
+        sparse = density <= self.max_sparse_density
+        self.logger.info('Density {0:.3f}, writing a {1} array'.format(
+            density, 'sparse' if sparse else 'dense'))
+        return sparse
+
+    def _get_alignment(self, zarr_dataset, tile_size):
+        # regions are aligned both to TileDB tiles and to zarr chunks
+        alignment = list(tile_size)
+        for _, arr_data in zarr_dataset.arrays():
+            for i in range(2):
+                chunk = arr_data.chunks[i]
+                alignment[i] = alignment[i] * chunk // gcd(alignment[i], chunk)
+        return alignment
+
+    def _get_region_size(self, dataset_shape, alignment, cell_size):
+        # a region is read while the previous one is written, each gets half the buffer
+        buffer_size = self.buffer_size // 2
+        row_size = dataset_shape[1] * cell_size
+        if alignment[0] * row_size <= buffer_size:
+            columns = dataset_shape[1]
+            rows = max(alignment[0], buffer_size // row_size // alignment[0] * alignment[0])
+        else:
+            rows = alignment[0]
+            columns = max(
+                alignment[1],
+                buffer_size // (rows * cell_size) // alignment[1] * alignment[1]
+            )
+        return rows, columns
+
+    def _get_regions(self, dataset_shape, region_size):
+        rows, columns = region_size
+        for r in range(0, dataset_shape[0], rows):
+            for c in range(0, dataset_shape[1], columns):
+                yield (
+                    slice(r, min(r + rows, dataset_shape[0])),
+                    slice(c, min(c + columns, dataset_shape[1]))
+                )
+
+    def _read_block(self, arr_data, region_data, rows, columns, row_offset):
+        region_data[rows.start - row_offset:rows.stop - row_offset] = arr_data[rows, columns]
+
+    def _read_region(self, executor, arrays, rows, columns):
+        # every attribute is split in blocks of zarr chunk rows, decoded concurrently
+        region_shape = (rows.stop - rows.start, columns.stop - columns.start)
+        region_data = dict()
+        futures = list()
+        for arr_label, arr_data in arrays:
+            region_data[arr_label] = np.empty(region_shape, dtype=arr_data.dtype)
+            step = arr_data.chunks[0]
+            for r in range(rows.start, rows.stop, step):
+                futures.append(executor.submit(
+                    self._read_block, arr_data, region_data[arr_label],
+                    slice(r, min(r + step, rows.stop)), columns, rows.start
+                ))
+        return rows, columns, region_data, futures
+
+    def _write_region(self, tiledb_dataset_path, index, rows, columns, region_data, futures):
+        for f in futures:
+            f.result()
+        self.logger.debug('Writing region {0}:{1}, {2}:{3}'.format(
+            rows.start, rows.stop, columns.start, columns.stop))
+        # every region is a fragment, committed before the progress metadata
+        with tiledb.open(tiledb_dataset_path, 'w', ctx=self.ctx) as A:
+            if A.schema.sparse:
+                stored = self._get_stored_cells(region_data)
+                coords = np.nonzero(stored)
+                if len(coords[0]):
+                    domain_dtype = A.schema.domain.dim(0).dtype
+                    A[(coords[0] + rows.start).astype(domain_dtype),
+                      (coords[1] + columns.start).astype(domain_dtype)] = {
+                        label: data[stored] for label, data in region_data.items()
+                    }
+            else:
+                A[rows, columns] = region_data
+            A.meta[REGIONS_DONE_KEY] = index + 1
+
+    def _get_progress(self, tiledb_dataset_path, region_size):
+        with tiledb.open(tiledb_dataset_path, ctx=self.ctx) as A:
+            if REGION_SIZE_KEY in A.meta:
+                # regions of an interrupted conversion are kept, whatever the buffer size
+                regions_done = A.meta[REGIONS_DONE_KEY] if REGIONS_DONE_KEY in A.meta else 0
+                return tuple(A.meta[REGION_SIZE_KEY]), regions_done
+        with tiledb.open(tiledb_dataset_path, 'w', ctx=self.ctx) as A:
+            A.meta[REGION_SIZE_KEY] = tuple(region_size)
+        return region_size, 0
+
+    def _consolidate(self, tiledb_dataset_path):
+        self.logger.info('Consolidating {0}'.format(tiledb_dataset_path))
+        for mode in ('fragments', 'array_meta'):
+            # regions are disjoint, padding of the boundary tiles is the only amplification
+            config = tiledb.Config({
+                'sm.consolidation.mode': mode,
+                'sm.consolidation.amplification': 1000,
+                'sm.vacuum.mode': mode
+            })
+            tiledb.consolidate(tiledb_dataset_path, config=config, ctx=self.ctx)
+            tiledb.vacuum(tiledb_dataset_path, config=config, ctx=self.ctx)
+
+    def _get_overviews_path(self, tiledb_dataset_path):
+        return '{0}.overviews'.format(os.path.normpath(tiledb_dataset_path))
+
+    def _downsample(self, data, pooling):
+        # odd rows and columns are pooled with a copy of themselves
+        data = np.pad(data, [(0, s % 2) for s in data.shape], mode='edge')
+        blocks = data.reshape(data.shape[0] // 2, 2, data.shape[1] // 2, 2)
+        if pooling == 'max':
+            return blocks.max(axis=(1, 3))
+        pooled = blocks.mean(axis=(1, 3))
+        if np.issubdtype(data.dtype, np.integer):
+            pooled = np.rint(pooled)
+        return pooled.astype(data.dtype)
+
+    def _read_band(self, tiledb_array, start, stop, labels):
+        data = tiledb_array[start:stop]
+        if not tiledb_array.schema.sparse:
+            return data
+        # cells missing from sparse arrays are zeros
+        band = dict()
+        for label in labels:
+            band[label] = np.zeros((stop - start, tiledb_array.schema.shape[1]),
+                                   dtype=tiledb_array.schema.attr(label).dtype)
+            band[label][data['rows'] - start, data['columns']] = data[label]
+        return band
+
+    def _write_overview(self, source_path, overview_path, cell_size):
+        with tiledb.open(source_path, ctx=self.ctx) as S, \
+                tiledb.open(overview_path, 'w', ctx=self.ctx) as O:
+            rows, columns = S.schema.shape
+            labels = [S.schema.attr(i).name for i in range(S.schema.nattr)]
+            band = max(2, self.buffer_size // (columns * cell_size) // 2 * 2)
+            for r in range(0, rows, band):
+                data = self._read_band(S, r, min(r + band, rows), labels)
+                O[r // 2:(min(r + band, rows) + 1) // 2] = {
+                    label: self._downsample(
+                        data[label], self.attribute_pooling.get(label, self.pooling))
+                    for label in labels
+                }
+
+    def _build_overviews(self, tiledb_dataset_path, attributes, tiledb_meta):
+        overviews_path = self._get_overviews_path(tiledb_dataset_path)
+        if tiledb.object_type(overviews_path, ctx=self.ctx) is not None:
+            tiledb.remove(overviews_path, ctx=self.ctx)
+        tiledb.group_create(overviews_path, ctx=self.ctx)
+        schema = tiledb.ArraySchema.load(tiledb_dataset_path, ctx=self.ctx)
+        shape = schema.shape
+        tile_size = [int(schema.domain.dim(i).tile) for i in range(2)]
+        cell_size = sum(np.dtype(dtype).itemsize for _, dtype in attributes)
+        source_path = tiledb_dataset_path
+        level = 0
+        while level < self.overview_levels and max(shape) > 1:
+            level += 1
+            shape = tuple((s + 1) // 2 for s in shape)
+            overview_path = os.path.join(overviews_path, str(level))
+            self.logger.info('Writing overview level {0}, shape {1}'.format(level, shape))
+            self._init_tiledb_dataset(overview_path, shape, attributes,
+                                      [min(t, s) for t, s in zip(tile_size, shape)])
+            self._write_overview(source_path, overview_path, cell_size)
+            overview_meta = dict(tiledb_meta)
+            overview_meta.update({
+                'overview_level': level,
+                'downsample_factor': 2 ** level,
+                'base_dataset': os.path.basename(os.path.normpath(tiledb_dataset_path))
+            })
+            for label, _ in attributes:
+                overview_meta.update({
+                    '{0}.dzi_sampling_level'.format(label):
+                        tiledb_meta['{0}.dzi_sampling_level'.format(label)] - level,
+                    '{0}.rows'.format(label): shape[1],
+                    '{0}.columns'.format(label): shape[0],
+                    '{0}.pooling'.format(label): self.attribute_pooling.get(label, self.pooling)
+                })
+            with tiledb.open(overview_path, 'w', ctx=self.ctx) as O:
+                for k, v in overview_meta.items():
+                    O.meta[k] = v
+            if self.consolidate:
+                self._consolidate(overview_path)
+            source_path = overview_path
+        return {
+            'overview_levels': level,
+            'overviews': os.path.basename(overviews_path)
+        }
 
     def _zarr_to_tiledb(self, zarr_dataset, tiledb_dataset_path, slide_resolution):
-        tiledb_data = dict()
         tiledb_meta = {
             'original_width': slide_resolution[0],
             'original_height': slide_resolution[1],
             'slide_path': zarr_dataset.attrs['filename']
         }
         for arr_label, arr_data in zarr_dataset.arrays():
-            tiledb_data[arr_label] = arr_data[:]
             tiledb_meta.update(
                 {
                     '{0}.dzi_sampling_level'.format(arr_label): ceil(arr_data.attrs['dzi_sampling_level']),
@@ -75,13 +381,63 @@ class ZarrToTileDBConverter(object):
                     '{0}.columns'.format(arr_label): arr_data.shape[0]
                 }
             )
-        with tiledb.open(tiledb_dataset_path, 'w') as A:
-            A[:] = tiledb_data
+            if 'round_to_0_100' in arr_data.attrs:
+                tiledb_meta['{0}.round_to_0_100'.format(arr_label)] = \
+                    int(arr_data.attrs['round_to_0_100'])
+        arrays = list(zarr_dataset.arrays())
+        dataset_shape = arrays[0][1].shape
+        cell_size = sum(arr_data.dtype.itemsize for _, arr_data in arrays)
+        schema = tiledb.ArraySchema.load(tiledb_dataset_path, ctx=self.ctx)
+        if schema.sparse:
+            tiledb_meta['sparse_threshold'] = self.sparse_threshold
+        alignment = self._get_alignment(
+            zarr_dataset, [int(schema.domain.dim(i).tile) for i in range(2)])
+        region_size, regions_done = self._get_progress(
+            tiledb_dataset_path, self._get_region_size(dataset_shape, alignment, cell_size))
+        regions = list(self._get_regions(dataset_shape, region_size))
+        if regions_done:
+            self.logger.info('Resuming from region {0} of {1}'.format(regions_done, len(regions)))
+        with ThreadPoolExecutor(self.workers) as executor:
+            # the next region is decoded while the current one is written
+            pending = deque()
+            for index in range(regions_done, len(regions)):
+                pending.append((index,) + self._read_region(executor, arrays, *regions[index]))
+                if len(pending) > 1:
+                    self._write_region(tiledb_dataset_path, *pending.popleft())
+            while pending:
+                self._write_region(tiledb_dataset_path, *pending.popleft())
+        if self.overview_levels:
+            tiledb_meta.update(self._build_overviews(
+                tiledb_dataset_path, self._get_array_attributes(zarr_dataset), tiledb_meta))
+        with tiledb.open(tiledb_dataset_path, 'w', ctx=self.ctx) as A:
             for k, v in tiledb_meta.items():
                 A.meta[k] = v
+            del A.meta[REGION_SIZE_KEY]
+            del A.meta[REGIONS_DONE_KEY]
+        if self.consolidate:
+            self._consolidate(tiledb_dataset_path)
+
+    def _get_status(self, zarr_dataset, tiledb_dataset_path):
+        # metadata are written last, their presence marks a complete conversion
+        if tiledb.object_type(tiledb_dataset_path, ctx=self.ctx) != 'array':
+            return MISSING
+        try:
+            with tiledb.open(tiledb_dataset_path, ctx=self.ctx) as A:
+                attributes = set(A.schema.attr(i).name for i in range(A.schema.nattr))
+                if (attributes != set(label for label, _ in zarr_dataset.arrays()) or
+                        A.schema.shape != self._get_array_shape(zarr_dataset)):
+                    return INCOMPATIBLE
+                return COMPLETE if 'slide_path' in A.meta else PARTIAL
+        except tiledb.TileDBError as te:
+            self.logger.warning('Invalid TileDB dataset {0}: {1}'.format(tiledb_dataset_path, te))
+            return INCOMPATIBLE
+
+    def is_converted(self, zarr_dataset, out_folder):
+        tiledb_dataset_path = self._get_tiledb_path(zarr_dataset, out_folder)
+        return self._get_status(zarr.open(zarr_dataset, mode='r'), tiledb_dataset_path) == COMPLETE
 
-    def run(self, zarr_dataset, out_folder):
-        z = zarr.open(zarr_dataset)
+    def run(self, zarr_dataset, out_folder, overwrite=False):
+        z = zarr.open(zarr_dataset, mode='r')
         try:
             slide_res = z.attrs['resolution']
         except KeyError as ke:
@@ -90,29 +446,235 @@ class ZarrToTileDBConverter(object):
         dset_shape = self._get_array_shape(z)
         tiledb_dataset_path = self._get_tiledb_path(zarr_dataset, out_folder)
         self.logger.info('TileDB dataset path: {0}'.format(tiledb_dataset_path))
-        attributes = self._get_array_attributes(z)
-        self._init_tiledb_dataset(tiledb_dataset_path, dset_shape, attributes)
+        status = self._get_status(z, tiledb_dataset_path)
+        if status != MISSING and overwrite:
+            self.logger.info('Removing existing dataset {0}'.format(tiledb_dataset_path))
+            tiledb.remove(tiledb_dataset_path, ctx=self.ctx)
+            overviews_path = self._get_overviews_path(tiledb_dataset_path)
+            if tiledb.object_type(overviews_path, ctx=self.ctx) is not None:
+                tiledb.remove(overviews_path, ctx=self.ctx)
+            status = MISSING
+        if status == COMPLETE:
+            self.logger.info('Dataset already converted, nothing to do')
+            return tiledb_dataset_path
+        if status == INCOMPATIBLE:
+            self.logger.error('Existing dataset {0} does not match the zarr dataset'.format(
+                tiledb_dataset_path))
+            sys.exit('Existing dataset {0} does not match, use --overwrite'.format(
+                tiledb_dataset_path))
+        if status == MISSING:
+            attributes = self._get_array_attributes(z)
+            tile_size = self._get_tile_size(z, dset_shape)
+            self._init_tiledb_dataset(tiledb_dataset_path, dset_shape, attributes, tile_size,
+                                      self._use_sparse(z))
         self._zarr_to_tiledb(z, tiledb_dataset_path, slide_res)
+        return tiledb_dataset_path
+
+
+# converter of the current batch worker process, sharing a single TileDB context
+_CONVERTER = None
+
+
+def _init_batch_worker(args):
+    global _CONVERTER
+    _CONVERTER = _get_converter(args, get_logger(args.log_level, args.log_file))
+
+
+def _convert_dataset_job(job):
+    zarr_dataset, out_folder, overwrite = job
+    tiledb_dataset_path = _CONVERTER._get_tiledb_path(zarr_dataset, out_folder)
+    result = {'input': zarr_dataset, 'output': tiledb_dataset_path}
+    start = time.perf_counter()
+    try:
+        if not overwrite and _CONVERTER.is_converted(zarr_dataset, out_folder):
+            _CONVERTER.logger.info('Skipping {0}, already converted'.format(zarr_dataset))
+            result['status'] = 'SKIPPED'
+        else:
+            _CONVERTER.run(zarr_dataset, out_folder, overwrite)
+            result['status'] = 'OK'
+    except (Exception, SystemExit) as ex:
+        _CONVERTER.logger.error('Conversion of {0} failed: {1}'.format(zarr_dataset, ex))
+        result.update(status='ERROR', error=str(ex))
+    result['elapsed'] = time.perf_counter() - start
+    return result
+
+
+def _list_datasets(inputs):
+    if glob.has_magic(inputs):
+        return sorted(glob.glob(inputs))
+    if os.path.isdir(inputs):
+        return sorted(
+            os.path.join(inputs, d) for d in os.listdir(inputs)
+            if os.path.isfile(os.path.join(inputs, d, '.zgroup'))
+        )
+    base_dir = os.path.dirname(inputs)
+    with open(inputs) as manifest:
+        return [
+            os.path.join(base_dir, line.strip()) for line in manifest
+            if line.strip() and not line.startswith('#')
+        ]
+
+
+def _get_converter(args, logger):
+    ctx = tiledb.Ctx(dict(args.tiledb_config))
+    return ZarrToTileDBConverter(logger, args.buffer_size, args.tile_size, args.cell_order,
+                                 args.tile_order, args.filters, dict(args.attribute_filters),
+                                 args.workers, ctx, args.consolidate, args.overview_levels,
+                                 args.overview_pooling, dict(args.attribute_pooling),
+                                 args.array_type, args.sparse_threshold, args.max_sparse_density)
+
+
+def _attribute_pooling(value):
+    label, sep, pooling = value.partition('=')
+    if not sep or not label or pooling not in POOLING:
+        raise argparse.ArgumentTypeError(
+            'expected LABEL={0}, got {1}'.format('|'.join(POOLING), value))
+    return label, pooling
+
+
+def _config_parameter(value):
+    key, sep, parameter = value.partition('=')
+    if not sep or not key:
+        raise argparse.ArgumentTypeError('expected KEY=VALUE, got {0}'.format(value))
+    return key, parameter
+
+
+def _filter_list(value):
+    filters = [f for f in value.split(',') if f]
+    for f in filters:
+        if f.partition(':')[0] not in FILTERS:
+            raise argparse.ArgumentTypeError('unknown filter {0}'.format(f))
+    return filters
+
+
+def _attribute_filters(value):
+    label, sep, filters = value.partition('=')
+    if not sep or not label:
+        raise argparse.ArgumentTypeError('expected LABEL=FILTERS, got {0}'.format(value))
+    return label, _filter_list(filters)
 
 
 def make_parser():
-    parser = argparse.ArgumentParser()
+    parser = argparse.ArgumentParser(
+        epilog='use "%(prog)s batch -h" for converting many datasets at once'
+    )
     parser.add_argument('--zarr-dataset', type=str, required=True,
                         help='path to the ZARR dataset to be converted')
     parser.add_argument('--out-folder', type=str, required=True,
                         help='output folder for TileDB dataset')
+    _add_conversion_arguments(parser)
+    return parser
+
+
+def make_batch_parser():
+    parser = argparse.ArgumentParser(
+        prog='zarr_to_tiledb.py batch',
+        description='convert many datasets using a pool of processes, datasets already '
+                    'converted are skipped'
+    )
+    parser.add_argument('inputs', type=str,
+                        help='glob pattern matching the ZARR datasets, folder containing them '
+                             'or manifest file listing one dataset path per line')
+    parser.add_argument('--out-folder', type=str, required=True,
+                        help='output folder for TileDB datasets')
+    parser.add_argument('--processes', type=int, default=os.cpu_count(),
+                        help='number of worker processes (default=number of CPUs)')
+    parser.add_argument('--report', type=str, default=None,
+                        help='summary report file (default=OUT_FOLDER/report.json)')
+    _add_conversion_arguments(parser)
+    return parser
+
+
+def _add_conversion_arguments(parser):
+    parser.add_argument('--buffer-size', type=float, default=DEFAULT_BUFFER_SIZE,
+                        help='max MB of data read from zarr at once (default={0})'.format(
+                            DEFAULT_BUFFER_SIZE))
+    parser.add_argument('--tile-size', type=int, nargs=2, default=None,
+                        metavar=('ROWS', 'COLUMNS'),
+                        help='TileDB tile extents (default=zarr chunk shape)')
+    parser.add_argument('--cell-order', type=str, choices=LAYOUTS, default='row-major',
+                        help='TileDB cell order (default=row-major)')
+    parser.add_argument('--tile-order', type=str, choices=LAYOUTS, default='row-major',
+                        help='TileDB tile order (default=row-major)')
+    parser.add_argument('--filters', type=_filter_list, default=[],
+                        help='comma separated filter pipeline for all the attributes, filters are '
+                             '{0} with an optional :LEVEL, e.g. bitshuffle,zstd:5'.format(
+                                 ', '.join(FILTERS)))
+    parser.add_argument('--attribute-filters', type=_attribute_filters, action='append',
+                        default=[], metavar='LABEL=FILTERS',
+                        help='filter pipeline for a single attribute, e.g. tumor=delta,zstd')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                        help='threads reading zarr data (default={0})'.format(DEFAULT_WORKERS))
+    parser.add_argument('--array-type', type=str, choices=ARRAY_TYPES, default='dense',
+                        help='TileDB array type, auto writes a sparse array if the cells to be '
+                             'stored are at most --max-sparse-density (default=dense)')
+    parser.add_argument('--sparse-threshold', type=float, default=0,
+                        help='sparse arrays only store cells where an attribute is greater than '
+                             'this value, other cells read as 0 (default=0)')
+    parser.add_argument('--max-sparse-density', type=float, default=DEFAULT_MAX_SPARSE_DENSITY,
+                        help='max fraction of stored cells for a sparse array with '
+                             '--array-type auto (default={0})'.format(DEFAULT_MAX_SPARSE_DENSITY))
+    parser.add_argument('--overview-levels', type=int, default=0,
+                        help='number of overview levels, each one halving the resolution of the '
+                             'previous one, written as arrays of the TileDB group '
+                             'DATASET.tiledb.overviews (default=0)')
+    parser.add_argument('--overview-pooling', type=str, choices=POOLING, default='max',
+                        help='pooling of the overview cells for all the attributes (default=max)')
+    parser.add_argument('--attribute-pooling', type=_attribute_pooling, action='append',
+                        default=[], metavar='LABEL=POOLING',
+                        help='pooling of the overview cells of a single attribute, e.g. '
+                             'tumor=mean')
+    parser.add_argument('--overwrite', action='store_true',
+                        help='remove existing TileDB datasets instead of resuming their '
+                             'conversion or skipping them')
+    parser.add_argument('--no-consolidate', dest='consolidate', action='store_false',
+                        help='keep a fragment per written region')
+    parser.add_argument('--tiledb-config', type=_config_parameter, action='append',
+                        default=[], metavar='KEY=VALUE',
+                        help='TileDB configuration parameter, e.g. sm.compute_concurrency_level=4')
     parser.add_argument('--log-level', type=str, choices=LOG_LEVELS,
                         default='INFO', help='log level (default=INFO)')
     parser.add_argument('--log-file', type=str, default=None, help='log file (default=stderr)')
-    return parser
 
 
 def main(argv=None):
+    if argv and argv[0] == 'batch':
+        return batch_main(argv[1:])
     parser = make_parser()
     args = parser.parse_args(argv)
     logger = get_logger(args.log_level, args.log_file)
-    app = ZarrToTileDBConverter(logger)
-    app.run(args.zarr_dataset, args.out_folder)
+    app = _get_converter(args, logger)
+    app.run(args.zarr_dataset, args.out_folder, args.overwrite)
+
+
+def batch_main(argv):
+    parser = make_batch_parser()
+    args = parser.parse_args(argv)
+    logger = get_logger(args.log_level, args.log_file)
+    datasets = _list_datasets(args.inputs)
+    logger.info('Converting {0} datasets with {1} processes'.format(len(datasets), args.processes))
+    os.makedirs(args.out_folder, exist_ok=True)
+    jobs = [(d, args.out_folder, args.overwrite) for d in datasets]
+    start = time.perf_counter()
+    # TileDB is not fork safe, every worker creates its own context
+    pool = multiprocessing.get_context('spawn').Pool(args.processes, _init_batch_worker, (args,))
+    with pool:
+        results = list(pool.imap_unordered(_convert_dataset_job, jobs))
+    failures = [r for r in results if r['status'] == 'ERROR']
+    report = {
+        'datasets': len(results),
+        'skipped': len([r for r in results if r['status'] == 'SKIPPED']),
+        'failed': len(failures),
+        'elapsed': time.perf_counter() - start,
+        'results': sorted(results, key=lambda r: r['input'])
+    }
+    report_path = args.report or os.path.join(args.out_folder, 'report.json')
+    with open(report_path, 'w') as ofile:
+        json.dump(report, ofile, indent=2)
+    logger.info('Report written to {0}'.format(report_path))
+    if failures:
+        logger.error('{0} conversions failed'.format(len(failures)))
+        sys.exit('{0} conversions failed'.format(len(failures)))
 
 
 if __name__ == '__main__':
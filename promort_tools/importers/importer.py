@@ -20,23 +20,36 @@
 import argparse, sys
 from importlib import import_module
 
+from promort_tools.libs.client.client import (DEFAULT_TIMEOUT, DEFAULT_RETRIES,
+                                               DEFAULT_BACKOFF_FACTOR, DEFAULT_POOL_SIZE)
+from promort_tools.libs.client.session_cache import DEFAULT_SESSION_CACHE
 from promort_tools.libs.utils.logger import get_logger, LOG_LEVELS
 
-SUBMODULES_NAMES = [
-    'slides_importer', 'predictions_importer', 'tissue_fragments_importer'
+# (subcommand, help) of every submodule; a submodule is imported, and registers its
+# arguments and implementation, only when its subcommand is run
+SUBCOMMANDS = [
+    ('slides_importer', 'import a slide, or the slides listed in a manifest'),
+    ('predictions_importer', 'import a prediction of a slide'),
+    ('tissue_fragments_importer', 'import the tissue fragments of a prediction'),
 ]
 
-SUBMODULES = [
-    import_module('%s.%s' % ('promort_tools.importers', n))
-    for n in SUBMODULES_NAMES
-]
+
+class _LazySubParsersAction(argparse._SubParsersAction):
+    def __call__(self, parser, namespace, values, option_string=None):
+        subparser = self._name_parser_map.get(values[0])
+        if subparser is not None and subparser.get_default('func') is None:
+            module = import_module('%s.%s' % ('promort_tools.importers', values[0]))
+            registered = []
+            module.register(registered)
+            _, _, addp, impl = registered[0]
+            addp(subparser)
+            subparser.set_defaults(func=impl)
+        super(_LazySubParsersAction, self).__call__(parser, namespace, values, option_string)
 
 
 class ProMortImporter(object):
     def __init__(self):
-        self.supported_modules = []
-        for m in SUBMODULES:
-            m.register(self.supported_modules)
+        self.supported_modules = SUBCOMMANDS
 
     def make_parser(self):
         parser = argparse.ArgumentParser(description='ProMort data importer')
@@ -65,11 +78,45 @@ class ProMortImporter(object):
                             type=str,
                             default=None,
                             help='log file (default=stderr)')
-        subparsers = parser.add_subparsers()
-        for k, h, addp, impl in self.supported_modules:
-            subparser = subparsers.add_parser(k, help=h)
-            addp(subparser)
-            subparser.set_defaults(func=impl)
+        parser.add_argument('--timeout',
+                            type=float,
+                            default=DEFAULT_TIMEOUT,
+                            help='seconds to wait for a ProMort response (default=%(default)s)')
+        parser.add_argument('--retries',
+                            type=int,
+                            default=DEFAULT_RETRIES,
+                            help='retries on connection errors, timeouts and 5xx responses '
+                                 '(default=%(default)s)')
+        parser.add_argument('--backoff',
+                            dest='backoff_factor',
+                            type=float,
+                            default=DEFAULT_BACKOFF_FACTOR,
+                            help='base delay in seconds of the randomized exponential backoff '
+                                 'between retries (default=%(default)s)')
+        parser.add_argument('--pool-size',
+                            type=int,
+                            default=DEFAULT_POOL_SIZE,
+                            help='max connections kept open to the ProMort host '
+                                 '(default=%(default)s)')
+        parser.add_argument('--no-keep-alive',
+                            dest='keep_alive',
+                            action='store_false',
+                            help='close the connection after each request')
+        parser.add_argument('--retry-posts',
+                            action='store_true',
+                            help='retry POST requests too, which may create duplicates '
+                                 'if the server did apply the failed request')
+        parser.add_argument('--session-cache',
+                            action='store_true',
+                            help='reuse the ProMort session stored in --session-cache-file '
+                                 'across runs, the session is not closed on exit')
+        parser.add_argument('--session-cache-file',
+                            type=str,
+                            default=DEFAULT_SESSION_CACHE,
+                            help='file of the session cache (default=%(default)s)')
+        subparsers = parser.add_subparsers(action=_LazySubParsersAction)
+        for k, h in self.supported_modules:
+            subparsers.add_parser(k, help=h)
         return parser
 
 
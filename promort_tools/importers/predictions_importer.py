@@ -22,7 +22,7 @@ try:
 except ImportError:
     import json
 
-from ..libs.client import ProMortClient, ProMortAuthenticationError
+from ..libs.client import ProMortClient, ProMortAuthenticationError, get_client_options
 
 import sys, requests
 
@@ -30,8 +30,9 @@ PREDICTION_TYPES = ['TISSUE', 'TUMOR', 'GLEASON']
 
 
 class PredictionImporter(object):
-    def __init__(self, host, user, passwd, session_id, logger):
-        self.promort_client = ProMortClient(host, user, passwd, session_id)
+    def __init__(self, host, user, passwd, session_id, logger, **client_options):
+        self.promort_client = ProMortClient(host, user, passwd, session_id,
+                                            **client_options)
         self.logger = logger
 
     def _import_prediction(self,
@@ -84,7 +85,7 @@ TBD
 
 def implementation(host, user, passwd, session_id, logger, args):
     prediction_importer = PredictionImporter(host, user, passwd, session_id,
-                                             logger)
+                                             logger, **get_client_options(args))
     prediction_importer.run(args)
 
 
@@ -17,20 +17,29 @@
 #  IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 #  CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
-from ..libs.client import ProMortClient
-from ..libs.client import ProMortAuthenticationError
+from ..libs.client import ConcurrentProMortClient, get_client_options
+from ..libs.client import ProMortAuthenticationError, ProMortInternalServerError
+from ..libs.omero import OmeroMetadataFetcher
+from ..libs.omero.metadata import DEFAULT_METADATA_CACHE, DEFAULT_TTL
 
 from argparse import ArgumentError
-import sys, requests
-from urllib.parse import urljoin
-from functools import reduce
+import sys, requests, csv, json, os
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_WORKERS = 8
+TRUE_VALUES = ('1', 'true', 'yes', 'y')
 
 
 class SlideImporter(object):
 
-    def __init__(self, host, user, passwd, session_id, logger):
-        self.promort_client = ProMortClient(host, user, passwd, session_id)
+    def __init__(self, host, user, passwd, session_id, logger, workers=DEFAULT_WORKERS,
+                 omero_cache=None, omero_cache_ttl=DEFAULT_TTL, **client_options):
+        self.promort_client = ConcurrentProMortClient(host, user, passwd, session_id,
+                                                      max_in_flight=workers, **client_options)
+        self.omero_metadata = OmeroMetadataFetcher(omero_cache, omero_cache_ttl, workers,
+                                                   self.promort_client.timeout)
         self.logger = logger
+        self.workers = workers
 
     def _get_case_label(self, slide_label):
         return slide_label.split('-')[0]
@@ -42,11 +51,15 @@ class SlideImporter(object):
         )
         if response.status_code == requests.codes.CREATED:
             self.logger.info('Case created')
+            return 'CREATED'
         elif response.status_code == requests.codes.CONFLICT:
             self.logger.info('Case already exist')
+            return 'EXISTS'
         elif response.status_code == requests.codes.BAD:
             self.logger.error('ERROR while creating Case: {0}'.format(response.text))
-            sys.exit('ERROR while creating Case')
+            raise SlideImportError('ERROR while creating Case')
+        raise SlideImportError('ERROR while creating Case: {0} {1}'.format(
+            response.status_code, response.text))
 
     def _import_slide(self, slide_label, case_label, omero_id=None, mirax_file=False,
                       omero_host=None, ignore_duplicated=False):
@@ -62,34 +75,136 @@ class SlideImporter(object):
             self.logger.info('Slide created')
             if omero_id is not None and omero_host is not None:
                 self._update_slide(slide_label, omero_id, mirax_file, omero_host)
+            return 'CREATED'
         elif response.status_code == requests.codes.CONFLICT:
             if ignore_duplicated:
                 self.logger.info('Slide already exists')
                 if omero_id is not None and omero_host is not None:
                     self._update_slide(slide_label, omero_id, mirax_file, omero_host)
+                return 'EXISTS'
             else:
                 self.logger.error('A slide with the same ID already exists')
-                sys.exit('ERROR: duplicated slide')
+                raise SlideImportError('ERROR: duplicated slide')
         elif response.status_code == requests.codes.BAD:
             self.logger.error('ERROR while creating Slide: {0}'.format(response.text))
-            sys.exit('ERROR while creating Slide')
+            raise SlideImportError('ERROR while creating Slide')
+        raise SlideImportError('ERROR while creating Slide: {0} {1}'.format(
+            response.status_code, response.text))
 
     def _update_slide(self, slide_label, omero_id, mirax_file, omero_host):
-        if mirax_file:
-            join_items = (omero_host, 'ome_seadragon/mirax/deepzoom/get/', '{0}_metadata.json'.format(slide_label))
-        else:
-            join_items = (omero_host, 'ome_seadragon/deepzoom/get/', '{0}_metadata.json'.format(omero_id))
-        ome_url = reduce(urljoin, join_items)
-        response = requests.get(ome_url)
-        if response.status_code == requests.codes.OK:
-            slide_mpp = response.json()['image_mpp']
+        slide_mpp = self.omero_metadata.get_image_mpp(omero_host, slide_label, omero_id,
+                                                      mirax_file)
+        if slide_mpp is not None:
             response = self.promort_client.put(
                 api_url='api/slides/{0}/'.format(slide_label),
                 payload={'image_microns_per_pixel': slide_mpp, 'omero_id': omero_id}
             )
             self.logger.info('Slide updated')
 
+    def _read_manifest(self, manifest_path):
+        # CSV files need a header, JSONL files have an object per line, with the keys
+        # slide_label, case_label, omero_id, omero_host, mirax and extract_case
+        with open(manifest_path) as manifest:
+            if manifest_path.endswith('.jsonl'):
+                return [json.loads(line) for line in manifest if line.strip()]
+            return list(csv.DictReader(manifest))
+
+    def _get_manifest_row(self, row, args):
+        def get(key, default=None):
+            value = row.get(key)
+            return default if value in (None, '') else value
+
+        def get_flag(key, default):
+            value = get(key, default)
+            return value if isinstance(value, bool) else str(value).lower() in TRUE_VALUES
+
+        slide_label = get('slide_label')
+        if slide_label is None:
+            raise SlideImportError('Missing slide_label')
+        case_label = get('case_label', args.case_label)
+        if case_label is None:
+            if not get_flag('extract_case', args.extract_case):
+                raise SlideImportError('Missing case_label and extract_case not enabled')
+            case_label = self._get_case_label(slide_label)
+        # the OMERO image is per slide, --omero-id is not a default for the rows
+        omero_id = get('omero_id')
+        return {
+            'slide_label': slide_label,
+            'case_label': case_label,
+            'omero_id': int(omero_id) if omero_id is not None else None,
+            'mirax_file': get_flag('mirax', args.mirax),
+            'omero_host': get('omero_host', args.omero_host)
+        }
+
+    def _import_manifest_row(self, row, case_errors, ignore_duplicated):
+        if 'error' in row:
+            raise SlideImportError(row['error'])
+        if row['case_label'] in case_errors:
+            raise SlideImportError(case_errors[row['case_label']])
+        return self._import_slide(row['slide_label'], row['case_label'], row['omero_id'],
+                                  row['mirax_file'], row['omero_host'], ignore_duplicated)
+
+    def _run_job(self, job, *args):
+        try:
+            return {'status': job(*args)}
+        except (SlideImportError, ProMortInternalServerError, requests.RequestException,
+                ValueError) as ex:
+            return {'status': 'ERROR', 'error': str(ex)}
+
+    def run_manifest(self, args):
+        rows = list()
+        for row in self._read_manifest(args.manifest):
+            try:
+                rows.append(self._get_manifest_row(row, args))
+            except (SlideImportError, ValueError) as ex:
+                rows.append({'slide_label': row.get('slide_label'), 'error': str(ex)})
+        try:
+            self.promort_client.login()
+        except ProMortAuthenticationError:
+            self.logger.critical('Authentication error, exit')
+            sys.exit('Authentication error, exit')
+        cases = sorted(set(r['case_label'] for r in rows if 'error' not in r))
+        omero_slides = [(r['omero_host'], r['slide_label'], r['omero_id'], r['mirax_file'])
+                        for r in rows
+                        if 'error' not in r and r['omero_id'] is not None and r['omero_host']]
+        self.logger.info('Importing {0} slides of {1} cases'.format(len(rows), len(cases)))
+        with ThreadPoolExecutor(self.workers) as executor:
+            # the metadata of the slides is read from OMERO while the cases are created
+            prefetch = executor.submit(self.omero_metadata.prefetch, omero_slides)
+            # every case is created once, before its slides
+            case_results = executor.map(lambda c: self._run_job(self._import_case, c), cases)
+            case_errors = dict(
+                (c, r['error']) for c, r in zip(cases, case_results) if r['status'] == 'ERROR'
+            )
+            for slide, ex in prefetch.result():
+                self.logger.warning('Unable to read the metadata of slide {0}: {1}'.format(
+                    slide[1], ex))
+            slide_results = executor.map(
+                lambda r: self._run_job(self._import_manifest_row, r, case_errors,
+                                        args.ignore_duplicated),
+                rows
+            )
+            results_path = args.results or '{0}.results.jsonl'.format(
+                os.path.splitext(args.manifest)[0])
+            failures = 0
+            with open(results_path, 'w') as results_file:
+                for index, (row, result) in enumerate(zip(rows, slide_results)):
+                    result.update({
+                        'row': index,
+                        'slide_label': row['slide_label'],
+                        'case_label': row.get('case_label')
+                    })
+                    failures += result['status'] == 'ERROR'
+                    results_file.write(json.dumps(result) + '\n')
+        self.promort_client.logout()
+        self.logger.info('Import job completed, results written to {0}'.format(results_path))
+        if failures:
+            self.logger.error('{0} slides were not imported'.format(failures))
+            sys.exit('ERROR: {0} slides were not imported'.format(failures))
+
     def run(self, args):
+        if args.manifest is not None:
+            return self.run_manifest(args)
         if args.case_label is None and not args.extract_case:
             raise ArgumentError(args.case_label,
                                 message='ERROR! Must specify a case label or enable the extract-case flag')
@@ -104,25 +219,40 @@ class SlideImporter(object):
         except ProMortAuthenticationError:
             self.logger.critical('Authentication error, exit')
             sys.exit('Authentication error, exit')
-        self._import_case(case_label)
-        self._import_slide(args.slide_label, case_label, args.omero_id, args.mirax,
-                           args.omero_host, args.ignore_duplicated)
+        try:
+            self._import_case(case_label)
+            self._import_slide(args.slide_label, case_label, args.omero_id, args.mirax,
+                               args.omero_host, args.ignore_duplicated)
+        except SlideImportError as ex:
+            sys.exit(str(ex))
         self.logger.info('Import job completed')
         self.promort_client.logout()
 
 
+class SlideImportError(Exception):
+    pass
+
+
 help_doc = """
 TBD
 """
 
 
 def implementation(host, user, passwd, session_id, logger, args):
-    slide_importer = SlideImporter(host, user, passwd, session_id, logger)
+    slide_importer = SlideImporter(host, user, passwd, session_id, logger, args.workers,
+                                   args.omero_cache, args.omero_cache_ttl * 3600,
+                                   **get_client_options(args))
     slide_importer.run(args)
 
 
 def make_parser(parser):
-    parser.add_argument('--slide-label', type=str, required=True, help='slide label')
+    slides = parser.add_mutually_exclusive_group(required=True)
+    slides.add_argument('--slide-label', type=str, help='slide label')
+    slides.add_argument('--manifest', type=str,
+                        help='CSV (with header) or JSONL file listing the slides to be imported, '
+                             'with columns slide_label, case_label, omero_id, omero_host, mirax and '
+                             'extract_case; missing values default to the command line options, '
+                             'except omero_id')
     parser.add_argument('--case-label', type=str, required=False, help='case label')
     parser.add_argument('--omero-id', type=int,
                         help='OMERO ID, only required if the slide was previously uploaded to an OMERO server')
@@ -132,6 +262,17 @@ def make_parser(parser):
     parser.add_argument('--extract-case', action='store_true', help='extract case ID from slide label')
     parser.add_argument('--ignore-duplicated', action='store_true',
                         help='if enabled, trying to import an existing slide will not produce an error')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                        help='slides imported concurrently from a manifest (default=%(default)s)')
+    parser.add_argument('--results', type=str, default=None,
+                        help='JSONL file with the result of every manifest row '
+                             '(default=MANIFEST.results.jsonl)')
+    parser.add_argument('--omero-cache', type=str, nargs='?', const=DEFAULT_METADATA_CACHE,
+                        default=None,
+                        help='JSON file caching the slide metadata read from OMERO, '
+                             '{0} if no file is given'.format(DEFAULT_METADATA_CACHE))
+    parser.add_argument('--omero-cache-ttl', type=float, default=DEFAULT_TTL / 3600.0,
+                        help='hours the cached slide metadata is valid (default=%(default)s)')
 
 
 def register(registration_list):
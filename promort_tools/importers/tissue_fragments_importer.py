@@ -22,17 +22,36 @@ try:
 except ImportError:
     import json
 
-from ..libs.client import ProMortClient, ProMortAuthenticationError
+from ..converters.shapes_io import load_shapes
+from ..libs.client import (
+    ConcurrentProMortClient,
+    ProMortAuthenticationError,
+    get_client_options,
+)
 
 import sys
 import requests
+from itertools import islice
 
 PREDICTION_TYPES = ["TISSUE", "TUMOR", "GLEASON"]
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_WORKERS = 8
 
 
 class TissueFragmentsImporter(object):
-    def __init__(self, host, user, passwd, session_id, logger):
-        self.promort_client = ProMortClient(host, user, passwd, session_id)
+    def __init__(
+        self,
+        host,
+        user,
+        passwd,
+        session_id,
+        logger,
+        workers=DEFAULT_WORKERS,
+        **client_options,
+    ):
+        self.promort_client = ConcurrentProMortClient(
+            host, user, passwd, session_id, max_in_flight=workers, **client_options
+        )
         self.logger = logger
 
     def _import_tissue_fragments(self, prediction_id, shapes, provenance_json=None):
@@ -62,15 +81,31 @@ class TissueFragmentsImporter(object):
         collection_id = self._create_collection(args.prediction_id)
         self.logger.info("Collection created with id %s", collection_id)
 
-        with open(args.shapes) as f_obj:
-            shapes = json.load(f_obj)["shapes"]
+        shapes = load_shapes(args.shapes)["shapes"]
 
-        for shape in shapes:
-            self.logger.info("add to collection %s shape %s", collection_id, shape)
-            self._create_fragment(collection_id, shape)
+        failures = self._create_fragments(
+            collection_id, shapes, args.batch_size, args.bulk
+        )
 
         self.promort_client.logout()
 
+        if failures:
+            self.logger.error("%d fragments were not created", len(failures))
+            if args.failed_shapes:
+                with open(args.failed_shapes, "w") as ofile:
+                    json.dump(
+                        {
+                            "shapes": [shape for _, shape, _ in failures],
+                            "errors": [
+                                {"index": index, "error": error}
+                                for index, _, error in failures
+                            ],
+                        },
+                        ofile,
+                    )
+                self.logger.info("Failed shapes written to %s", args.failed_shapes)
+            sys.exit("ERROR: {0} fragments were not created".format(len(failures)))
+
     def _create_collection(self, prediction_id) -> int:
         response = self.promort_client.post(
             api_url="api/tissue_fragments_collections/",
@@ -78,18 +113,94 @@ class TissueFragmentsImporter(object):
         )
         return response.json()["id"]
 
-    def _create_fragment(self, collection_id, shape):
-        self.logger.debug("creating shape %s", shape)
+    def _create_fragments(self, collection_id, shapes, batch_size, bulk=True):
+        """
+        Creates a fragment for every shape, sending batch_size shapes at
+        once to the bulk endpoint or, if the server does not have one (or
+        bulk is False), as concurrent requests. Returns a list of
+        (index, shape, error) for the fragments that were not created.
+        """
+        failures = []
+        shapes = iter(shapes)
+        start = 0
+        while True:
+            batch = list(islice(shapes, batch_size))
+            if not batch:
+                break
+            self.logger.info(
+                "adding to collection %s shapes %d-%d",
+                collection_id,
+                start,
+                start + len(batch) - 1,
+            )
+            if bulk:
+                try:
+                    errors = self._create_fragments_bulk(collection_id, batch)
+                except BulkNotSupported:
+                    self.logger.info("Bulk creation not supported by the server")
+                    bulk = False
+            if not bulk:
+                errors = self._create_fragments_concurrent(collection_id, batch)
+            failures.extend(
+                (start + i, shape, error)
+                for i, (shape, error) in enumerate(zip(batch, errors))
+                if error is not None
+            )
+            start += len(batch)
+        return failures
+
+    def _create_fragments_bulk(self, collection_id, shapes):
+        self.logger.debug("creating %d shapes", len(shapes))
         try:
             response = self.promort_client.post(
-                api_url=f"api/tissue_fragments_collections/{collection_id}/fragments/",
-                json={"shape_json": shape},
+                api_url=f"api/tissue_fragments_collections/{collection_id}/fragments/bulk/",
+                json=[{"shape_json": shape} for shape in shapes],
+            )
+        except Exception as ex:
+            self.logger.error(ex)
+            return [str(ex)] * len(shapes)
+        if response.status_code in (
+            requests.codes.NOT_FOUND,
+            requests.codes.METHOD_NOT_ALLOWED,
+        ):
+            raise BulkNotSupported()
+        if response.status_code != requests.codes.CREATED:
+            self.logger.error(
+                "ERROR while creating fragments: %s %s",
+                response.status_code,
+                response.text,
+            )
+            return [response.text or str(response.status_code)] * len(shapes)
+        return [None] * len(shapes)
+
+    def _create_fragments_concurrent(self, collection_id, shapes):
+        futures = []
+        for shape in shapes:
+            self.logger.debug("creating shape %s", shape)
+            futures.append(
+                self.promort_client.submit(
+                    "post",
+                    api_url=f"api/tissue_fragments_collections/{collection_id}/fragments/",
+                    json={"shape_json": shape},
+                )
             )
+        responses = self.promort_client.gather(futures, return_exceptions=True)
+        return [self._get_fragment_error(response) for response in responses]
+
+    def _get_fragment_error(self, response):
+        try:
+            if isinstance(response, Exception):
+                raise response
             self.logger.debug("response %s", response)
             self.logger.debug("response.text %s", response.text)
             response.raise_for_status()
         except Exception as ex:
             self.logger.error(ex)
+            return str(ex)
+
+
+class BulkNotSupported(Exception):
+    pass
 
 
 help_doc = """
@@ -99,7 +210,7 @@ TBD
 
 def implementation(host, user, passwd, session_id, logger, args):
     prediction_importer = TissueFragmentsImporter(
-        host, user, passwd, session_id, logger
+        host, user, passwd, session_id, logger, args.workers, **get_client_options(args)
     )
     prediction_importer.run(args)
 
@@ -109,7 +220,35 @@ def make_parser(parser):
         "--prediction-id", type=str, required=True, help="prediction id"
     )
     parser.add_argument(
-        "shapes", type=str, help="file containing json-serialized shapes"
+        "shapes",
+        type=str,
+        help="file containing the shapes serialized by mask_to_shapes (json or zarr)",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=DEFAULT_BATCH_SIZE,
+        help="fragments sent at once (default=%(default)s)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=DEFAULT_WORKERS,
+        help="max concurrent requests when the server has no bulk endpoint "
+        "(default=%(default)s)",
+    )
+    parser.add_argument(
+        "--no-bulk",
+        dest="bulk",
+        action="store_false",
+        help="do not use the bulk endpoint, send a request per fragment",
+    )
+    parser.add_argument(
+        "--failed-shapes",
+        type=str,
+        default=None,
+        help="json file where the shapes of the fragments that were not created "
+        "are written, it can be imported again",
     )
 
 
@@ -17,5 +17,5 @@
 #  IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 #  CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
-from .client import ProMortClient
+from .client import ProMortClient, ConcurrentProMortClient, get_client_options
 from .errors import ProMortAuthenticationError, UserNotAllowed, UserNotLoggedIn, ProMortInternalServerError
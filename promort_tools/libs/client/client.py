@@ -17,14 +17,41 @@
 #  IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 #  CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
-import requests
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urljoin
 
 from .errors import ProMortAuthenticationError, ProMortInternalServerError, UserNotLoggedIn
+from .session_cache import SessionCache
+from ..utils.lazy_import import lazy_import
+
+requests = lazy_import('requests')
+
+DEFAULT_TIMEOUT = 60  # seconds
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF_FACTOR = 0.5  # seconds
+MAX_BACKOFF = 60  # seconds
+DEFAULT_POOL_SIZE = 10
+# ProMortClient arguments that can be set from the command line options of the same name
+CLIENT_OPTIONS = ('timeout', 'retries', 'backoff_factor', 'pool_size', 'keep_alive',
+                  'retry_posts', 'session_cache')
+
+
+def get_client_options(args):
+    options = dict((k, getattr(args, k)) for k in CLIENT_OPTIONS if hasattr(args, k))
+    # --session-cache enables the cache, which is stored in --session-cache-file
+    if options.get('session_cache'):
+        options['session_cache'] = args.session_cache_file
+    return options
 
 
 class ProMortClient(object):
-    def __init__(self, host, user, passwd, session_cookie):
+    def __init__(self, host, user, passwd, session_cookie, timeout=DEFAULT_TIMEOUT,
+                 retries=DEFAULT_RETRIES, backoff_factor=DEFAULT_BACKOFF_FACTOR,
+                 pool_size=DEFAULT_POOL_SIZE, keep_alive=True, retry_posts=False,
+                 session_cache=None):
         self.promort_host = host
         self.promort_user = user
         self.promort_passwd = passwd
@@ -32,6 +59,47 @@ class ProMortClient(object):
         self.csrf_token = None
         self.session_cookie = session_cookie
         self.session_id = None
+        # seconds to wait for the server, None waits forever
+        self.timeout = timeout
+        # failed requests are sent again up to retries times, waiting a random time up to
+        # backoff_factor * 2 ** attempt; posts are retried only if retry_posts is True,
+        # as they may not be idempotent
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.retry_posts = retry_posts
+        self._mount_adapter(pool_size)
+        if not keep_alive:
+            self.promort_client.headers['Connection'] = 'close'
+        # path of a SessionCache file, if set login() reuses the session stored there and
+        # logout() keeps it open on the server, requests rejected with a 401 or 403 log in
+        # again once
+        self.session_cache = SessionCache(session_cache) if session_cache else None
+        self._login_lock = threading.Lock()
+
+    def _mount_adapter(self, pool_size):
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.promort_client.mount('http://', adapter)
+        self.promort_client.mount('https://', adapter)
+
+    def _get_backoff(self, attempt):
+        return random.uniform(0, min(MAX_BACKOFF, self.backoff_factor * 2 ** attempt))
+
+    def _send(self, method, url, retry=True, **kwargs):
+        # connection errors, timeouts and 5xx responses are retried
+        attempt = 0
+        while True:
+            try:
+                response = self.promort_client.request(method, url, timeout=self.timeout,
+                                                       **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if not retry or attempt >= self.retries:
+                    raise
+            else:
+                if (not retry or attempt >= self.retries or
+                        response.status_code < requests.codes.INTERNAL_SERVER_ERROR):
+                    return response
+            time.sleep(self._get_backoff(attempt))
+            attempt += 1
 
     def _update_payload(self, payload):
         auth_payload = {
@@ -40,71 +108,169 @@ class ProMortClient(object):
         }
         payload.update(auth_payload)
 
+    def _get_session_key(self):
+        return '{0}@{1}'.format(self.promort_user, self.promort_host)
+
+    def _set_session(self):
+        self.csrf_token = self.promort_client.cookies.get('csrftoken')
+        self.session_id = self.promort_client.cookies.get(self.session_cookie)
+
+    def _load_session(self):
+        cookies = self.session_cache.load(self._get_session_key())
+        if cookies is None:
+            return False
+        for c in cookies:
+            self.promort_client.cookies.set(c['name'], c['value'], domain=c['domain'],
+                                            path=c['path'], expires=c['expires'],
+                                            secure=c['secure'])
+        self._set_session()
+        return self._logged_in()
+
+    def _save_session(self):
+        cookies = [
+            {
+                'name': c.name,
+                'value': c.value,
+                'domain': c.domain,
+                'path': c.path,
+                'expires': c.expires,
+                'secure': c.secure
+            } for c in self.promort_client.cookies
+            if c.name in ('csrftoken', self.session_cookie)
+        ]
+        expires = [c['expires'] for c in cookies
+                   if c['name'] == self.session_cookie and c['expires']]
+        self.session_cache.save(self._get_session_key(), cookies,
+                                expires[0] if expires else None)
+
+    def _renew_session(self, session_id):
+        # concurrent requests rejected with the same session log in only once
+        with self._login_lock:
+            if self.session_id == session_id:
+                self.session_cache.delete(self._get_session_key())
+                self.promort_client.cookies.clear()
+                self._login()
+
     def login(self):
+        if self.session_cache is not None and self._load_session():
+            return
+        self._login()
+
+    def _login(self):
         url = urljoin(self.promort_host, 'api/auth/login/')
         payload = {
             'username': self.promort_user,
             'password': self.promort_passwd
         }
-        response = self.promort_client.post(url, json=payload)
+        response = self._send('POST', url, json=payload)
         if response.status_code == requests.codes.OK:
-            self.csrf_token = self.promort_client.cookies.get('csrftoken')
-            self.session_id = self.promort_client.cookies.get(
-                self.session_cookie)
+            self._set_session()
+            if self.session_cache is not None:
+                self._save_session()
         else:
             raise ProMortAuthenticationError('Authentication failed')
 
     def logout(self):
+        if self.session_cache is not None:
+            # the cached session stays valid for the next client
+            self.csrf_token = None
+            self.session_id = None
+            return
         payload = {}
         self._update_payload(payload)
         url = urljoin(self.promort_host, 'api/auth/logout/')
-        self.promort_client.post(url, payload)
+        self._send('POST', url, data=payload)
         self.csrf_token = None
         self.session_id = None
 
     def _logged_in(self):
         return self.csrf_token is not None and self.session_id is not None
 
-    def get(self, api_url, payload):
-        if self._logged_in():
-            request_url = urljoin(self.promort_host, api_url)
-            response = self.promort_client.get(request_url, params=payload)
-            if response.status_code == requests.codes.INTERNAL_SERVER_ERROR:
-                raise ProMortInternalServerError(response.text)
-            else:
-                return response
-        else:
+    def _send_logged_in(self, method, api_url, csrf=True, **kwargs):
+        if not self._logged_in():
             raise UserNotLoggedIn('Login not performed')
-
-    def post(self, api_url, payload=None, json=None):
-        if self._logged_in():
-            request_url = urljoin(self.promort_host, api_url)
-            response = self.promort_client.post(
-                request_url,
-                data=payload,
-                json=json,
-                headers={
+        request_url = urljoin(self.promort_host, api_url)
+        renewed = self.session_cache is None
+        while True:
+            session_id = self.session_id
+            if csrf:
+                kwargs['headers'] = {
                     'x-csrftoken': self.promort_client.cookies.get('csrftoken')
-                })
-            if response.status_code == requests.codes.INTERNAL_SERVER_ERROR:
-                raise ProMortInternalServerError(response.text)
-            else:
-                return response
-        else:
-            raise UserNotLoggedIn('Login not performed')
+                }
+            response = self._send(method, request_url, **kwargs)
+            if renewed or response.status_code not in (requests.codes.UNAUTHORIZED,
+                                                       requests.codes.FORBIDDEN):
+                break
+            # the cached session expired or was closed on the server
+            self._renew_session(session_id)
+            renewed = True
+        if response.status_code == requests.codes.INTERNAL_SERVER_ERROR:
+            raise ProMortInternalServerError(response.text)
+        return response
+
+    def get(self, api_url, payload):
+        return self._send_logged_in('GET', api_url, csrf=False, params=payload)
+
+    def post(self, api_url, payload=None, json=None, retry=None):
+        return self._send_logged_in('POST', api_url,
+                                    retry=self.retry_posts if retry is None else retry,
+                                    data=payload, json=json)
 
     def put(self, api_url, payload):
-        if self._logged_in():
-            request_url = urljoin(self.promort_host, api_url)
-            response = self.promort_client.put(
-                request_url,
-                payload,
-                headers={
-                    'x-csrftoken': self.promort_client.cookies.get('csrftoken')
-                })
-            if response.status_code == requests.codes.INTERNAL_SERVER_ERROR:
-                raise ProMortInternalServerError(response.text)
-            else:
-                return response
-        else:
-            raise UserNotLoggedIn('Login not performed')
+        return self._send_logged_in('PUT', api_url, data=payload)
+
+
+# submit() queues a get/post/put on a pool of threads and returns a Future, gather() waits
+# for a list of them. At most max_in_flight requests are pending at once, submit() blocks
+# until one of them completes, and the connection pool is sized accordingly.
+class ConcurrentProMortClient(ProMortClient):
+
+    def __init__(self, host, user, passwd, session_cookie, max_in_flight=8, **client_options):
+        super(ConcurrentProMortClient, self).__init__(host, user, passwd, session_cookie,
+                                                      **client_options)
+        self.max_in_flight = max_in_flight
+        pool_size = client_options.get('pool_size', DEFAULT_POOL_SIZE)
+        if pool_size < max_in_flight:
+            self._mount_adapter(max_in_flight)
+        self._in_flight = threading.BoundedSemaphore(max_in_flight)
+        self._executor = None
+
+    def submit(self, method, api_url, *args, **kwargs):
+        if method not in ('get', 'post', 'put'):
+            raise ValueError('Unsupported method {0}'.format(method))
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.max_in_flight)
+        self._in_flight.acquire()
+        try:
+            future = self._executor.submit(getattr(self, method), api_url, *args, **kwargs)
+        except Exception:
+            self._in_flight.release()
+            raise
+        future.add_done_callback(lambda f: self._in_flight.release())
+        return future
+
+    def gather(self, futures, return_exceptions=False):
+        results = list()
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as ex:
+                if not return_exceptions:
+                    raise
+                results.append(ex)
+        return results
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def logout(self):
+        self.close()
+        super(ConcurrentProMortClient, self).logout()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
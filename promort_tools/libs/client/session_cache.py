@@ -0,0 +1,82 @@
+#  Copyright (c) 2021, CRS4
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy of
+#  this software and associated documentation files (the "Software"), to deal in
+#  the Software without restriction, including without limitation the rights to
+#  use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+#  the Software, and to permit persons to whom the Software is furnished to do so,
+#  subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+#  FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+#  COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+#  IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+#  CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import json
+import os
+import stat
+import tempfile
+import time
+
+DEFAULT_SESSION_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'promort_tools',
+                                     'sessions.json')
+# used when the session cookie expires when the browser is closed
+DEFAULT_SESSION_MAX_AGE = 12 * 3600  # seconds
+# sessions expiring in less than this are not reused
+EXPIRY_MARGIN = 60  # seconds
+
+
+# Maps '<user>@<host>' keys to the cookies of an authenticated session and their expiry time.
+# The file is only readable by its owner, a cache file accessible by other users is ignored.
+class SessionCache(object):
+    def __init__(self, path=DEFAULT_SESSION_CACHE):
+        self.path = path
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                if os.fstat(f.fileno()).st_mode & (stat.S_IRWXG | stat.S_IRWXO):
+                    return {}
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _write(self, sessions):
+        folder = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(folder, mode=0o700, exist_ok=True)
+        # mkstemp creates the file with 0600 permissions, replace is atomic
+        fd, tmp_path = tempfile.mkstemp(dir=folder, prefix='.sessions')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(sessions, f)
+            os.replace(tmp_path, self.path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+    def load(self, key):
+        session = self._read().get(key)
+        if session is None or session['expires'] - EXPIRY_MARGIN <= time.time():
+            return None
+        return session['cookies']
+
+    def save(self, key, cookies, expires=None):
+        sessions = self._read()
+        now = time.time()
+        # drop the expired sessions of every user
+        sessions = dict((k, s) for k, s in sessions.items() if s['expires'] > now)
+        sessions[key] = {
+            'cookies': cookies,
+            'expires': expires or now + DEFAULT_SESSION_MAX_AGE
+        }
+        self._write(sessions)
+
+    def delete(self, key):
+        sessions = self._read()
+        if sessions.pop(key, None) is not None:
+            self._write(sessions)
@@ -0,0 +1,141 @@
+#  Copyright (c) 2021, CRS4
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy of
+#  this software and associated documentation files (the "Software"), to deal in
+#  the Software without restriction, including without limitation the rights to
+#  use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+#  the Software, and to permit persons to whom the Software is furnished to do so,
+#  subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+#  FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+#  COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+#  IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+#  CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import json
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import reduce
+from urllib.parse import urljoin
+
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_METADATA_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'promort_tools',
+                                      'omero_metadata.json')
+DEFAULT_TTL = 30 * 24 * 3600  # seconds
+DEFAULT_TIMEOUT = 60  # seconds
+DEFAULT_WORKERS = 8
+
+
+# Reads the image_mpp of slides from the ome_seadragon metadata of an OMERO server using a
+# pooled session. Values are kept in memory and, if cache_path is set, in a JSON file where
+# they are valid for ttl seconds; prefetch() reads the missing values of many slides
+# concurrently.
+class OmeroMetadataFetcher(object):
+    def __init__(self, cache_path=None, ttl=DEFAULT_TTL, workers=DEFAULT_WORKERS,
+                 timeout=DEFAULT_TIMEOUT):
+        self.cache_path = cache_path
+        self.ttl = ttl
+        self.workers = workers
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._lock = threading.Lock()
+        self._cache = self._read_cache()
+
+    def _read_cache(self):
+        if self.cache_path is None:
+            return {}
+        try:
+            with open(self.cache_path) as f:
+                cache = json.load(f)
+        except (IOError, ValueError):
+            return {}
+        now = time.time()
+        return dict((k, v) for k, v in cache.items() if v['time'] + self.ttl > now)
+
+    def _write_cache(self):
+        if self.cache_path is None:
+            return
+        folder = os.path.dirname(os.path.abspath(self.cache_path))
+        os.makedirs(folder, exist_ok=True)
+        with self._lock:
+            cache = dict(self._cache)
+        fd, tmp_path = tempfile.mkstemp(dir=folder, prefix='.omero_metadata')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(cache, f)
+            os.replace(tmp_path, self.cache_path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+    def _get_key(self, omero_host, slide_label, omero_id, mirax_file):
+        if mirax_file:
+            return 'MIRAX:{0}:{1}'.format(omero_host, slide_label)
+        return 'OMERO_IMG:{0}:{1}'.format(omero_host, omero_id)
+
+    def _get_url(self, omero_host, slide_label, omero_id, mirax_file):
+        if mirax_file:
+            join_items = (omero_host, 'ome_seadragon/mirax/deepzoom/get/',
+                          '{0}_metadata.json'.format(slide_label))
+        else:
+            join_items = (omero_host, 'ome_seadragon/deepzoom/get/',
+                          '{0}_metadata.json'.format(omero_id))
+        return reduce(urljoin, join_items)
+
+    def _fetch(self, omero_host, slide_label, omero_id, mirax_file):
+        key = self._get_key(omero_host, slide_label, omero_id, mirax_file)
+        with self._lock:
+            if key in self._cache:
+                return self._cache[key]['image_mpp']
+        response = self.session.get(self._get_url(omero_host, slide_label, omero_id, mirax_file),
+                                    timeout=self.timeout)
+        if response.status_code != requests.codes.OK:
+            return None
+        image_mpp = response.json()['image_mpp']
+        with self._lock:
+            self._cache[key] = {'image_mpp': image_mpp, 'time': time.time()}
+        return image_mpp
+
+    # None if the slide is unknown to the OMERO server
+    def get_image_mpp(self, omero_host, slide_label, omero_id, mirax_file=False):
+        key = self._get_key(omero_host, slide_label, omero_id, mirax_file)
+        cached = key in self._cache
+        image_mpp = self._fetch(omero_host, slide_label, omero_id, mirax_file)
+        if not cached and image_mpp is not None:
+            self._write_cache()
+        return image_mpp
+
+    # slides is a list of (omero_host, slide_label, omero_id, mirax_file) tuples, failed
+    # requests are returned as (slide, exception) pairs and retried by get_image_mpp
+    def prefetch(self, slides):
+        slides = [s for s in set(slides) if self._get_key(*s) not in self._cache]
+        if not slides:
+            return []
+        failures = list()
+
+        def fetch(slide):
+            try:
+                self._fetch(*slide)
+            except (requests.RequestException, ValueError, KeyError) as ex:
+                failures.append((slide, ex))
+
+        with ThreadPoolExecutor(self.workers) as executor:
+            list(executor.map(fetch, slides))
+        self._write_cache()
+        return failures
+
+    def close(self):
+        self.session.close()
@@ -1,7 +1,43 @@
+import io
+import json
+import logging
+import os
+import subprocess
+import sys
+import tracemalloc
+
 import cv2
+import numpy as np
 import pytest
+import tiledb
+import zarr
 
-from promort_tools.converters.mask_to_shapes import convert_to_shapes, BasicScaler
+from promort_tools.converters.mask_to_shapes import (
+    SCALERS,
+    BasicScaler,
+    ChunkedContourFinder,
+    Shape,
+    TileDBMask,
+    _open_group,
+    add_pyramid,
+    apply_threshold,
+    batch_main,
+    convert_to_shapes,
+    convert_to_shapes_chunked,
+    convert_to_shapes_sweep,
+    filter_contours,
+    get_scaler,
+    main,
+    pack_contours,
+    polygon_areas,
+    write_json,
+)
+from promort_tools.converters.shapes_io import load_shapes
+from promort_tools.converters import zarr_to_tiledb
+from promort_tools.converters.zarr_to_tiledb import (
+    DEFAULT_BUFFER_SIZE,
+    ZarrToTileDBConverter,
+)
 
 
 @pytest.mark.parametrize("scale_factor", [1, 2, 4, 8])
@@ -67,3 +103,863 @@ def test_mask_to_shapes_th_100(square_mask, scale_factor):
         orig_res[0] / 2 - scale_factor / 2,
         orig_res[0] / 4 + scale_factor / 2,
     ) in coordinates
+
+
+@pytest.mark.parametrize("chunk_rows", [1, 3, 5, 16])
+@pytest.mark.parametrize("threshold", [0, 50, 100])
+def test_mask_to_shapes_chunked_fixture(square_mask, chunk_rows, threshold):
+    orig_res = [_ * 4 for _ in square_mask.shape]
+    expected = convert_to_shapes(
+        square_mask.copy(), orig_res, threshold, BasicScaler(square_mask.shape)
+    )
+    z_mask = zarr.array(square_mask, chunks=(chunk_rows, square_mask.shape[1]))
+    shapes = convert_to_shapes_chunked(
+        z_mask, orig_res, threshold, BasicScaler(square_mask.shape)
+    )
+    assert shapes == expected
+
+
+@pytest.mark.parametrize("seed", range(10))
+@pytest.mark.parametrize("chunk_rows", [1, 2, 7, 32])
+def test_mask_to_shapes_chunked_random(seed, chunk_rows):
+    rng = np.random.default_rng(seed)
+    mask = (rng.random((48, 40)) * 100).astype("uint8")
+    if seed % 2:
+        mask = cv2.GaussianBlur(mask, (5, 5), 0)
+    orig_res = [_ * 2 for _ in mask.shape]
+    expected = convert_to_shapes(mask.copy(), orig_res, 50, BasicScaler(mask.shape))
+    shapes = convert_to_shapes_chunked(
+        zarr.array(mask), orig_res, 50, BasicScaler(mask.shape), chunk_rows
+    )
+    assert shapes == expected
+
+
+def test_mask_to_shapes_chunked_nested():
+    mask = np.zeros((20, 20), dtype="uint8")
+    mask[2:18, 2:18] = 100
+    mask[5:15, 5:15] = 0
+    mask[8:12, 8:12] = 100  # island inside the hole, not external
+    expected = convert_to_shapes(mask.copy(), mask.shape, 50, BasicScaler(mask.shape))
+    assert len(expected["shapes"]) == 1
+    for chunk_rows in (1, 4, 9):
+        shapes = convert_to_shapes_chunked(
+            mask, mask.shape, 50, BasicScaler(mask.shape), chunk_rows
+        )
+        assert shapes == expected
+
+
+def test_mask_to_shapes_chunked_memory():
+    # a single ring crossing every band, as tissue fragments often do
+    size, chunk_rows = 1024, 16
+    mask = np.zeros((size, size), dtype="uint8")
+    cv2.circle(mask, (size // 2, size // 2), size // 2 - 1, 100, -1)
+    cv2.circle(mask, (size // 2, size // 2), size // 4, 0, -1)
+    z_mask = zarr.array(mask, chunks=(chunk_rows, size))
+    ChunkedContourFinder(z_mask[:64], 50, chunk_rows).find_contours()  # warm up
+    tracemalloc.start()
+    try:
+        contours = ChunkedContourFinder(z_mask, 50, chunk_rows).find_contours()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    expected, _ = cv2.findContours(
+        (mask >= 50).astype("uint8"), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE
+    )
+    assert len(contours) == len(expected) == 1
+    assert np.array_equal(contours[0], expected[0])
+    # bounded by the bands, not by the component spanning the whole mask
+    assert peak < mask.nbytes / 2
+
+
+def _write_group(path, mask, resolution):
+    group = zarr.open_group(str(path), mode="w")
+    group.attrs["resolution"] = resolution
+    group.array("mask", mask).attrs["round_to_0_100"] = True
+
+
+def test_mask_to_shapes_batch(tmp_path, square_mask):
+    for name in ("a.zarr", "b.zarr"):
+        _write_group(tmp_path / "in" / name, square_mask, [64, 64])
+    out_folder = tmp_path / "out"
+    batch_main(
+        [str(tmp_path / "in"), "-o", str(out_folder), "-t", "0.5", "--processes", "2"]
+    )
+
+    expected = convert_to_shapes(
+        square_mask.copy(), [64, 64], 50, BasicScaler(square_mask.shape)
+    )
+    for name in ("a.zarr", "b.zarr"):
+        with open(out_folder / f"{name}.json") as f:
+            assert json.load(f) == json.loads(json.dumps(expected))
+    with open(out_folder / "report.json") as f:
+        report = json.load(f)
+    assert report["datasets"] == 2
+    assert report["failed"] == 0
+
+
+@pytest.mark.parametrize("chunk_rows", ["0", "-16"])
+def test_mask_to_shapes_invalid_chunk_rows(capsys, chunk_rows):
+    with pytest.raises(SystemExit) as exit_info:
+        main(["a.zarr", "--streaming", "--chunk-rows", chunk_rows])
+    assert exit_info.value.code == 2
+    assert "expected a positive integer" in capsys.readouterr().err
+
+
+def test_mask_to_shapes_batch_manifest_failure(tmp_path, square_mask):
+    _write_group(tmp_path / "a.zarr", square_mask, [64, 64])
+    manifest = tmp_path / "manifest.txt"
+    manifest.write_text("# datasets\na.zarr\nmissing.zarr\n")
+    report_path = tmp_path / "report.json"
+    with pytest.raises(SystemExit):
+        batch_main(
+            [
+                str(manifest),
+                "-o",
+                str(tmp_path / "out"),
+                "-t",
+                "0.5",
+                "--processes",
+                "1",
+                "--report",
+                str(report_path),
+            ]
+        )
+    with open(report_path) as f:
+        report = json.load(f)
+    assert report["failed"] == 1
+    statuses = {os.path.basename(r["input"]): r["status"] for r in report["results"]}
+    assert statuses == {"a.zarr": "OK", "missing.zarr": "ERROR"}
+
+
+def test_pack_contours():
+    contours = [
+        np.array([[[0, 0]], [[0, 4]], [[4, 4]], [[4, 0]]], dtype="int32"),
+        np.array([[[1, 1]], [[2, 2]]], dtype="int32"),  # not a polygon
+        np.array([[[5, 5]], [[5, 7]], [[8, 5]]], dtype="int32"),
+    ]
+    points, offsets = pack_contours(contours)
+    assert offsets.tolist() == [0, 5, 9]
+    assert points[4].tolist() == [0, 0]
+    assert points[8].tolist() == [5, 5]
+    assert polygon_areas(points, offsets).tolist() == [16, 3]
+
+
+@pytest.mark.parametrize("factor", [1, 2.5, 8])
+def test_basic_scaler_scale_shapes(rhombus_mask, square_mask, factor):
+    contours = []
+    for mask in (rhombus_mask, square_mask):
+        contours.extend(
+            cv2.findContours(
+                mask, mode=cv2.RETR_EXTERNAL, method=cv2.CHAIN_APPROX_SIMPLE
+            )[0]
+        )
+    points, offsets = pack_contours(contours)
+    scaler = BasicScaler(square_mask.shape)
+    scaled = scaler.scale_shapes(points, offsets, factor)
+    for i, (start, stop) in enumerate(zip(offsets[:-1], offsets[1:])):
+        shape = Shape(points[start:stop].tolist(), scaler)
+        assert scaled.coordinates[
+            scaled.offsets[i] : scaled.offsets[i + 1]
+        ].tolist() == [list(c) for c in scaler.get_coordinates(shape, factor)]
+        assert scaled.lengths[i] == scaler.get_length(shape, factor)
+        assert scaled.areas[i] == pytest.approx(scaler.get_area(shape, factor))
+
+
+@pytest.mark.parametrize("threshold", [0, 1, 50, 100, 101])
+def test_apply_threshold(square_mask, threshold):
+    original = square_mask.copy()
+    binary = apply_threshold(square_mask, threshold)
+    assert binary.dtype == np.uint8
+    assert (binary == (original >= threshold)).all()
+    assert (square_mask == original).all()
+
+    in_place = apply_threshold(square_mask, threshold, in_place=True)
+    assert in_place is square_mask
+    assert (in_place == binary).all()
+
+
+def test_apply_threshold_float(square_mask):
+    probabilities = square_mask.astype("float32") / 100
+    out = np.empty(square_mask.shape, dtype=np.uint8)
+    binary = apply_threshold(probabilities, 0.5, out=out, in_place=True)
+    assert binary is out
+    assert (binary == (square_mask >= 50)).all()
+    assert probabilities.dtype == np.float32
+
+
+def test_mask_to_shapes_float_mask(square_mask):
+    probabilities = square_mask.astype("float32") / 100
+    expected = convert_to_shapes(
+        square_mask, [32, 32], 50, BasicScaler(square_mask.shape)
+    )
+    shapes = convert_to_shapes(
+        probabilities, [32, 32], 0.5, BasicScaler(square_mask.shape)
+    )
+    assert shapes == expected
+
+
+def test_filter_contours():
+    square = np.array([[[0, 0]], [[0, 9]], [[9, 9]], [[9, 0]]], dtype="int32")
+    triangle = np.array([[[0, 0]], [[0, 2]], [[2, 0]]], dtype="int32")
+    segment = np.array([[[0, 0]], [[0, 5]]], dtype="int32")
+    contours = [square, triangle, segment]
+    assert filter_contours(contours, 100, 0) == [square, triangle]
+    assert filter_contours(contours, 100, 3) == [square]
+    assert filter_contours(contours, 100, 0, min_vertices=4) == [square]
+
+
+def test_mask_to_shapes_min_area(square_mask):
+    mask = square_mask.copy()
+    mask[12, 12] = 100
+    orig_res = mask.shape
+    shapes = convert_to_shapes(mask, orig_res, 50, BasicScaler(mask.shape))["shapes"]
+    assert len(shapes) == 1
+    shapes = convert_to_shapes(
+        mask, orig_res, 50, BasicScaler(mask.shape), min_area=0, min_vertices=1
+    )["shapes"]
+    assert len(shapes) == 1  # single pixels are never valid polygons
+    shapes = convert_to_shapes(
+        mask, orig_res, 50, BasicScaler(mask.shape), min_area=30
+    )["shapes"]
+    assert len(shapes) == 0
+
+
+@pytest.mark.parametrize("streaming", [False, True])
+def test_mask_to_shapes_sweep(streaming):
+    rng = np.random.default_rng(0)
+    mask = cv2.GaussianBlur((rng.random((64, 48)) * 100).astype("uint8"), (5, 5), 0)
+    thresholds = [40, 50, 60]
+    sweep = convert_to_shapes_sweep(
+        zarr.array(mask, chunks=(10, 48)) if streaming else mask,
+        mask.shape,
+        thresholds,
+        BasicScaler(mask.shape),
+        streaming=streaming,
+        min_area=0,
+    )
+    assert sorted(sweep) == thresholds
+    for threshold in thresholds:
+        expected = convert_to_shapes(
+            mask, mask.shape, threshold, BasicScaler(mask.shape), min_area=0
+        )
+        assert sweep[threshold] == expected
+
+
+def test_mask_to_shapes_main_sweep(tmp_path, square_mask):
+    _write_group(tmp_path / "a.zarr", square_mask, [64, 64])
+    out_file = tmp_path / "a.json"
+    main(["-t", "0.3,1", str(tmp_path / "a.zarr"), "-o", str(out_file), "-t", "0.5"])
+    with open(out_file) as f:
+        shapes = json.load(f)["thresholds"]
+    assert sorted(shapes) == ["0.3", "0.5", "1.0"]
+    assert shapes["0.3"] == shapes["0.5"]
+    assert len(shapes["1.0"]["shapes"]) == 1
+    assert shapes["1.0"] != shapes["0.5"]
+
+
+def test_mask_to_shapes_main_duplicated_thresholds(tmp_path, square_mask):
+    _write_group(tmp_path / "a.zarr", square_mask, [64, 64])
+    out_file = tmp_path / "a.json"
+    main([str(tmp_path / "a.zarr"), "-o", str(out_file), "-t", "0.5"])
+    with open(out_file) as f:
+        expected = json.load(f)
+    # 0.501 is 50 on the 0-100 mask as 0.5 is
+    for thresholds in ("0.5,0.5", "0.5,0.501"):
+        main([str(tmp_path / "a.zarr"), "-o", str(out_file), "-t", thresholds])
+        with open(out_file) as f:
+            assert json.load(f) == expected
+    main([str(tmp_path / "a.zarr"), "-o", str(out_file), "-t", "0.3,1,0.3"])
+    with open(out_file) as f:
+        assert list(json.load(f)["thresholds"]) == ["0.3", "1.0"]
+
+
+def test_add_pyramid():
+    angles = np.linspace(0, 2 * np.pi, 1000, endpoint=False)
+    coordinates = [(10000 + 5000 * np.cos(a), 10000 + 5000 * np.sin(a)) for a in angles]
+    coordinates.append(coordinates[0])
+    shapes = add_pyramid({"shapes": [{"coordinates": coordinates}]}, (20000, 18000))
+    pyramid = shapes["shapes"][0]["pyramid"]
+    assert sorted(pyramid, key=int) == [str(level) for level in range(3, 16)]
+    sizes = [len(pyramid[str(level)]) for level in range(15, 2, -1)]
+    assert sizes == sorted(sizes, reverse=True)
+    assert sizes[0] < len(coordinates)
+    assert 4 <= sizes[-1] < 10
+
+
+@pytest.mark.parametrize("thresholds", [["0.5"], ["0.5,1"]])
+def test_mask_to_shapes_zarr_format(tmp_path, square_mask, thresholds):
+    _write_group(tmp_path / "a.zarr", square_mask, [64, 64])
+    args = [str(tmp_path / "a.zarr"), "--pyramid", "-t", *thresholds]
+    main(args + ["-o", str(tmp_path / "a.json")])
+    main(args + ["-o", str(tmp_path / "a.shapes.zarr"), "--format", "zarr"])
+
+    with open(tmp_path / "a.json") as f:
+        expected = json.load(f)
+    loaded = load_shapes(str(tmp_path / "a.shapes.zarr"))
+    if "thresholds" in expected:
+        assert sorted(loaded["thresholds"]) == sorted(expected["thresholds"])
+        docs = [
+            (loaded["thresholds"][t], expected["thresholds"][t])
+            for t in expected["thresholds"]
+        ]
+    else:
+        docs = [(loaded, expected)]
+    for packed, doc in docs:
+        assert len(packed["shapes"]) == len(doc["shapes"])
+        assert list(packed["shapes"]) == doc["shapes"]
+        assert packed["shapes"][-1] == doc["shapes"][-1]
+    assert load_shapes(str(tmp_path / "a.json")) == expected
+
+
+def test_write_json(square_mask):
+    lazy = convert_to_shapes(
+        square_mask, [32, 32], 0, BasicScaler(square_mask.shape), lazy=True
+    )
+    expected = convert_to_shapes(
+        square_mask, [32, 32], 0, BasicScaler(square_mask.shape)
+    )
+    assert not isinstance(lazy["shapes"], list)
+    out = io.StringIO()
+    doc = {"thresholds": {"0.5": lazy, "1": {"shapes": iter([])}}, "other": [1, 2]}
+    assert write_json(doc, out) == 1
+    expected_doc = {
+        "thresholds": {"0.5": expected, "1": {"shapes": []}},
+        "other": [1, 2],
+    }
+    assert out.getvalue() == json.dumps(expected_doc)
+
+
+def test_mask_to_shapes_main_stdout(tmp_path, square_mask, capsys):
+    _write_group(tmp_path / "a.zarr", square_mask, [64, 64])
+    main([str(tmp_path / "a.zarr"), "-t", "0.5", "--log-file", str(tmp_path / "log")])
+    expected = convert_to_shapes(
+        square_mask, [64, 64], 50, BasicScaler(square_mask.shape)
+    )
+    assert capsys.readouterr().out == json.dumps(expected) + "\n"
+
+
+@pytest.mark.parametrize("name", sorted(SCALERS))
+@pytest.mark.parametrize("factor", [1, 2.5])
+def test_scalers_scale_shapes(rhombus_mask, square_mask, name, factor):
+    contours = []
+    for mask in (rhombus_mask, square_mask):
+        contours.extend(
+            cv2.findContours(
+                mask, mode=cv2.RETR_EXTERNAL, method=cv2.CHAIN_APPROX_SIMPLE
+            )[0]
+        )
+    points, offsets = pack_contours(contours)
+    scaler = get_scaler(name, square_mask.shape, (32, 32))
+    scaled = scaler.scale_shapes(points, offsets, factor)
+    assert len(scaled.offsets) == len(offsets)
+    for i, (start, stop) in enumerate(zip(offsets[:-1], offsets[1:])):
+        shape = Shape(points[start:stop].tolist(), scaler)
+        coordinates = scaled.coordinates[scaled.offsets[i] : scaled.offsets[i + 1]]
+        assert coordinates.ravel().tolist() == pytest.approx(
+            np.ravel(scaler.get_coordinates(shape, factor)).tolist()
+        )
+        assert scaled.lengths[i] == scaler.get_length(shape, factor)
+        assert scaled.areas[i] == pytest.approx(scaler.get_area(shape, factor))
+
+
+def test_shapely_scaler(square_mask):
+    expected = convert_to_shapes(
+        square_mask, [64, 64], 50, BasicScaler(square_mask.shape)
+    )
+    shapes = convert_to_shapes(
+        square_mask, [64, 64], 50, get_scaler("shapely", square_mask.shape, [64, 64])
+    )
+    assert shapes == expected
+
+
+def test_fit_scaler():
+    mask = np.ones((16, 8), dtype="uint8")
+    resolution = (64, 32)  # width, height: x scaled by 8, y by 2
+    shapes = convert_to_shapes(
+        mask, resolution, 1, get_scaler("fit", mask.shape, resolution)
+    )["shapes"]
+    assert sorted(shapes[0]["coordinates"]) == [
+        (4.0, 1.0),
+        (4.0, 1.0),
+        (4.0, 31.0),
+        (60.0, 1.0),
+        (60.0, 31.0),
+    ]
+    assert shapes[0]["area"] == 56 * 30
+
+
+@pytest.mark.parametrize("factor", [1, 4])
+def test_pyclipper_scaler(square_mask, rhombus_mask, factor):
+    resolution = [_ * factor for _ in square_mask.shape]
+    for mask, pixels in ((square_mask, 64), (rhombus_mask, 8)):
+        shapes = convert_to_shapes(
+            mask, resolution, 50, get_scaler("pyclipper", mask.shape, resolution)
+        )["shapes"]
+        assert len(shapes) == 1
+        # the grown polygon covers the pixels entirely
+        assert shapes[0]["area"] == pytest.approx(pixels * factor**2, rel=0.1)
+    shapes = convert_to_shapes(
+        square_mask,
+        resolution,
+        50,
+        get_scaler("pyclipper", square_mask.shape, resolution),
+    )["shapes"]
+    assert sorted(set(shapes[0]["coordinates"])) == [
+        (0.0, 0.0),
+        (0.0, 8.0 * factor),
+        (8.0 * factor, 0.0),
+        (8.0 * factor, 8.0 * factor),
+    ]
+
+
+def _write_prediction_group(path, arrays, chunks=(16, 16)):
+    group = zarr.open_group(str(path), mode="w")
+    group.attrs["resolution"] = [4000, 3000]
+    group.attrs["filename"] = "slide.mrxs"
+    for name, data in arrays.items():
+        array = group.array(name, data, chunks=chunks)
+        array.attrs["dzi_sampling_level"] = 9.3
+        array.attrs["tile_size"] = 256
+    return group
+
+
+def _prediction_arrays(shape=(100, 70), seed=0):
+    rng = np.random.default_rng(seed)
+    return {
+        "tumor": (rng.random(shape) * 100).astype("uint8"),
+        "gleason": rng.random(shape).astype("float32"),
+    }
+
+
+@pytest.mark.parametrize("buffer_size", [0.0001, 0.01, DEFAULT_BUFFER_SIZE])
+def test_zarr_to_tiledb(tmp_path, buffer_size):
+    arrays = _prediction_arrays()
+    _write_prediction_group(tmp_path / "pred.zarr", arrays)
+    converter = ZarrToTileDBConverter(logging.getLogger(), buffer_size)
+    converter.run(str(tmp_path / "pred.zarr"), str(tmp_path))
+
+    with tiledb.open(str(tmp_path / "pred.zarr.tiledb")) as dataset:
+        data = dataset[:]
+        for name, expected in arrays.items():
+            assert (data[name] == expected).all()
+        assert dataset.meta["original_width"] == 4000
+        assert dataset.meta["tumor.dzi_sampling_level"] == 10
+
+
+def test_zarr_to_tiledb_schema(tmp_path):
+    arrays = _prediction_arrays()
+    _write_prediction_group(tmp_path / "pred.zarr", arrays, chunks=(32, 64))
+    converter = ZarrToTileDBConverter(
+        logging.getLogger(),
+        cell_order="col-major",
+        filters=["bitshuffle", "zstd:7"],
+        attribute_filters={"gleason": ["delta", "lz4"]},
+    )
+    converter.run(str(tmp_path / "pred.zarr"), str(tmp_path))
+
+    schema = tiledb.ArraySchema.load(str(tmp_path / "pred.zarr.tiledb"))
+    assert [schema.domain.dim(i).tile for i in range(2)] == [32, 64]
+    assert schema.domain.dim(0).dtype == np.uint16
+    assert schema.cell_order == "col-major"
+    tumor_filters = schema.attr("tumor").filters
+    assert [type(f) for f in tumor_filters] == [
+        tiledb.BitShuffleFilter,
+        tiledb.ZstdFilter,
+    ]
+    assert tumor_filters[1].level == 7
+    assert [type(f) for f in schema.attr("gleason").filters] == [
+        tiledb.DeltaFilter,
+        tiledb.LZ4Filter,
+    ]
+    with tiledb.open(str(tmp_path / "pred.zarr.tiledb")) as dataset:
+        assert (dataset[:]["gleason"] == arrays["gleason"]).all()
+
+
+def test_zarr_to_tiledb_domain_dtype():
+    converter = ZarrToTileDBConverter(logging.getLogger())
+    assert converter._get_domain_dtype((65536, 10)) == np.uint16
+    assert converter._get_domain_dtype((10, 65537)) == np.uint32
+
+
+def test_zarr_to_tiledb_tile_size(tmp_path):
+    group = _write_prediction_group(tmp_path / "pred.zarr", _prediction_arrays())
+    converter = ZarrToTileDBConverter(logging.getLogger(), tile_size=(128, 8))
+    assert converter._get_tile_size(group, (100, 70)) == (100, 8)
+
+
+def test_zarr_to_tiledb_parser():
+    args = zarr_to_tiledb.make_parser().parse_args(
+        "--zarr-dataset a --out-folder b --filters bitshuffle,zstd:3 "
+        "--attribute-filters tumor=delta,zstd".split()
+    )
+    assert args.filters == ["bitshuffle", "zstd:3"]
+    assert dict(args.attribute_filters) == {"tumor": ["delta", "zstd"]}
+    with pytest.raises(SystemExit):
+        zarr_to_tiledb.make_parser().parse_args(
+            "--zarr-dataset a --out-folder b --filters snappy".split()
+        )
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_zarr_to_tiledb_workers(tmp_path, workers):
+    rng = np.random.default_rng(1)
+    arrays = {
+        label: rng.random((90, 50)).astype("float32")
+        for label in ("gleason_1", "gleason_2", "gleason_3")
+    }
+    _write_prediction_group(tmp_path / "pred.zarr", arrays, chunks=(8, 16))
+    converter = ZarrToTileDBConverter(logging.getLogger(), 0.002, workers=workers)
+    converter.run(str(tmp_path / "pred.zarr"), str(tmp_path))
+
+    with tiledb.open(str(tmp_path / "pred.zarr.tiledb")) as dataset:
+        data = dataset[:]
+        for name, expected in arrays.items():
+            assert (data[name] == expected).all()
+
+
+def test_zarr_to_tiledb_batch(tmp_path):
+    arrays = _prediction_arrays()
+    for name in ("a.zarr", "b.zarr"):
+        _write_prediction_group(tmp_path / "in" / name, arrays)
+    out_folder = tmp_path / "out"
+    argv = [
+        "batch",
+        str(tmp_path / "in" / "*.zarr"),
+        "--out-folder",
+        str(out_folder),
+        "--processes",
+        "2",
+        "--tiledb-config",
+        "sm.compute_concurrency_level=2",
+    ]
+    zarr_to_tiledb.main(argv)
+    with open(out_folder / "report.json") as f:
+        report = json.load(f)
+    assert (report["datasets"], report["skipped"], report["failed"]) == (2, 0, 0)
+    for name in ("a.zarr", "b.zarr"):
+        with tiledb.open(str(out_folder / f"{name}.tiledb")) as dataset:
+            assert (dataset[:]["tumor"] == arrays["tumor"]).all()
+
+    # an interrupted conversion has no metadata, it is converted again
+    with tiledb.open(str(out_folder / "b.zarr.tiledb"), "w") as dataset:
+        del dataset.meta["slide_path"]
+    zarr_to_tiledb.main(argv)
+    with open(out_folder / "report.json") as f:
+        report = json.load(f)
+    statuses = {os.path.basename(r["input"]): r["status"] for r in report["results"]}
+    assert statuses == {"a.zarr": "SKIPPED", "b.zarr": "OK"}
+    with tiledb.open(str(out_folder / "b.zarr.tiledb")) as dataset:
+        assert dataset.meta["slide_path"] == "slide.mrxs"
+
+
+def test_zarr_to_tiledb_batch_manifest_failure(tmp_path):
+    _write_prediction_group(tmp_path / "a.zarr", _prediction_arrays())
+    manifest = tmp_path / "manifest.txt"
+    manifest.write_text("# datasets\na.zarr\nmissing.zarr\n")
+    with pytest.raises(SystemExit):
+        zarr_to_tiledb.batch_main(
+            [str(manifest), "--out-folder", str(tmp_path / "out"), "--processes", "1"]
+        )
+    with open(tmp_path / "out" / "report.json") as f:
+        report = json.load(f)
+    statuses = {os.path.basename(r["input"]): r["status"] for r in report["results"]}
+    assert statuses == {"a.zarr": "OK", "missing.zarr": "ERROR"}
+
+
+def test_zarr_to_tiledb_resume(tmp_path, monkeypatch):
+    arrays = _prediction_arrays()
+    _write_prediction_group(tmp_path / "pred.zarr", arrays)
+    tiledb_path = str(tmp_path / "pred.zarr.tiledb")
+    converter = ZarrToTileDBConverter(logging.getLogger(), 0.002, workers=1)
+    write_region = converter._write_region
+    written = []
+
+    def recording_write_region(path, index, *args):
+        written.append(index)
+        write_region(path, index, *args)
+
+    def failing_write_region(path, index, *args):
+        if index == 3:
+            raise RuntimeError("interrupted")
+        recording_write_region(path, index, *args)
+
+    monkeypatch.setattr(converter, "_write_region", failing_write_region)
+    with pytest.raises(RuntimeError):
+        converter.run(str(tmp_path / "pred.zarr"), str(tmp_path))
+    assert not converter.is_converted(str(tmp_path / "pred.zarr"), str(tmp_path))
+
+    # a larger buffer does not change the regions of the interrupted conversion
+    converter.buffer_size *= 4
+    monkeypatch.setattr(converter, "_write_region", recording_write_region)
+    converter.run(str(tmp_path / "pred.zarr"), str(tmp_path))
+    assert written == list(range(len(written)))
+    assert converter.is_converted(str(tmp_path / "pred.zarr"), str(tmp_path))
+    with tiledb.open(tiledb_path) as dataset:
+        data = dataset[:]
+        for name, expected in arrays.items():
+            assert (data[name] == expected).all()
+        assert not any(k.startswith("conversion.") for k in dataset.meta.keys())
+    assert len(tiledb.FragmentInfoList(tiledb_path)) == 1
+
+
+def test_zarr_to_tiledb_existing_dataset(tmp_path):
+    _write_prediction_group(tmp_path / "pred.zarr", _prediction_arrays())
+    converter = ZarrToTileDBConverter(logging.getLogger())
+    converter.run(str(tmp_path / "pred.zarr"), str(tmp_path))
+
+    arrays = _prediction_arrays(shape=(60, 60), seed=1)
+    _write_prediction_group(tmp_path / "pred.zarr", arrays)
+    with pytest.raises(SystemExit):
+        converter.run(str(tmp_path / "pred.zarr"), str(tmp_path))
+    converter.run(str(tmp_path / "pred.zarr"), str(tmp_path), overwrite=True)
+    with tiledb.open(str(tmp_path / "pred.zarr.tiledb")) as dataset:
+        assert (dataset[:]["tumor"] == arrays["tumor"]).all()
+
+
+@pytest.mark.parametrize("array_type", ["dense", "sparse"])
+@pytest.mark.parametrize("streaming", [False, True])
+def test_mask_to_shapes_tiledb_input(tmp_path, streaming, array_type):
+    mask = np.zeros((48, 64), dtype="uint8")
+    for center, radius, value in (
+        ((10, 10), 6, 60),
+        ((40, 30), 12, 90),
+        ((58, 5), 4, 70),
+    ):
+        cv2.circle(mask, center, radius, value, -1)
+    group = _write_prediction_group(
+        tmp_path / "pred.zarr", {"tumor": mask}, chunks=(16, 16)
+    )
+    group["tumor"].attrs["round_to_0_100"] = True
+    ZarrToTileDBConverter(logging.getLogger(), array_type=array_type).run(
+        str(tmp_path / "pred.zarr"), str(tmp_path)
+    )
+
+    args = ["-t", "0.5", "--min-area", "0"] + (["--streaming"] if streaming else [])
+    main([str(tmp_path / "pred.zarr"), "-o", str(tmp_path / "zarr.json")] + args)
+    main([str(tmp_path / "pred.zarr.tiledb"), "-o", str(tmp_path / "tdb.json")] + args)
+    with open(tmp_path / "zarr.json") as f:
+        expected = json.load(f)
+    with open(tmp_path / "tdb.json") as f:
+        assert json.load(f) == expected
+    assert len(expected["shapes"]) > 1
+
+
+def test_tiledb_mask(tmp_path):
+    arrays = _prediction_arrays()
+    _write_prediction_group(tmp_path / "pred.zarr", arrays)
+    ZarrToTileDBConverter(logging.getLogger()).run(
+        str(tmp_path / "pred.zarr"), str(tmp_path)
+    )
+    mask, resolution, round_to_0_100 = _open_group(
+        str(tmp_path / "pred.zarr.tiledb"), "gleason"
+    )
+    assert (mask.shape, mask.chunks, resolution) == ((100, 70), (16, 16), [4000, 3000])
+    # without the zarr attribute, float masks are probabilities
+    assert not round_to_0_100
+    expected = arrays["gleason"]
+    assert (mask[90:120] == expected[90:]).all()
+    assert (mask[10:20, 60:] == expected[10:20, 60:]).all()
+    assert mask[120:130].shape == (0, 70)
+    assert (np.array(mask) == expected).all()
+
+
+@pytest.mark.parametrize("streaming", [False, True])
+def test_mask_to_shapes_tiledb_input_closed(tmp_path, monkeypatch, streaming):
+    masks = []
+    init = TileDBMask.__init__
+
+    def record_mask(self, *args):
+        init(self, *args)
+        masks.append(self)
+
+    monkeypatch.setattr(TileDBMask, "__init__", record_mask)
+    _write_prediction_group(tmp_path / "pred.zarr", _prediction_arrays())
+    ZarrToTileDBConverter(logging.getLogger()).run(
+        str(tmp_path / "pred.zarr"), str(tmp_path)
+    )
+    args = ["-o", str(tmp_path / "tdb.json"), "-t", "0.5"]
+    args += ["--streaming"] if streaming else []
+    main([str(tmp_path / "pred.zarr.tiledb"), "--array", "gleason"] + args)
+    assert len(masks) == 1
+    assert not masks[0].array.isopen
+
+
+def test_mask_to_shapes_zarr_input_without_tiledb(tmp_path):
+    _write_group(str(tmp_path / "mask.zarr"), np.zeros((10, 10), "uint8"), [10, 10])
+    code = (
+        "import sys\n"
+        "from promort_tools.converters.mask_to_shapes import main\n"
+        "main([{0!r}, '-o', {1!r}, '-t', '0.5'])\n"
+        "print('tiledb' in sys.modules)\n"
+    ).format(str(tmp_path / "mask.zarr"), str(tmp_path / "mask.json"))
+    output = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    ).stdout
+    assert output.splitlines()[-1] == "False"
+
+
+def test_mask_to_shapes_batch_tiledb_folder(tmp_path):
+    group = _write_prediction_group(tmp_path / "in" / "pred.zarr", _prediction_arrays())
+    group["tumor"].attrs["round_to_0_100"] = True
+    ZarrToTileDBConverter(logging.getLogger()).run(
+        str(tmp_path / "in" / "pred.zarr"), str(tmp_path / "in")
+    )
+    out_folder = tmp_path / "out"
+    argv = [str(tmp_path / "in"), "-o", str(out_folder), "-t", "0.5"]
+    argv += ["--array", "tumor", "--processes", "2"]
+    # workers forked after TileDB was initialised hang, run it apart to time out
+    code = (
+        "from promort_tools.converters.mask_to_shapes import batch_main\n"
+        "batch_main({0!r})\n"
+    ).format(argv)
+    subprocess.run([sys.executable, "-c", code], check=True, timeout=120)
+
+    with open(out_folder / "pred.zarr.json") as f:
+        expected = json.load(f)
+    with open(out_folder / "pred.zarr.tiledb.json") as f:
+        assert json.load(f) == expected
+    with open(out_folder / "report.json") as f:
+        assert json.load(f)["datasets"] == 2
+
+
+def test_zarr_to_tiledb_overviews(tmp_path):
+    arrays = _prediction_arrays(shape=(101, 70))
+    _write_prediction_group(tmp_path / "pred.zarr", arrays)
+    converter = ZarrToTileDBConverter(
+        logging.getLogger(),
+        0.001,
+        consolidate=False,
+        overview_levels=10,
+        attribute_pooling={"gleason": "mean"},
+    )
+    converter.run(str(tmp_path / "pred.zarr"), str(tmp_path))
+
+    with tiledb.open(str(tmp_path / "pred.zarr.tiledb")) as dataset:
+        assert dataset.meta["overview_levels"] == 7
+        assert dataset.meta["overviews"] == "pred.zarr.tiledb.overviews"
+    tumor, gleason = arrays["tumor"], arrays["gleason"].astype("float64")
+    for level in range(1, 8):
+        tumor = np.pad(tumor, [(0, s % 2) for s in tumor.shape], mode="edge")
+        tumor = tumor.reshape(tumor.shape[0] // 2, 2, -1, 2).max(axis=(1, 3))
+        gleason = np.pad(gleason, [(0, s % 2) for s in gleason.shape], mode="edge")
+        gleason = gleason.reshape(gleason.shape[0] // 2, 2, -1, 2).mean(axis=(1, 3))
+        path = str(tmp_path / "pred.zarr.tiledb.overviews" / str(level))
+        with tiledb.open(path) as overview:
+            data = overview[:]
+            assert (data["tumor"] == tumor).all()
+            assert data["gleason"].ravel() == pytest.approx(gleason.ravel(), rel=1e-5)
+            assert overview.meta["downsample_factor"] == 2**level
+            assert overview.meta["tumor.dzi_sampling_level"] == 10 - level
+            assert overview.meta["tumor.pooling"] == "max"
+            assert overview.meta["gleason.pooling"] == "mean"
+            assert overview.meta["base_dataset"] == "pred.zarr.tiledb"
+    assert tumor.shape == (1, 1)
+
+
+def _sparse_prediction_arrays(shape=(100, 70)):
+    arrays = _prediction_arrays(shape)
+    arrays["tumor"][arrays["tumor"] < 95] = 0
+    arrays["gleason"][arrays["gleason"] < 0.9] = 0
+    return arrays
+
+
+def _read_dense(path, shape):
+    with tiledb.open(path) as dataset:
+        data = dataset[:]
+        if not dataset.schema.sparse:
+            return data
+        dense = {}
+        for name in ("tumor", "gleason"):
+            dense[name] = np.zeros(shape, dtype=dataset.schema.attr(name).dtype)
+            dense[name][data["rows"], data["columns"]] = data[name]
+        return dense
+
+
+def test_zarr_to_tiledb_sparse(tmp_path):
+    arrays = _sparse_prediction_arrays()
+    _write_prediction_group(tmp_path / "pred.zarr", arrays)
+    for array_type in ("dense", "sparse"):
+        converter = ZarrToTileDBConverter(
+            logging.getLogger(),
+            0.002,
+            array_type=array_type,
+            consolidate=False,
+            overview_levels=2,
+        )
+        converter.run(str(tmp_path / "pred.zarr"), str(tmp_path / array_type))
+
+    sparse_path = str(tmp_path / "sparse" / "pred.zarr.tiledb")
+    with tiledb.open(sparse_path) as dataset:
+        assert dataset.schema.sparse
+        assert dataset.meta["sparse_threshold"] == 0
+        stored = (arrays["tumor"] > 0) | (arrays["gleason"] > 0)
+        assert len(dataset[:]["tumor"]) == stored.sum()
+    data = _read_dense(sparse_path, (100, 70))
+    for name, expected in arrays.items():
+        assert (data[name] == expected).all()
+    for level in ("1", "2"):
+        with tiledb.open(
+            str(tmp_path / "dense" / "pred.zarr.tiledb.overviews" / level)
+        ) as d, tiledb.open(
+            str(tmp_path / "sparse" / "pred.zarr.tiledb.overviews" / level)
+        ) as s:
+            assert (s[:]["tumor"] == d[:]["tumor"]).all()
+            assert (s[:]["gleason"] == d[:]["gleason"]).all()
+
+
+def test_zarr_to_tiledb_sparse_threshold(tmp_path):
+    arrays = _prediction_arrays()
+    _write_prediction_group(tmp_path / "pred.zarr", {"tumor": arrays["tumor"]})
+    converter = ZarrToTileDBConverter(
+        logging.getLogger(), array_type="sparse", sparse_threshold=50
+    )
+    converter.run(str(tmp_path / "pred.zarr"), str(tmp_path))
+    with tiledb.open(str(tmp_path / "pred.zarr.tiledb")) as dataset:
+        data = dataset[:]
+    expected = arrays["tumor"] > 50
+    assert len(data["tumor"]) == expected.sum()
+    assert (data["tumor"] == arrays["tumor"][data["rows"], data["columns"]]).all()
+    assert (data["tumor"] > 50).all()
+
+
+@pytest.mark.parametrize(
+    "sparse, max_density, expected",
+    [(True, 0.2, True), (False, 0.2, False), (True, 0.1, False)],
+)
+def test_zarr_to_tiledb_auto_array_type(tmp_path, sparse, max_density, expected):
+    # about 15% of the cells of the sparse arrays are stored
+    arrays = _sparse_prediction_arrays() if sparse else _prediction_arrays()
+    _write_prediction_group(tmp_path / "pred.zarr", arrays)
+    converter = ZarrToTileDBConverter(
+        logging.getLogger(), array_type="auto", max_sparse_density=max_density
+    )
+    converter.run(str(tmp_path / "pred.zarr"), str(tmp_path))
+    with tiledb.open(str(tmp_path / "pred.zarr.tiledb")) as dataset:
+        assert dataset.schema.sparse == expected
+
+
+@pytest.mark.parametrize(
+    "module, argv",
+    [
+        ("zarr_to_tiledb", ["--help"]),
+        ("zarr_to_tiledb", ["batch", "--help"]),
+        ("mask_to_shapes", ["--help"]),
+        ("mask_to_shapes", ["batch", "--help"]),
+    ],
+)
+def test_converters_lazy_imports(module, argv):
+    code = (
+        "import runpy, sys\n"
+        "sys.argv = ['{0}'] + {1!r}\n"
+        "try:\n"
+        "    runpy.run_module('promort_tools.converters.{0}', run_name='__main__')\n"
+        "except SystemExit:\n"
+        "    pass\n"
+        "heavy = ('cv2', 'numpy', 'pyclipper', 'shapely', 'tiledb', 'zarr')\n"
+        "print(sorted(set(m.split('.')[0] for m in sys.modules) & set(heavy)))\n"
+    ).format(module, argv)
+    output = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    ).stdout
+    assert "usage:" in output
+    assert output.splitlines()[-1] == "[]"
@@ -0,0 +1,577 @@
+import argparse
+import itertools
+import json
+import logging
+import os
+import stat
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+import pytest
+import requests
+
+from promort_tools.importers import predictions_importer
+from promort_tools.importers.importer import ProMortImporter
+from promort_tools.importers.slides_importer import SlideImporter, SlideImportError
+from promort_tools.importers.tissue_fragments_importer import TissueFragmentsImporter
+from promort_tools.libs.client import (
+    ConcurrentProMortClient,
+    ProMortClient,
+    ProMortInternalServerError,
+)
+from promort_tools.libs.client import client as client_module
+from promort_tools.libs.client.session_cache import DEFAULT_SESSION_CACHE
+from promort_tools.libs.omero import OmeroMetadataFetcher
+
+HOST = "http://promort/"
+
+
+class FakeAdapter(requests.adapters.BaseAdapter):
+    """
+    Transport answering every request with handler(method, path, body),
+    which returns a (status code, json body) pair, and recording the
+    requests as (method, path, body, headers) and their timeouts.
+    """
+
+    def __init__(self, handler=None):
+        super().__init__()
+        self.handler = handler or (lambda *_: (requests.codes.CREATED, {"id": 1}))
+        self.requests = []
+        self.timeouts = []
+        self.lock = threading.Lock()
+
+    def send(self, request, **kwargs):
+        path = urlparse(request.url).path.lstrip("/")
+        body = request.body
+        if body and request.headers.get("Content-Type") == "application/json":
+            body = json.loads(body)
+        with self.lock:
+            self.requests.append((request.method, path, body, request.headers))
+            self.timeouts.append(kwargs.get("timeout"))
+        status_code, content = self.handler(request.method, path, body)
+        response = requests.Response()
+        response.status_code = status_code
+        response._content = json.dumps(content).encode() if content else b""
+        response.request = request
+        response.url = request.url
+        return response
+
+    def close(self):
+        pass
+
+
+def _login(client, adapter):
+    client.promort_client.mount("http://", adapter)
+    client.promort_client.cookies.set("csrftoken", "token")
+    client.csrf_token = "token"
+    client.session_id = "session"
+
+
+def _fragments_importer(adapter, workers=4):
+    importer = TissueFragmentsImporter(
+        HOST, "user", "passwd", "sessionid", logging.getLogger(), workers
+    )
+    _login(importer.promort_client, adapter)
+    importer.promort_client.login = lambda: None
+    return importer
+
+
+def _parse_importer_args(argv):
+    return (
+        ProMortImporter()
+        .make_parser()
+        .parse_args(["--host", HOST, "--user", "user", "--passwd", "passwd"] + argv)
+    )
+
+
+def _shapes(count):
+    return [{"coordinates": [[i, i], [i + 1, i], [i, i + 1]]} for i in range(count)]
+
+
+def test_concurrent_client_max_in_flight():
+    in_flight = []
+    current = [0]
+    lock = threading.Lock()
+
+    def handler(method, path, body):
+        with lock:
+            current[0] += 1
+            in_flight.append(current[0])
+        time.sleep(0.01)
+        with lock:
+            current[0] -= 1
+        return requests.codes.CREATED, {"index": body["index"]}
+
+    with ConcurrentProMortClient(HOST, "user", "passwd", "sessionid", 3) as client:
+        adapter = FakeAdapter(handler)
+        _login(client, adapter)
+        futures = [
+            client.submit("post", "api/items/", json={"index": i}) for i in range(12)
+        ]
+        responses = client.gather(futures)
+    assert [r.json()["index"] for r in responses] == list(range(12))
+    assert max(in_flight) == 3
+    assert all(r[3]["x-csrftoken"] == "token" for r in adapter.requests)
+
+
+def test_concurrent_client_gather_exceptions():
+    client = ConcurrentProMortClient(HOST, "user", "passwd", "sessionid")
+    futures = [client.submit("get", "api/items/", {})]
+    with pytest.raises(Exception):
+        client.gather(futures)
+    assert isinstance(client.gather(futures, return_exceptions=True)[0], Exception)
+    client.close()
+
+
+def test_importer_lazy_subcommands():
+    code = (
+        "import sys\n"
+        "from promort_tools.importers.importer import ProMortImporter\n"
+        "print(ProMortImporter().make_parser().format_help())\n"
+        "print(sorted(m for m in sys.modules if m.startswith(('promort_tools.importers.',"
+        " 'requests', 'numpy', 'zarr'))))\n"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    ).stdout
+    assert "tissue_fragments_importer" in output
+    assert output.splitlines()[-1] == "['promort_tools.importers.importer']"
+    # the arguments of a subcommand are known once it runs
+    args = _parse_importer_args(
+        ["predictions_importer", "--prediction-label", "P1", "--slide-label", "S1"]
+        + ["--prediction-type", "TUMOR"]
+    )
+    assert args.func is predictions_importer.implementation
+    assert (args.prediction_label, args.prediction_type) == ("P1", "TUMOR")
+
+
+def _flaky_handler(failures, status=requests.codes.INTERNAL_SERVER_ERROR):
+    calls = [0]
+
+    def handler(method, path, body):
+        calls[0] += 1
+        if calls[0] <= failures:
+            if status is None:
+                raise requests.ConnectionError("connection reset")
+            return status, {"detail": "error"}
+        return requests.codes.OK, {"id": 1}
+
+    return handler
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(client_module.time, "sleep", sleeps.append)
+    return sleeps
+
+
+@pytest.mark.parametrize("status", [requests.codes.SERVICE_UNAVAILABLE, None])
+def test_client_retries(sleeps, status):
+    adapter = FakeAdapter(_flaky_handler(2, status))
+    client = ProMortClient(HOST, "user", "passwd", "sessionid", timeout=5)
+    _login(client, adapter)
+    assert client.get("api/slides/", {}).status_code == requests.codes.OK
+    assert len(adapter.requests) == 3
+    assert adapter.timeouts == [5, 5, 5]
+    assert len(sleeps) == 2
+    assert all(0 <= s <= client.backoff_factor * 2**i for i, s in enumerate(sleeps))
+
+
+def test_client_retries_exhausted(sleeps):
+    adapter = FakeAdapter(_flaky_handler(10))
+    client = ProMortClient(HOST, "user", "passwd", "sessionid", retries=2)
+    _login(client, adapter)
+    with pytest.raises(ProMortInternalServerError):
+        client.put("api/slides/S1/", {})
+    assert len(adapter.requests) == 3
+    adapter = FakeAdapter(_flaky_handler(10, None))
+    _login(client, adapter)
+    with pytest.raises(requests.ConnectionError):
+        client.get("api/slides/", {})
+    assert len(adapter.requests) == 3
+
+
+def test_client_post_retries(sleeps):
+    adapter = FakeAdapter(_flaky_handler(1))
+    client = ProMortClient(HOST, "user", "passwd", "sessionid")
+    _login(client, adapter)
+    with pytest.raises(ProMortInternalServerError):
+        client.post("api/slides/", {"id": "S1"})
+    assert len(adapter.requests) == 1
+    assert client.post("api/slides/", {"id": "S1"}, retry=True).ok
+    client = ProMortClient(HOST, "user", "passwd", "sessionid", retry_posts=True)
+    adapter = FakeAdapter(_flaky_handler(1))
+    _login(client, adapter)
+    assert client.post("api/slides/", {"id": "S1"}).ok
+    assert len(adapter.requests) == 2
+
+
+def test_client_options():
+    args = _parse_importer_args(
+        ["--timeout", "2.5", "--retries", "0", "--pool-size", "4", "--no-keep-alive"]
+        + ["slides_importer", "--slide-label", "S1"]
+    )
+    importer = SlideImporter(
+        HOST,
+        "user",
+        "passwd",
+        "sessionid",
+        logging.getLogger(),
+        8,
+        **client_module.get_client_options(args)
+    )
+    client = importer.promort_client
+    assert (client.timeout, client.retries, client.retry_posts) == (2.5, 0, False)
+    assert client.promort_client.headers["Connection"] == "close"
+    # the pool holds at least one connection for each request in flight
+    assert client.promort_client.get_adapter(HOST)._pool_maxsize == 8
+
+
+def test_client_session_cache_options(tmp_path):
+    args = _parse_importer_args(["slides_importer", "--slide-label", "S1"])
+    assert not client_module.get_client_options(args)["session_cache"]
+    # the flag takes no value, the subcommand after it is still parsed
+    args = _parse_importer_args(
+        ["--session-cache", "slides_importer", "--slide-label", "S1"]
+    )
+    assert args.slide_label == "S1"
+    options = client_module.get_client_options(args)
+    assert options["session_cache"] == DEFAULT_SESSION_CACHE
+    cache = str(tmp_path / "sessions.json")
+    args = _parse_importer_args(
+        ["--session-cache", "--session-cache-file", cache, "slides_importer"]
+        + ["--slide-label", "S1"]
+    )
+    assert client_module.get_client_options(args)["session_cache"] == cache
+
+
+def _session_handler(client, statuses, first_session=1):
+    """
+    Login sets a new session cookie, other requests answer the next of
+    statuses or 200.
+    """
+    sessions = itertools.count(first_session)
+
+    def handler(method, path, body):
+        if path == "api/auth/login/":
+            client.promort_client.cookies.set(
+                "csrftoken", "token", domain="promort.local"
+            )
+            client.promort_client.cookies.set(
+                "sessionid", "s{0}".format(next(sessions)), domain="promort.local"
+            )
+            return requests.codes.OK, None
+        return statuses.pop(0) if statuses else requests.codes.OK, None
+
+    return handler
+
+
+def test_client_session_cache(tmp_path):
+    cache = str(tmp_path / "cache" / "sessions.json")
+    client = ProMortClient(HOST, "user", "passwd", "sessionid", session_cache=cache)
+    adapter = FakeAdapter(_session_handler(client, []))
+    client.promort_client.mount("http://", adapter)
+    client.login()
+    client.logout()
+    assert [r[1] for r in adapter.requests] == ["api/auth/login/"]
+    assert stat.S_IMODE(os.stat(cache).st_mode) == 0o600
+
+    client = ProMortClient(HOST, "user", "passwd", "sessionid", session_cache=cache)
+    adapter = FakeAdapter(_session_handler(client, [requests.codes.FORBIDDEN], 2))
+    client.promort_client.mount("http://", adapter)
+    client.login()
+    assert (client.csrf_token, client.session_id) == ("token", "s1")
+    assert adapter.requests == []
+    # the cached session expired on the server, log in again and retry
+    assert client.put("api/slides/S1/", {}).ok
+    assert [r[1] for r in adapter.requests] == [
+        "api/slides/S1/",
+        "api/auth/login/",
+        "api/slides/S1/",
+    ]
+    assert adapter.requests[0][3]["Cookie"] == "csrftoken=token; sessionid=s1"
+    assert adapter.requests[2][3]["Cookie"] == "csrftoken=token; sessionid=s2"
+    with open(cache) as f:
+        assert "s2" in f.read()
+    # a request rejected after logging in again is not retried
+    adapter.handler = _session_handler(client, [requests.codes.FORBIDDEN] * 2)
+    assert client.get("api/slides/", {}).status_code == requests.codes.FORBIDDEN
+    assert len(adapter.requests) == 6
+
+    # other users and clients without cache log in
+    for client in (
+        ProMortClient(HOST, "other", "passwd", "sessionid", session_cache=cache),
+        ProMortClient(HOST, "user", "passwd", "sessionid"),
+    ):
+        adapter = FakeAdapter(_session_handler(client, []))
+        client.promort_client.mount("http://", adapter)
+        client.login()
+        client.logout()
+        assert len(adapter.requests) == 2 - (client.session_cache is not None)
+    os.chmod(cache, 0o644)
+    client = ProMortClient(HOST, "user", "passwd", "sessionid", session_cache=cache)
+    adapter = FakeAdapter(_session_handler(client, []))
+    client.promort_client.mount("http://", adapter)
+    client.login()
+    assert len(adapter.requests) == 1
+
+
+def test_tissue_fragments_bulk():
+    adapter = FakeAdapter()
+    failures = _fragments_importer(adapter)._create_fragments(7, _shapes(5), 2)
+    assert failures == []
+    assert [(r[1], len(r[2])) for r in adapter.requests] == [
+        ("api/tissue_fragments_collections/7/fragments/bulk/", n) for n in (2, 2, 1)
+    ]
+    assert [f["shape_json"] for r in adapter.requests for f in r[2]] == _shapes(5)
+
+
+def test_tissue_fragments_concurrent(tmp_path):
+    def handler(method, path, body):
+        if path.endswith("/bulk/"):
+            return requests.codes.NOT_FOUND, None
+        if path == "api/tissue_fragments_collections/":
+            return requests.codes.CREATED, {"id": 7}
+        if path == "api/auth/logout/":
+            return requests.codes.OK, None
+        if body["shape_json"]["coordinates"][0][0] in (1, 3):
+            return requests.codes.BAD, None
+        return requests.codes.CREATED, None
+
+    adapter = FakeAdapter(handler)
+    with open(tmp_path / "shapes.json", "w") as f:
+        json.dump({"shapes": _shapes(5)}, f)
+    args = argparse.Namespace(
+        prediction_id="p",
+        shapes=str(tmp_path / "shapes.json"),
+        batch_size=2,
+        bulk=True,
+        failed_shapes=str(tmp_path / "failed.json"),
+    )
+    with pytest.raises(SystemExit):
+        _fragments_importer(adapter, workers=3).run(args)
+
+    bulk_requests = [r for r in adapter.requests if r[1].endswith("/bulk/")]
+    assert len(bulk_requests) == 1
+    created = [
+        r[2]["shape_json"]
+        for r in adapter.requests
+        if r[1] == "api/tissue_fragments_collections/7/fragments/"
+    ]
+    assert sorted(s["coordinates"][0][0] for s in created) == [0, 1, 2, 3, 4]
+    with open(tmp_path / "failed.json") as f:
+        failed = json.load(f)
+    assert failed["shapes"] == [_shapes(5)[1], _shapes(5)[3]]
+    assert [e["index"] for e in failed["errors"]] == [1, 3]
+
+
+def test_slides_manifest(tmp_path):
+    def handler(method, path, body):
+        if path == "api/cases/":
+            return requests.codes.CREATED, None
+        if path == "api/slides/":
+            if "id=C2-2" in body:
+                return requests.codes.CONFLICT, None
+            return requests.codes.CREATED, None
+        return requests.codes.OK, None
+
+    adapter = FakeAdapter(handler)
+    manifest = tmp_path / "cohort.csv"
+    manifest.write_text(
+        "slide_label,case_label,omero_id,mirax\n"
+        "C1-1,,,\n"
+        "C1-2,,12,true\n"
+        "C2-1,,,\n"
+        "C2-2,,,\n"
+        "X-1,CX,,\n"
+    )
+    importer = SlideImporter(
+        HOST, "user", "passwd", "sessionid", logging.getLogger(), workers=3
+    )
+    _login(importer.promort_client, adapter)
+    importer.promort_client.login = lambda: None
+    args = _parse_importer_args(
+        ["slides_importer", "--manifest", str(manifest), "--extract-case"]
+    )
+    with pytest.raises(SystemExit):
+        importer.run(args)
+
+    case_requests = sorted(r[2] for r in adapter.requests if r[1] == "api/cases/")
+    assert case_requests == ["id=C1", "id=C2", "id=CX"]
+    slide_requests = [r[2] for r in adapter.requests if r[1] == "api/slides/"]
+    assert "id=C1-2&case=C1&omero_id=12&image_type=MIRAX" in slide_requests
+    with open(tmp_path / "cohort.results.jsonl") as f:
+        results = [json.loads(line) for line in f]
+    assert [(r["slide_label"], r["case_label"], r["status"]) for r in results] == [
+        ("C1-1", "C1", "CREATED"),
+        ("C1-2", "C1", "CREATED"),
+        ("C2-1", "C2", "CREATED"),
+        ("C2-2", "C2", "ERROR"),
+        ("X-1", "CX", "CREATED"),
+    ]
+    assert results[3]["error"] == "ERROR: duplicated slide"
+
+
+def test_slides_manifest_case_error(tmp_path):
+    def handler(method, path, body):
+        if path == "api/cases/":
+            return requests.codes.FORBIDDEN, {"detail": "forbidden"}
+        return requests.codes.CREATED, None
+
+    adapter = FakeAdapter(handler)
+    manifest = tmp_path / "cohort.csv"
+    manifest.write_text("slide_label,case_label\nC1-1,C1\n")
+    importer = SlideImporter(HOST, "user", "passwd", "sessionid", logging.getLogger())
+    _login(importer.promort_client, adapter)
+    importer.promort_client.login = lambda: None
+    args = _parse_importer_args(["slides_importer", "--manifest", str(manifest)])
+    with pytest.raises(SystemExit):
+        importer.run(args)
+
+    # slides of cases that were not created are not sent
+    assert not [r for r in adapter.requests if r[1] == "api/slides/"]
+    with open(tmp_path / "cohort.results.jsonl") as f:
+        (result,) = [json.loads(line) for line in f]
+    assert result["status"] == "ERROR"
+    assert result["error"] == 'ERROR while creating Case: 403 {"detail": "forbidden"}'
+
+
+def test_slides_manifest_rows(tmp_path):
+    manifest = tmp_path / "cohort.jsonl"
+    manifest.write_text(
+        '{"slide_label": "C1-1", "mirax": true}\n\n{"slide_label": "C2-1", "omero_id": 3}\n'
+    )
+    importer = SlideImporter(HOST, "user", "passwd", "sessionid", logging.getLogger())
+    args = _parse_importer_args(
+        ["slides_importer", "--manifest", str(manifest), "--omero-host", "http://ome/"]
+    )
+    rows = importer._read_manifest(str(manifest))
+    assert len(rows) == 2
+    with pytest.raises(SlideImportError):
+        importer._get_manifest_row(rows[0], args)
+    args.case_label = "C"
+    assert importer._get_manifest_row(rows[1], args) == {
+        "slide_label": "C2-1",
+        "case_label": "C",
+        "omero_id": 3,
+        "mirax_file": False,
+        "omero_host": "http://ome/",
+    }
+    args.omero_id = 7
+    assert importer._get_manifest_row(rows[0], args) == {
+        "slide_label": "C1-1",
+        "case_label": "C",
+        "omero_id": None,
+        "mirax_file": True,
+        "omero_host": "http://ome/",
+    }
+
+
+@pytest.fixture
+def omero_server():
+    """
+    ome_seadragon stand-in, the metadata of slide N has image_mpp N / 4
+    (MIRAX slide labels end with -N) and N = 99 is unknown.
+    """
+    hits = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            hits.append(self.path)
+            name = self.path.rsplit("/", 1)[-1][: -len("_metadata.json")]
+            index = int(name.rsplit("-", 1)[-1])
+            if index == 99:
+                self.send_response(404)
+                self.end_headers()
+                return
+            content = json.dumps({"image_mpp": index / 4}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield "http://127.0.0.1:{0}/".format(server.server_port), hits
+    server.shutdown()
+    server.server_close()
+
+
+def test_omero_metadata_cache(tmp_path, omero_server):
+    url, hits = omero_server
+    cache = str(tmp_path / "omero.json")
+    slides = [
+        (url, "C1-1", 1, False),
+        (url, "C1-2", 2, False),
+        (url, "C1-3", None, True),
+        (url, "C1-4", 99, False),
+    ]
+    fetcher = OmeroMetadataFetcher(cache, workers=4)
+    assert fetcher.prefetch(slides + slides[:2]) == []
+    assert sorted(hits) == [
+        "/ome_seadragon/deepzoom/get/1_metadata.json",
+        "/ome_seadragon/deepzoom/get/2_metadata.json",
+        "/ome_seadragon/deepzoom/get/99_metadata.json",
+        "/ome_seadragon/mirax/deepzoom/get/C1-3_metadata.json",
+    ]
+    assert [fetcher.get_image_mpp(*s) for s in slides] == [0.25, 0.5, 0.75, None]
+    # unknown slides are not cached
+    assert len(hits) == 5
+
+    fetcher = OmeroMetadataFetcher(cache)
+    assert fetcher.prefetch(slides[:3]) == []
+    assert fetcher.get_image_mpp(url, "C1-2", 2) == 0.5
+    assert len(hits) == 5
+    fetcher = OmeroMetadataFetcher(cache, ttl=0)
+    assert fetcher.get_image_mpp(url, "C1-2", 2) == 0.5
+    assert len(hits) == 6
+    failures = OmeroMetadataFetcher().prefetch(
+        [("http://127.0.0.1:1/", "C1-1", 1, False)]
+    )
+    assert isinstance(failures[0][1], requests.ConnectionError)
+
+
+def test_slides_manifest_omero_cache(tmp_path, omero_server):
+    url, hits = omero_server
+    manifest = tmp_path / "cohort.csv"
+    manifest.write_text(
+        "slide_label,case_label,omero_id,mirax\n"
+        "C1-1,C1,1,\n"
+        "C1-2,C1,7,true\n"
+        "C1-3,C1,,\n"
+    )
+    argv = ["slides_importer", "--manifest", str(manifest), "--omero-host", url]
+    argv += ["--omero-cache", str(tmp_path / "omero.json"), "--ignore-duplicated"]
+    for status in (requests.codes.CREATED, requests.codes.CONFLICT):
+        adapter = FakeAdapter(lambda method, path, body: (status, None))
+        args = _parse_importer_args(argv)
+        importer = SlideImporter(
+            HOST,
+            "user",
+            "passwd",
+            "sessionid",
+            logging.getLogger(),
+            2,
+            args.omero_cache,
+            args.omero_cache_ttl * 3600,
+        )
+        _login(importer.promort_client, adapter)
+        importer.promort_client.login = lambda: None
+        importer.run(args)
+        updates = sorted((r[1], r[2]) for r in adapter.requests if r[0] == "PUT")
+        assert updates == [
+            ("api/slides/C1-1/", "image_microns_per_pixel=0.25&omero_id=1"),
+            ("api/slides/C1-2/", "image_microns_per_pixel=0.5&omero_id=7"),
+        ]
+        # the second run reads the metadata from the cache
+        assert len(hits) == 2